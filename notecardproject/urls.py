@@ -17,11 +17,14 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from django.contrib.auth import views as auth_views
 
+from notecards import search
+
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^', include('notecards.urls')),
     url(r'^accounts/logout/$', auth_views.logout,
      {'next_page': '/notecards/'}),
     url(r'^accounts/', include('allauth.urls')),
-    url(r'^search/', include('haystack.urls')),
+    # Kept for links to the search page from before it moved into the app
+    url(r'^search/$', search.deck_search),
 ]
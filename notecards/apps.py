@@ -0,0 +1,9 @@
+from django.apps import AppConfig
+
+
+class NotecardsConfig(AppConfig):
+    name = 'notecards'
+
+    def ready(self):
+        # Connect the signal handlers
+        from notecards import signals  # noqa
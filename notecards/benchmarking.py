@@ -0,0 +1,294 @@
+'''
+Seeding large data sets and measuring how the busiest views perform on
+them, used by the benchmark command.
+
+Seeding writes users, decks, tags and cards with bulk inserts, and cards
+with plain executemany() calls since building millions of model instances
+would take far longer than inserting them. The denormalized data the
+views rely on (card counts, deck counters, score histograms and tag
+counts) is written alongside, so the views see the data set as if it had
+been built through the site.
+
+Seeding refuses to write to a database holding anything but an earlier
+seeded data set, and the seeded users have unusable passwords, so nobody
+can log in as them. The benchmark logs its clients in by setting up their
+sessions directly.
+
+Views are driven through Django's test client, which goes through the
+same URL resolving, middleware and templates as a real request. Each
+request is timed and its queries counted, and a few more are made with
+tracemalloc running to find the view's peak memory use, which is kept out
+of the timings since tracing slows everything down.
+'''
+import gc
+import random
+import time
+import tracemalloc
+from collections import Counter
+from importlib import import_module
+
+from django.conf import settings
+from django.contrib.auth import (BACKEND_SESSION_KEY, HASH_SESSION_KEY,
+                                 SESSION_KEY)
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.template.defaultfilters import slugify
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from taggit.models import Tag, TaggedItem
+
+from notecards import tagging
+from notecards.stats import percentile
+from notecards.models import (MAX_DECKS, Card, Deck, DeckCounter,
+                              ScoreBucket)
+
+
+# Usernames of the seeded users start with this
+PREFIX = 'bench-'
+# Number of rows inserted per statement while seeding
+CHUNK_SIZE = 5000
+# Number of tags the seeded decks are tagged with
+NUM_TAGS = 50
+# Requests made with tracemalloc running to measure each view's memory
+MEMORY_REQUESTS = 3
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def seeded():
+    '''Returns True if there is a seeded data set in the database.'''
+    return User.objects.filter(username=PREFIX + '0').exists()
+
+
+def unseeded():
+    '''
+    Returns True if the database holds users that weren't seeded, which
+    means it isn't set aside for benchmarking.
+    '''
+    return User.objects.exclude(username__startswith=PREFIX).exists()
+
+
+def login(client, user):
+    '''Logs the test client in as the user without a password.'''
+    session = import_module(settings.SESSION_ENGINE).SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = 'django.contrib.auth.backends.ModelBackend'
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+
+def seed(users, decks, cards, rand=random, chunkSize=CHUNK_SIZE, log=None):
+    '''
+    Fills the database with `users` users, `decks` decks shared evenly
+    between them and `cards` cards shared evenly between the decks. Every
+    tenth deck is unpublished.
+    Raises ValueError if the database holds anything else.
+    '''
+    if unseeded():
+        raise ValueError('The database holds data that was not seeded, '
+                         'only benchmark against an empty database set '
+                         'aside for it')
+    if decks > users * MAX_DECKS:
+        raise ValueError('Users can have at most {0} decks each'
+                         .format(MAX_DECKS))
+    log = log or (lambda message: None)
+    password = make_password(None)
+
+    for chunk in _chunks(range(users), chunkSize):
+        User.objects.bulk_create(
+            [User(username='{0}{1}'.format(PREFIX, i), password=password)
+             for i in chunk])
+    userIds = list(User.objects.filter(username__startswith=PREFIX)
+                               .order_by('id')
+                               .values_list('id', flat=True))
+    log('Created {0} user(s)'.format(len(userIds)))
+
+    perDeck, extra = divmod(cards, decks) if decks else (0, 0)
+    owned = Counter()
+    for chunk in _chunks(range(decks), chunkSize):
+        newDecks = []
+        for i in chunk:
+            title = 'Bench deck {0}'.format(i)
+            authorId = userIds[i % len(userIds)]
+            owned[authorId] += 1
+            newDecks.append(Deck(author_id=authorId,
+                                 title=title,
+                                 slug=slugify(title),
+                                 description='Seeded for benchmarking',
+                                 published=i % 10 != 0,
+                                 card_count=perDeck + (i < extra)))
+        Deck.objects.bulk_create(newDecks)
+    DeckCounter.objects.bulk_create(
+        [DeckCounter(user_id=userId, count=count)
+         for userId, count in owned.items()])
+    deckIds = list(Deck.objects.filter(author_id__in=userIds)
+                               .order_by('id')
+                               .values_list('id', flat=True))
+    log('Created {0} deck(s)'.format(len(deckIds)))
+
+    tags = [Tag.objects.get_or_create(name='bench{0}'.format(i),
+                                      defaults={'slug': 'bench{0}'.format(i)})
+            [0] for i in range(NUM_TAGS)]
+    contentType = ContentType.objects.get_for_model(Deck)
+    for chunk in _chunks(deckIds, chunkSize):
+        TaggedItem.objects.bulk_create(
+            [TaggedItem(content_type=contentType, object_id=deckId, tag=tag)
+             for deckId in chunk
+             for tag in rand.sample(tags, rand.randint(1, 3))])
+    tagging.rebuild_counts()
+
+    table = connection.ops.quote_name(Card._meta.db_table)
+    insert = 'INSERT INTO {0} (front, back, deck_id, score) ' \
+             'VALUES (%s, %s, %s, %s)'.format(table)
+    rows = []
+    buckets = []
+    inserted = 0
+
+    def flush():
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.executemany(insert, rows)
+            ScoreBucket.objects.bulk_create(buckets)
+        del rows[:]
+        del buckets[:]
+
+    for position, deckId in enumerate(deckIds):
+        scores = Counter()
+        for i in range(perDeck + (position < extra)):
+            score = rand.randint(0, 5)
+            scores[score] += 1
+            rows.append(('front {0}'.format(i), 'back {0}'.format(i),
+                         deckId, score))
+        buckets.extend(ScoreBucket(deck_id=deckId, score=score, count=count)
+                       for score, count in scores.items())
+        if len(rows) >= chunkSize:
+            inserted += len(rows)
+            flush()
+            log('Created {0} card(s)'.format(inserted))
+    if rows or buckets:
+        inserted += len(rows)
+        flush()
+    log('Created {0} card(s)'.format(inserted))
+
+
+class Benchmark(object):
+    '''
+    Drives the views against the seeded data set. Each scenario method
+    picks a deck at random and returns the (client, method, path, data) of
+    the request to make.
+    '''
+
+    views = ('get_card', 'check_answer', 'get_decks', 'view_deck',
+             'clone_deck')
+    # Views whose changes are rolled back after every request, so that
+    # running the benchmark doesn't grow the data set
+    rolled_back = ('clone_deck',)
+
+    def __init__(self, rand=random):
+        self.rand = rand
+        self.anonymous = Client()
+        self._clients = {}
+        users = User.objects.filter(username__startswith=PREFIX)
+        self.usernames = dict(users.values_list('id', 'username'))
+        decks = Deck.objects.filter(author__in=users)
+        self.decks = list(decks.values_list('id', 'author_id'))
+        self.published = list(decks.filter(published=True)
+                                   .values_list('id', 'author_id'))
+        self.drillable = list(decks.filter(card_count__gt=0)
+                                   .values_list('id', 'author_id'))
+        self.cards = decks.aggregate(cards=Sum('card_count'))['cards'] or 0
+
+    def client(self, userId):
+        '''Returns a client logged in as the user.'''
+        if userId not in self._clients:
+            client = Client()
+            login(client, User.objects.get(pk=userId))
+            self._clients[userId] = client
+        return self._clients[userId]
+
+    def get_card(self):
+        deckId, authorId = self.rand.choice(self.drillable)
+        return (self.client(authorId), 'get',
+                reverse('get_card', kwargs={'deckid': deckId}), {})
+
+    def check_answer(self):
+        deckId, authorId = self.rand.choice(self.drillable)
+        cardId = Card.objects.filter(deck_id=deckId) \
+                             .values_list('id', flat=True)[0]
+        return (self.client(authorId), 'post',
+                reverse('check_answer', kwargs={'deckid': deckId}),
+                {'cardid': cardId, 'ans': 'back 0'})
+
+    def get_decks(self):
+        return self.anonymous, 'get', reverse('decks'), {}
+
+    def view_deck(self):
+        deckId, authorId = self.rand.choice(self.published)
+        return self.anonymous, 'get', reverse('view_deck'), {'did': deckId}
+
+    def clone_deck(self):
+        deckId, authorId = self.rand.choice(self.decks)
+        # Anyone but the deck's author
+        userId = self.rand.choice([userId for userId in self.usernames
+                                   if userId != authorId] or [authorId])
+        return (self.client(userId), 'get', reverse('clone_deck'),
+                {'did': deckId})
+
+    def _request(self, view):
+        client, method, path, data = getattr(self, view)()
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            if view in self.rolled_back:
+                with transaction.atomic():
+                    response = getattr(client, method)(path, data)
+                    transaction.set_rollback(True)
+            else:
+                response = getattr(client, method)(path, data)
+            if response.streaming:
+                b''.join(response.streaming_content)
+            elapsed = time.perf_counter() - start
+        return elapsed, len(queries), response.status_code
+
+    def run(self, view, requests, warmup=0):
+        '''
+        Makes `requests` requests to the view after `warmup` untimed ones.
+        Returns a dict of the latency percentiles in milliseconds, the
+        queries per request, the peak memory in bytes and the number of
+        requests that got an error status.
+        '''
+        for i in range(warmup):
+            self._request(view)
+        timings = []
+        queries = []
+        errors = 0
+        for i in range(requests):
+            elapsed, numQueries, status = self._request(view)
+            timings.append(elapsed * 1000)
+            queries.append(numQueries)
+            if status >= 400:
+                errors += 1
+        gc.collect()
+        tracemalloc.start()
+        try:
+            for i in range(MEMORY_REQUESTS):
+                self._request(view)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {'requests': requests,
+                'errors': errors,
+                'mean': sum(timings) / len(timings),
+                'p50': percentile(timings, 50),
+                'p95': percentile(timings, 95),
+                'p99': percentile(timings, 99),
+                'queries': {'mean': sum(queries) / len(queries),
+                            'max': max(queries)},
+                'peak_memory': peak}
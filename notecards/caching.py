@@ -0,0 +1,108 @@
+'''
+Caching of rendered deck pages and deck listing fragments.
+
+Entries are keyed by the version of every deck they show, so they never
+need invalidating: when a deck, its tags or its cards change the deck's
+version is bumped, pages showing it get new keys, and the stale entries
+are left for the cache to evict.
+
+The cache named by the NOTECARDS_CACHE setting is used when the project
+configures one, so every process shares the rendered output. Otherwise
+each process keeps its most recently used entries in memory.
+'''
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+# Number of entries each process keeps when there's no shared cache
+LRU_SIZE = 1000
+# Seconds an entry is kept in the shared cache
+TIMEOUT = 60 * 60
+
+
+class LRUCache(object):
+    '''
+    A thread safe in-memory cache that evicts the least recently used
+    entry once it holds `size` entries.
+    '''
+
+    def __init__(self, size=LRU_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return default
+            self._entries[key] = value
+            return value
+
+    def set(self, key, value, timeout=None):
+        # Entries are never stale since their keys carry the deck versions,
+        # so the timeout is only there to match Django's cache API
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def incr(self, key, delta=1):
+        with self._lock:
+            if key not in self._entries:
+                raise ValueError('Key {0} not found'.format(key))
+            self._entries[key] += delta
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_local = LRUCache()
+
+
+def is_shared():
+    '''Returns True if every process uses the same cache.'''
+    return bool(getattr(settings, 'NOTECARDS_CACHE', None))
+
+
+def get_cache():
+    '''Returns the shared cache if one is configured, else the local one.'''
+    if is_shared():
+        return caches[settings.NOTECARDS_CACHE]
+    return _local
+
+
+def deck_version(deck):
+    '''
+    Returns the parts of a deck that change whenever what it shows
+    changes. Linked clones include their source deck, whose cards they show.
+    '''
+    parts = [deck.id, deck.version, deck.dateModified.isoformat()]
+    if deck.source_id:
+        parts += [deck.source.version, deck.source.dateModified.isoformat()]
+    return parts
+
+
+def cached(name, parts, render):
+    '''
+    Returns the entry for `name` at the version given by `parts`, calling
+    `render` to build and store it if it isn't cached.
+    '''
+    version = ':'.join(str(part) for part in parts)
+    key = 'notecards:{0}:{1}'.format(
+        name, hashlib.md5(version.encode()).hexdigest())
+    cache = get_cache()
+    value = cache.get(key)
+    if value is None:
+        value = render()
+        cache.set(key, value, TIMEOUT)
+    return value
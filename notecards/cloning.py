@@ -0,0 +1,168 @@
+'''
+Copying decks from one user to another.
+
+Cloning a deck creates a linked clone: a deck row of its own, with its
+own title, description and tags, that shows the cards of the source deck
+instead of copying them. The new owner's scores are kept per card in
+CardProgress, so popular decks don't get their cards duplicated for
+every learner. Linked clones follow the source deck's cards as its
+author edits them.
+
+The cards are only copied (copy on write) when the owner edits the clone's
+cards. The copy is built in a single transaction with chunked bulk inserts
+and carries the owner's progress over as the new cards' scores, and the
+owner's review history over to the new cards.
+
+When the source deck is deleted its cards aren't copied at all: they're
+handed over to its oldest linked clone, which becomes the source deck of
+the others, in a few statements however many clones and cards there are.
+This happens however the deck is deleted, including along with its
+author's account or through a queryset.
+'''
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Case, IntegerField, Q, Value, When
+
+from taggit.models import TaggedItem
+
+from notecards import indexing, sampling
+from notecards.models import Card, CardProgress, Deck, Review
+
+
+# Number of cards copied per INSERT
+CHUNK_SIZE = 500
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def clone_deck(deck, user):
+    '''
+    Creates an unpublished linked clone of the deck and its tags owned by
+    the user. The clone starts with no progress, so every card has a score
+    of 0.
+    Raises ValidationError if the user already owns the deck or a copy of
+    it, or a deck with the same title.
+    Returns the new deck.
+    '''
+    if deck.author_id == user.id:
+        raise ValidationError('You already own this deck')
+    if Deck.objects.filter(author=user, title=deck.title).exists():
+        raise ValidationError('You already own a deck with this title')
+    contentId = deck.content_id
+    owned = Deck.objects.filter(author=user) \
+                        .filter(Q(pk=contentId) | Q(source_id=contentId))
+    if owned.exists():
+        raise ValidationError('You already own a copy of this deck')
+    with transaction.atomic():
+        newDeck = Deck(author=user,
+                       title=deck.title,
+                       description=deck.description,
+                       published=False,
+                       source_id=contentId)
+        try:
+            with transaction.atomic():
+                newDeck.save()
+        except IntegrityError:
+            raise ValidationError('You already own a deck with this title')
+        # Copy the tags
+        TaggedItem.objects.bulk_create(
+            [TaggedItem(content_object=newDeck, tag=tag)
+             for tag in deck.tags.all()])
+    return newDeck
+
+
+def materialize(deck, chunkSize=CHUNK_SIZE):
+    '''
+    Turns a linked clone into a deck with cards of its own. The source
+    deck's cards are copied with the owner's progress as their scores.
+    Returns a dict mapping the ids of the source deck's cards to the ids
+    of their copies, which is empty if the deck wasn't a linked clone.
+    '''
+    with transaction.atomic():
+        # Lock the deck so the cards can't be copied twice
+        sourceId = Deck.objects.select_for_update() \
+                               .filter(pk=deck.pk) \
+                               .values_list('source_id', flat=True)[0]
+        if sourceId is None:
+            deck.source = None
+            return {}
+        progress = CardProgress.objects.filter(deck=deck)
+        scores = dict(progress.values_list('card_id', 'score'))
+        copies = {}
+        cards = Card.objects.filter(deck_id=sourceId) \
+                            .order_by('id') \
+                            .values_list('id', 'front', 'back') \
+                            .iterator()
+        for chunk in _chunks(cards, chunkSize):
+            Card.objects.bulk_create(
+                [Card(front=front,
+                      back=back,
+                      deck=deck,
+                      score=scores.get(cardid, 0),
+                      origin=cardid)
+                 for cardid, front, back in chunk])
+            # bulk_create doesn't return the new ids
+            chunkCopies = dict(
+                Card.objects.filter(deck=deck,
+                                    origin__in=[row[0] for row in chunk])
+                            .values_list('origin', 'id'))
+            Review.objects.filter(deck=deck,
+                                  card_id__in=list(chunkCopies)) \
+                          .update(card_id=Case(*[When(card_id=old,
+                                                      then=Value(new))
+                                                 for old, new
+                                                 in chunkCopies.items()],
+                                               output_field=IntegerField()))
+            copies.update(chunkCopies)
+        progress.delete()
+        Deck.objects.filter(pk=deck.pk).update(source=None)
+        deck.source = None
+        deck.touch(len(copies))
+        sampling.rebuild_buckets(deck)
+        indexing.cards_changed(deck.id)
+    return copies
+
+
+def hand_over(deck, exclude=()):
+    '''
+    Moves the deck's cards to its oldest linked clone whose id isn't in
+    exclude, with the clone owner's progress as their scores, and makes
+    that clone the source of the deck's other linked clones, whose
+    progress stays with the cards. Used while deleting the deck, see
+    notecards.models.hand_over_cards.
+    Returns the clone the cards went to, or None if there were no clones.
+    '''
+    with transaction.atomic():
+        clones = Deck.objects.select_for_update().filter(source=deck)
+        cloneIds = list(clones.exclude(pk__in=exclude)
+                              .order_by('id')
+                              .values_list('id', flat=True))
+        if not cloneIds:
+            return None
+        heir = Deck.objects.get(pk=cloneIds[0])
+        moved = Card.objects.filter(deck=deck).update(deck=heir)
+        deck.card_count -= moved
+        # Scores are the heir's progress, cards it never answered score 0
+        cards = Card.objects.filter(deck=heir)
+        cards.update(score=0)
+        progress = CardProgress.objects.filter(deck=heir)
+        for score in set(progress.values_list('score', flat=True)):
+            cards.filter(pk__in=progress.filter(score=score)
+                                        .values('card_id')) \
+                 .update(score=score)
+        progress.delete()
+        clones.exclude(pk=heir.pk).update(source=heir)
+        Deck.objects.filter(pk=heir.pk).update(source=None)
+        heir.source = None
+        heir.touch(moved)
+        sampling.rebuild_buckets(heir)
+    return heir
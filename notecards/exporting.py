@@ -0,0 +1,178 @@
+'''
+Streaming output of a deck's cards.
+
+The cards are read a page at a time, ordered by id and starting after the
+last card of the previous page, and written out a chunk at a time. Every
+page is a small query of its own, so exporting a deck takes the same
+amount of memory however many cards it holds and whichever database
+backend is in use.
+
+Decks can be exported as CSV, JSON Lines or the tab separated text that
+Anki imports, all of which can be imported again (see notecards.importing).
+A user's decks can be exported together as a zip archive with one file
+per deck, which is compressed as it's sent.
+'''
+import csv
+import io
+import json
+import zipfile
+
+
+# Number of cards written out per chunk
+CHUNK_SIZE = 200
+
+
+def _rows(cards, fields, chunkSize):
+    # Paging by id keeps each query small, where iterating one big query
+    # would have most database drivers load all of it at once
+    lastId = 0
+    while True:
+        page = list(cards.filter(id__gt=lastId)
+                         .order_by('id')
+                         .values_list('id', *fields)[:chunkSize])
+        for row in page:
+            yield row
+        if len(page) < chunkSize:
+            return
+        lastId = page[-1][0]
+
+
+def json_cards(cards, chunkSize=CHUNK_SIZE):
+    '''
+    Yields a card queryset as JSON in chunks. The output has the same
+    shape as Django's JSON serializer.
+    '''
+    rows = _rows(cards, ('front', 'back', 'deck_id', 'score'), chunkSize)
+    chunk = ['[']
+    separator = ''
+    for cardid, front, back, deckid, score in rows:
+        chunk.append(separator)
+        chunk.append(json.dumps({'model': 'notecards.card',
+                                 'pk': cardid,
+                                 'fields': {'front': front,
+                                            'back': back,
+                                            'deck': deckid,
+                                            'score': score}}))
+        separator = ', '
+        if len(chunk) >= chunkSize * 2:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def jsonl_cards(cards, chunkSize=CHUNK_SIZE):
+    '''Yields a card queryset as JSON Lines, one card per line, in chunks.'''
+    chunk = []
+    for cardid, front, back in _rows(cards, ('front', 'back'), chunkSize):
+        chunk.append(json.dumps({'front': front, 'back': back}) + '\n')
+        if len(chunk) >= chunkSize:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+
+
+def pack_cards(cards, scores=None, chunkSize=CHUNK_SIZE):
+    '''
+    Yields a card queryset in chunks as a JSON list of compact
+    [id, front, back, score] lists, for drilling offline. `scores` maps
+    card ids to the scores to use instead of the cards' own, with cards
+    missing from it scoring 0, which is how linked clones keep theirs.
+    '''
+    rows = _rows(cards, ('front', 'back', 'score'), chunkSize)
+    chunk = ['[']
+    separator = ''
+    for cardid, front, back, score in rows:
+        if scores is not None:
+            score = scores.get(cardid, 0)
+        chunk.append(separator)
+        chunk.append(json.dumps([cardid, front, back, score]))
+        separator = ', '
+        if len(chunk) >= chunkSize * 2:
+            yield ''.join(chunk)
+            chunk = []
+    chunk.append(']')
+    yield ''.join(chunk)
+
+
+def _delimited(cards, chunkSize, header, **formatting):
+    output = io.StringIO()
+    output.write(header)
+    writer = csv.writer(output, **formatting)
+    for count, (cardid, front, back) in enumerate(
+            _rows(cards, ('front', 'back'), chunkSize), 1):
+        writer.writerow([front, back])
+        if count % chunkSize == 0:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+    if output.tell():
+        yield output.getvalue()
+
+
+def csv_cards(cards, chunkSize=CHUNK_SIZE):
+    '''Yields a card queryset as CSV with a header row, in chunks.'''
+    return _delimited(cards, chunkSize, 'front,back\r\n')
+
+
+def anki_cards(cards, chunkSize=CHUNK_SIZE):
+    '''
+    Yields a card queryset in chunks as the tab separated text that Anki
+    imports as notes, with the card's front and back as the note's fields.
+    '''
+    return _delimited(cards, chunkSize, '#separator:tab\n#html:false\n',
+                      delimiter='\t', lineterminator='\n')
+
+
+# Maps each export format to its writer, file extension and content type
+FORMATS = {'csv': (csv_cards, 'csv', 'text/csv'),
+           'jsonl': (jsonl_cards, 'jsonl', 'application/x-ndjson'),
+           'anki': (anki_cards, 'txt', 'text/plain')}
+
+
+def filename(deck, format):
+    '''Returns the name of the file a deck is exported to.'''
+    return '{0}.{1}'.format(deck.slug or deck.id, FORMATS[format][1])
+
+
+class _Output(object):
+    '''A file that holds what's written to it until it's taken.'''
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive(decks, format, chunkSize=CHUNK_SIZE):
+    '''
+    Yields a zip archive holding each of the decks in the given format, in
+    chunks of bytes.
+    '''
+    write = FORMATS[format][0]
+    output = _Output()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as zipFile:
+        for deck in decks:
+            # Different titles can have the same slug
+            info = zipfile.ZipInfo(
+                '{0}-{1}'.format(deck.id, filename(deck, format)),
+                deck.dateModified.timetuple()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zipFile.open(info, 'w') as member:
+                for chunk in write(deck.cards(), chunkSize):
+                    member.write(chunk.encode())
+                    data = output.take()
+                    if data:
+                        yield data
+    yield output.take()
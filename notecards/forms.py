@@ -23,3 +23,8 @@ class deckForm(forms.ModelForm):
         super(deckForm, self).__init__(*args, **kwargs)
         for field in iter(self.fields):
             self.fields[field].widget.attrs['class'] = 'fullwidth'
+
+
+class importForm(forms.Form):
+    file = forms.FileField(help_text='A CSV or tab separated file with a '
+                                     'card\'s front and back on each line.')
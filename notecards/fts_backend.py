@@ -0,0 +1,338 @@
+'''
+A haystack search backend storing the index in an SQLite FTS5 table.
+
+It runs inside the Django process, so small installations and tests can
+search without an Elasticsearch cluster. Results are ranked with BM25 and
+can be filtered on any indexed field, for example tags:
+
+    HAYSTACK_CONNECTIONS = {
+        'default': {
+            'ENGINE': 'notecards.fts_backend.FTS5Engine',
+            'PATH': os.path.join(BASE_DIR, 'search.sqlite3'),
+        },
+    }
+
+PATH defaults to an in-memory index, which only lasts as long as the
+process. The backend needs an SQLite built with FTS5, which is the case
+for the SQLite bundled with recent Python releases. Sorting, faceting and
+"more like this" aren't supported.
+'''
+import json
+import os
+import sqlite3
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import six
+
+from haystack import connections
+from haystack.backends import (BaseEngine, BaseSearchBackend,
+                               BaseSearchQuery, log_query)
+from haystack.constants import DJANGO_CT, DJANGO_ID, ID
+from haystack.exceptions import SearchBackendError
+from haystack.inputs import Clean, PythonData
+from haystack.models import SearchResult
+from haystack.utils import get_identifier, get_model_ct
+from haystack.utils.app_loading import haystack_get_model
+
+
+# FTS5 table holding the indexed text, and the table giving each document
+# a rowid so documents can be replaced without scanning the index
+DOCUMENTS = 'haystack_documents'
+IDS = 'haystack_ids'
+
+# Reserved columns of the documents table
+RESERVED = (ID, DJANGO_CT, DJANGO_ID, 'data')
+
+TOKENIZE = 'porter unicode61 remove_diacritics 2'
+
+# One connection per database and process, shared by every thread
+_databases = {}
+_databasesLock = threading.Lock()
+
+
+def _database(path, timeout):
+    key = (path, os.getpid())
+    with _databasesLock:
+        if key not in _databases:
+            db = sqlite3.connect(path, timeout=timeout,
+                                 check_same_thread=False)
+            if path != ':memory:':
+                # Searches don't have to wait for updates
+                db.execute('PRAGMA journal_mode=WAL')
+            _databases[key] = (db, threading.RLock())
+        return _databases[key]
+
+
+def _quote(word):
+    return '"{0}"'.format(word.replace('"', '""'))
+
+
+class FTS5SearchBackend(BaseSearchBackend):
+
+    def __init__(self, connection_alias, **connection_options):
+        super(FTS5SearchBackend, self).__init__(connection_alias,
+                                                **connection_options)
+        self.path = connection_options.get('PATH', ':memory:')
+        self.tokenize = connection_options.get('TOKENIZE', TOKENIZE)
+        self.db, self.lock = _database(self.path, self.timeout)
+        if 'fts5' not in self._compile_options():
+            raise ImproperlyConfigured('The SQLite used by Python was built '
+                                       'without FTS5')
+        self.setup_complete = False
+
+    def _compile_options(self):
+        return ' '.join(row[0] for row in
+                        self.db.execute('PRAGMA compile_options')).lower()
+
+    def build_schema(self, fields):
+        '''
+        Returns the name of the document field and the indexed fields, which
+        each get a column of the documents table.
+        '''
+        content = ''
+        columns = []
+        for fieldName, field in sorted(fields.items()):
+            if field.document:
+                content = field.index_fieldname
+            if field.indexed and field.index_fieldname not in columns:
+                columns.append(field.index_fieldname)
+        return content, columns
+
+    def setup(self):
+        unifiedIndex = connections[self.connection_alias].get_unified_index()
+        self.content_field_name, self.columns = self.build_schema(
+            unifiedIndex.all_searchfields())
+        with self.lock, self.db:
+            existing = [row[1] for row in
+                        self.db.execute('PRAGMA table_info({0})'
+                                        .format(DOCUMENTS))]
+            wanted = ['data'] + self.columns
+            if existing and existing != wanted:
+                # The indexes changed, the index has to be rebuilt anyway
+                self.db.execute('DROP TABLE {0}'.format(DOCUMENTS))
+                self.db.execute('DROP TABLE IF EXISTS {0}'.format(IDS))
+                existing = []
+            if not existing:
+                self.db.execute(
+                    "CREATE VIRTUAL TABLE {0} USING fts5("
+                    "data UNINDEXED, {1}, tokenize='{2}')"
+                    .format(DOCUMENTS,
+                            ', '.join(_quote(col) for col in self.columns),
+                            self.tokenize))
+            self.db.execute('CREATE TABLE IF NOT EXISTS {0} ('
+                            'identifier TEXT PRIMARY KEY, '
+                            'django_ct TEXT, '
+                            'django_id TEXT)'.format(IDS))
+            self.db.execute('CREATE INDEX IF NOT EXISTS {0}_ct '
+                            'ON {0} (django_ct)'.format(IDS))
+        self.setup_complete = True
+
+    def _text(self, value):
+        if isinstance(value, (list, tuple, set)):
+            return ' '.join(self._text(item) for item in value)
+        if value is None:
+            return ''
+        return six.text_type(value)
+
+    def update(self, index, iterable, commit=True):
+        if not self.setup_complete:
+            self.setup()
+        insert = 'INSERT INTO {0} (rowid, data, {1}) VALUES (?, ?{2})' \
+                 .format(DOCUMENTS,
+                         ', '.join(_quote(col) for col in self.columns),
+                         ', ?' * len(self.columns))
+        with self.lock, self.db:
+            for obj in iterable:
+                doc = index.full_prepare(obj)
+                rowid = self._rowid(doc[ID], doc[DJANGO_CT], doc[DJANGO_ID])
+                self.db.execute('DELETE FROM {0} WHERE rowid = ?'
+                                .format(DOCUMENTS), (rowid,))
+                data = dict((key, value) for key, value in doc.items()
+                            if key not in RESERVED)
+                self.db.execute(insert,
+                                [rowid, json.dumps(data,
+                                                   cls=DjangoJSONEncoder)] +
+                                [self._text(doc.get(col))
+                                 for col in self.columns])
+
+    def _rowid(self, identifier, ct, pk):
+        self.db.execute('INSERT OR IGNORE INTO {0} '
+                        '(identifier, django_ct, django_id) VALUES (?, ?, ?)'
+                        .format(IDS), (identifier, ct, six.text_type(pk)))
+        return self.db.execute('SELECT rowid FROM {0} WHERE identifier = ?'
+                               .format(IDS), (identifier,)).fetchone()[0]
+
+    def remove(self, obj_or_string, commit=True):
+        if not self.setup_complete:
+            self.setup()
+        identifier = get_identifier(obj_or_string)
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM {0} WHERE rowid IN '
+                            '(SELECT rowid FROM {1} WHERE identifier = ?)'
+                            .format(DOCUMENTS, IDS), (identifier,))
+            self.db.execute('DELETE FROM {0} WHERE identifier = ?'
+                            .format(IDS), (identifier,))
+
+    def clear(self, models=None, commit=True):
+        if not self.setup_complete:
+            self.setup()
+        with self.lock, self.db:
+            if models is None:
+                self.db.execute('DELETE FROM {0}'.format(DOCUMENTS))
+                self.db.execute('DELETE FROM {0}'.format(IDS))
+                return
+            cts = [get_model_ct(model) for model in models]
+            where = 'django_ct IN ({0})'.format(', '.join('?' * len(cts)))
+            self.db.execute('DELETE FROM {0} WHERE rowid IN '
+                            '(SELECT rowid FROM {1} WHERE {2})'
+                            .format(DOCUMENTS, IDS, where), cts)
+            self.db.execute('DELETE FROM {0} WHERE {1}'.format(IDS, where),
+                            cts)
+
+    @log_query
+    def search(self, query_string, sort_by=None, start_offset=0,
+               end_offset=None, highlight=False, narrow_queries=None,
+               models=None, limit_to_registered_models=None,
+               result_class=None, **kwargs):
+        if not self.setup_complete:
+            self.setup()
+        if not query_string:
+            return {'results': [], 'hits': 0}
+        if sort_by:
+            raise SearchBackendError('The FTS5 backend only orders results '
+                                     'by relevance')
+
+        where = []
+        params = []
+        match = [] if query_string == '*' else ['({0})'.format(query_string)]
+        match += ['({0})'.format(narrow) for narrow in narrow_queries or []]
+        if match:
+            where.append('{0} MATCH ?'.format(DOCUMENTS))
+            params.append(' AND '.join(match))
+        if models:
+            cts = [get_model_ct(model) for model in models]
+        elif limit_to_registered_models is not False:
+            cts = self.build_models_list()
+        else:
+            cts = []
+        if cts:
+            where.append('i.django_ct IN ({0})'
+                         .format(', '.join('?' * len(cts))))
+            params.extend(cts)
+
+        tables = '{0} JOIN {1} AS i ON i.rowid = {0}.rowid' \
+                 .format(DOCUMENTS, IDS)
+        where = ' AND '.join(where) or '1'
+        columns = 'i.django_ct, i.django_id, {0}.data, {1}'.format(
+            DOCUMENTS, 'bm25({0})'.format(DOCUMENTS) if match else '0')
+        if highlight and match:
+            column = self.columns.index(self.content_field_name) + 1
+            columns += ", highlight({0}, {1}, '<em>', '</em>')".format(
+                DOCUMENTS, column)
+        limit = -1 if end_offset is None else end_offset - start_offset
+        order = 'bm25({0})'.format(DOCUMENTS) if match else 'i.rowid'
+
+        try:
+            with self.lock:
+                hits = self.db.execute('SELECT count(*) FROM {0} WHERE {1}'
+                                       .format(tables, where),
+                                       params).fetchone()[0]
+                rows = self.db.execute(
+                    'SELECT {0} FROM {1} WHERE {2} ORDER BY {3} '
+                    'LIMIT ? OFFSET ?'.format(columns, tables, where, order),
+                    params + [limit, start_offset]).fetchall()
+        except sqlite3.OperationalError as e:
+            # Queries FTS5 can't parse, like ones that only exclude terms
+            if not self.silently_fail:
+                raise SearchBackendError(six.text_type(e))
+            return {'results': [], 'hits': 0}
+
+        return {'results': self._process_results(rows, result_class),
+                'hits': hits}
+
+    def _process_results(self, rows, result_class=None):
+        resultClass = result_class or SearchResult
+        unifiedIndex = connections[self.connection_alias].get_unified_index()
+        results = []
+        for row in rows:
+            ct, pk, data, rank = row[:4]
+            appLabel, modelName = ct.split('.')
+            model = haystack_get_model(appLabel, modelName)
+            if model is None:
+                continue
+            index = unifiedIndex.get_index(model)
+            fields = {}
+            for key, value in json.loads(data).items():
+                field = index.fields.get(key)
+                if field is not None and hasattr(field, 'convert'):
+                    value = field.convert(value)
+                fields[str(key)] = value
+            if len(row) > 4:
+                fields['highlighted'] = {self.content_field_name: [row[4]]}
+            # BM25 ranks better matches lower, haystack expects the reverse
+            results.append(resultClass(appLabel, modelName, pk, -rank,
+                                       **fields))
+        return results
+
+
+class FTS5SearchQuery(BaseSearchQuery):
+
+    def clean(self, query_fragment):
+        '''
+        Quotes every word, so user input can't be read as FTS5 syntax.
+        '''
+        if not isinstance(query_fragment, six.string_types):
+            return query_fragment
+        return ' '.join(_quote(word) for word in query_fragment.split())
+
+    def build_exact_query(self, query_string):
+        # The words have already been quoted one by one
+        return _quote(query_string.replace('"', ''))
+
+    def build_query(self):
+        query = super(FTS5SearchQuery, self).build_query()
+        # NOT only works between two expressions in FTS5
+        return query.replace(' AND NOT ', ' NOT ')
+
+    def build_query_fragment(self, field, filter_type, value):
+        if not hasattr(value, 'input_type_name'):
+            if hasattr(value, 'values_list'):
+                value = list(value)
+            if isinstance(value, six.string_types) and value != ' ':
+                value = Clean(value)
+            else:
+                value = PythonData(value)
+        prepared = value.prepare(self)
+
+        if filter_type == 'in':
+            expression = ' OR '.join(self.build_exact_query(self.clean(
+                six.text_type(item))) for item in prepared)
+        else:
+            if not isinstance(prepared, six.string_types):
+                prepared = self.clean(six.text_type(prepared))
+            if filter_type in ('contains', 'content', 'fuzzy'):
+                expression = prepared
+            elif filter_type == 'startswith':
+                expression = prepared + ' *'
+            elif filter_type == 'exact':
+                if value.input_type_name != 'exact':
+                    prepared = self.build_exact_query(prepared)
+                expression = prepared
+            else:
+                raise SearchBackendError('The FTS5 backend does not support '
+                                         '{0} filters'.format(filter_type))
+        if not expression:
+            return ''
+
+        if field != 'content':
+            unifiedIndex = connections[self._using].get_unified_index()
+            return '{0} : ({1})'.format(
+                _quote(unifiedIndex.get_index_fieldname(field)), expression)
+        return '({0})'.format(expression)
+
+
+class FTS5Engine(BaseEngine):
+    backend = FTS5SearchBackend
+    query = FTS5SearchQuery
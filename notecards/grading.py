@@ -0,0 +1,182 @@
+'''
+Grading of drill answers.
+
+A user's answer for a card is correct if it matches the back of any card
+in the deck with the same front, giving the user the benefit of the doubt.
+Every matching card gains a point, up to a maximum of 5. If nothing
+matches, every card with that front is reset to 1 point.
+
+Answers are graded in batches. The cards involved are read in one query,
+then the score changes are written with one UPDATE per distinct sequence
+of changes, so a whole drill session can be graded in a handful of
+statements.
+
+For linked clones the scores are the owner's CardProgress rows, which are
+created the first time the owner answers a card.
+
+Answers given while drilling offline are synced the same way: they're
+replayed in order against the scores the server holds, so answers given
+on another device in the meantime are kept, and the client takes on the
+resulting scores.
+
+Every graded answer can be logged as a Review in the same transaction as
+the scores it changes, see notecards.reviewing.
+'''
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+
+from notecards import sampling
+from notecards.models import Card, CardProgress, Review
+
+
+MAX_SCORE = 5
+RESET_SCORE = 1
+
+# Codes for the changes a card goes through while grading a batch
+CORRECT = '+'
+WRONG = '0'
+
+
+def _final_score(score, changes):
+    for change in changes:
+        if change == WRONG:
+            score = RESET_SCORE
+        elif score < MAX_SCORE:
+            score += 1
+    return score
+
+
+def _score_expression(changes):
+    # The score a card ends up with only depends on the last reset and the
+    # number of points added after it, which lets every card that went
+    # through the same changes share one UPDATE.
+    lastReset = changes.rfind(WRONG)
+    points = changes[lastReset + 1:].count(CORRECT)
+    if lastReset >= 0:
+        return Value(min(MAX_SCORE, RESET_SCORE + points))
+    return Case(When(score__gte=MAX_SCORE, then=F('score')),
+                When(score__gte=MAX_SCORE - points, then=Value(MAX_SCORE)),
+                default=F('score') + points)
+
+
+def check_answer(deck, card, userAnswer):
+    '''
+    Returns 'correct' if the answer matches the back of any card in the
+    deck with the same front as the card, or 'wrong', without saving
+    anything.
+    '''
+    matching = Card.objects.filter(deck_id=deck.content_id,
+                                   front=card.front,
+                                   back=userAnswer)
+    return 'correct' if matching.exists() else 'wrong'
+
+
+def grade_answers(deck, answers):
+    '''
+    Grades a sequence of (cardid, answer) pairs for cards in the deck, in
+    order, and saves the resulting scores.
+    Returns a list with one dict per answer holding the 'cardid', the
+    'result' ('correct', 'wrong' or 'unknown' for cards not in the deck)
+    and the card's real 'answer'.
+    '''
+    return sync_answers(deck, answers)[0]
+
+
+def sync_answers(deck, answers, reviews=None):
+    '''
+    Grades answers the same way as grade_answers. `reviews`, if given,
+    holds a (userid, dateAnswered, responseTime) tuple for each answer,
+    and a Review is logged for each answer to a card in the deck.
+    Returns the list of results and a dict mapping the id of every card
+    whose score was graded to its new score.
+    '''
+    cardids = set(cardid for cardid, answer in answers)
+    with transaction.atomic():
+        # Every card that shares a front with one of the answered cards
+        presented = Card.objects.filter(deck_id=deck.content_id,
+                                        pk__in=cardids) \
+                                .values('front')
+        cards = Card.objects.filter(deck_id=deck.content_id,
+                                    front__in=presented)
+        if deck.source_id:
+            # Linked clones keep the owner's scores as progress rows
+            cards = list(cards.order_by('id'))
+            progress = CardProgress.objects.select_for_update() \
+                                           .filter(deck=deck,
+                                                   card__in=cards)
+            scores = dict(progress.values_list('card_id', 'score'))
+        else:
+            cards = list(cards.select_for_update().order_by('id'))
+            scores = dict((card.id, card.score) for card in cards)
+        byId = dict((card.id, card) for card in cards)
+        byFront = defaultdict(list)
+        for card in cards:
+            byFront[card.front].append(card)
+
+        changes = defaultdict(str)
+        results = []
+        newReviews = []
+        for position, (cardid, userAnswer) in enumerate(answers):
+            card = byId.get(cardid)
+            if card is None:
+                results.append({'cardid': cardid, 'result': 'unknown'})
+                continue
+            result = {'cardid': cardid, 'answer': card.back,
+                      'result': 'wrong'}
+            for ans in byFront[card.front]:
+                if ans.back == userAnswer:
+                    changes[ans.id] += CORRECT
+                    result['result'] = 'correct'
+            if result['result'] == 'wrong':
+                for ans in byFront[card.front]:
+                    changes[ans.id] += WRONG
+            results.append(result)
+            if reviews is not None:
+                userid, dateAnswered, responseTime = reviews[position]
+                newReviews.append(
+                    Review(user_id=userid,
+                           deck=deck,
+                           card_id=cardid,
+                           correct=result['result'] == 'correct',
+                           dateAnswered=dateAnswered,
+                           responseTime=responseTime))
+
+        # Cards that went through the same changes get the same UPDATE
+        groups = defaultdict(list)
+        moves = Counter()
+        newProgress = []
+        finalScores = {}
+        for cardid, cardChanges in changes.items():
+            if cardid in scores:
+                groups[cardChanges].append(cardid)
+                score = scores[cardid]
+                moves[score] -= 1
+            else:
+                # First answer for this card in a linked clone
+                score = 0
+                newProgress.append(
+                    CardProgress(user_id=deck.author_id,
+                                 deck=deck,
+                                 card_id=cardid,
+                                 score=_final_score(score, cardChanges)))
+            finalScores[cardid] = _final_score(score, cardChanges)
+            moves[finalScores[cardid]] += 1
+        if deck.source_id:
+            for cardChanges, ids in groups.items():
+                CardProgress.objects.filter(deck=deck, card__in=ids) \
+                    .update(score=_score_expression(cardChanges))
+            CardProgress.objects.bulk_create(newProgress)
+        else:
+            for cardChanges, ids in groups.items():
+                Card.objects.filter(pk__in=ids) \
+                            .update(score=_score_expression(cardChanges))
+        if changes:
+            # Offline drills hold on to the scores until they change
+            deck.touch_scores()
+        sampling.update_buckets(deck, moves)
+        if newReviews:
+            Review.objects.bulk_create(newReviews)
+
+    return results, finalScores
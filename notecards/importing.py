@@ -0,0 +1,154 @@
+'''
+Importing cards from CSV and tab separated files.
+
+Files are read a line at a time and the cards are inserted in chunks, one
+transaction and one bulk INSERT per chunk, so files with hundreds of
+thousands of rows can be imported without holding them in memory. Each
+chunk is committed as it's written, so an import that fails part way
+keeps the cards inserted before the failure.
+
+Each row holds a card's front and back in its first two columns, which
+covers spreadsheets saved as CSV and Anki's "Notes in Plain Text" export.
+Further columns (such as Anki's tags) are ignored, as is a first row of
+'front' and 'back' headings. Rows are validated with the same rules as
+cardForm, and rows that fail are left out and reported by line number.
+'''
+import codecs
+import csv
+import itertools
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from notecards import cloning, indexing, sampling
+from notecards.forms import cardForm
+from notecards.models import Card
+
+
+# Number of cards inserted per transaction
+CHUNK_SIZE = 500
+# Most row errors kept for the report, the rest are only counted
+MAX_ERRORS = 100
+
+# Values of the separator header in Anki exports
+SEPARATORS = {'tab': '\t',
+              'comma': ',',
+              'semicolon': ';',
+              'pipe': '|',
+              'space': ' '}
+
+
+def decode(upload, encoding='utf-8-sig'):
+    '''Yields the lines of an uploaded file as text.'''
+    return codecs.iterdecode(upload, encoding)
+
+
+def read_rows(lines):
+    '''
+    Yields (line number, fields) for every row of a CSV or tab separated
+    file given as lines of text. Files are tab separated if their first
+    line holds a tab, unless an Anki #separator header says otherwise.
+    '''
+    lines = iter(lines)
+    delimiter = None
+    skipped = 0
+    for line in lines:
+        if line.startswith('#'):
+            # Anki headers, like #separator:tab or #html:true
+            key, _, value = line[1:].strip().partition(':')
+            if key == 'separator' and (value.lower() in SEPARATORS or
+                                       len(value) == 1):
+                delimiter = SEPARATORS.get(value.lower(), value)
+        elif line.strip():
+            break
+        skipped += 1
+    else:
+        return
+    if delimiter is None:
+        delimiter = '\t' if '\t' in line else ','
+    reader = csv.reader(itertools.chain([line], lines), delimiter=delimiter)
+    for fields in reader:
+        yield skipped + reader.line_num, fields
+
+
+def _clean(fields):
+    # The form's fields are used directly rather than binding a form per
+    # row, which applies the same rules at a fraction of the cost
+    if len(fields) < 2:
+        raise ValidationError('Expected a front and a back')
+    cleaned = {}
+    errors = []
+    for name, value in zip(('front', 'back'), fields):
+        try:
+            cleaned[name] = cardForm.base_fields[name].clean(value)
+        except ValidationError as e:
+            errors.extend('{0}: {1}'.format(name, message)
+                          for message in e.messages)
+    if errors:
+        raise ValidationError(errors)
+    return cleaned
+
+
+def _insert(deck, cards):
+    with transaction.atomic():
+        Card.objects.bulk_create(cards)
+        deck.touch(len(cards))
+        sampling.add_cards(deck, [card.score for card in cards])
+        indexing.cards_changed(deck.id)
+
+
+def import_cards(deck, lines, chunkSize=CHUNK_SIZE, progress=None):
+    '''
+    Adds a card to the deck for every valid row of a CSV or tab separated
+    file, given as lines of text. Linked clones get their own copy of the
+    cards first. `progress` is called with the number of cards imported so
+    far after each chunk is inserted.
+    Returns a dict with the number of cards 'imported', the number of rows
+    that 'failed' and a list of (line number, message) 'errors' for the
+    first MAX_ERRORS of them.
+    '''
+    cloning.materialize(deck)
+    imported = failed = 0
+    errors = []
+    chunk = []
+
+    def fail(lineNumber, messages):
+        if len(errors) < MAX_ERRORS:
+            errors.append((lineNumber, ' '.join(messages)))
+
+    lineNumber = 0
+    first = True
+    try:
+        for lineNumber, fields in read_rows(lines):
+            if not any(field.strip() for field in fields):
+                continue
+            if first:
+                first = False
+                headings = [field.strip().lower() for field in fields[:2]]
+                if headings == ['front', 'back']:
+                    continue
+            try:
+                cleaned = _clean(fields)
+            except ValidationError as e:
+                failed += 1
+                fail(lineNumber, e.messages)
+                continue
+            chunk.append(Card(front=cleaned['front'],
+                              back=cleaned['back'],
+                              deck=deck))
+            if len(chunk) == chunkSize:
+                _insert(deck, chunk)
+                imported += len(chunk)
+                chunk = []
+                if progress is not None:
+                    progress(imported)
+    except (csv.Error, UnicodeDecodeError) as e:
+        # Nothing after a malformed line can be trusted
+        failed += 1
+        fail(lineNumber + 1, ['Could not read the file: {0}'.format(e)])
+    if chunk:
+        _insert(deck, chunk)
+        imported += len(chunk)
+        if progress is not None:
+            progress(imported)
+    return {'imported': imported, 'failed': failed, 'errors': errors}
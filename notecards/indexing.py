@@ -0,0 +1,293 @@
+'''
+Keeping the search index up to date.
+
+QueuedSignalProcessor is a haystack signal processor that queues decks as
+they are created, edited, published, unpublished, retagged or deleted, or
+their cards change, and sends them to the search backend in batches a few
+seconds later. New
+decks show up in search almost straight away while the backend only sees
+one bulk update per batch, however busy the site is. Enable it with
+
+    HAYSTACK_SIGNAL_PROCESSOR = 'notecards.indexing.QueuedSignalProcessor'
+
+The queue lives in memory, so changes queued by a process that dies
+before flushing are picked up by the next update_deck_index run.
+'''
+import atexit
+import datetime
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, models
+from django.db.models import Max, Min
+
+from haystack import connections as haystack_connections
+from haystack.exceptions import NotHandled
+from haystack.signals import BaseSignalProcessor
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between flushes of the queue
+FLUSH_INTERVAL = 5
+# Most objects sent to the backend at once
+BATCH_SIZE = 100
+
+UPDATE = 'update'
+DELETE = 'delete'
+# An update of a deck and its linked clones, whose documents hold its cards
+CARDS = 'cards'
+
+# Incremental updates look this far behind the watermark, so decks saved
+# in a transaction that committed after the last update started aren't
+# missed
+WATERMARK_OVERLAP = datetime.timedelta(minutes=5)
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+# Models are looked up when needed because haystack imports this module
+# before the app registry is ready
+
+def _deck_index(using):
+    Deck = apps.get_model('notecards', 'Deck')
+    return haystack_connections[using].get_unified_index().get_index(Deck)
+
+
+def cards_changed(deckId):
+    '''
+    Queues the deck and its linked clones for reindexing after its cards
+    were added or removed in bulk, which sends no signals. Does nothing
+    unless the QueuedSignalProcessor is in use.
+    '''
+    import haystack
+    if isinstance(haystack.signal_processor, QueuedSignalProcessor):
+        haystack.signal_processor.enqueue_cards(deckId)
+
+
+def pk_ranges(queryset, size):
+    '''Splits a queryset into [start, end) ranges of `size` primary keys.'''
+    bounds = queryset.aggregate(low=Min('pk'), high=Max('pk'))
+    if bounds['low'] is None:
+        return []
+    return [(start, start + size)
+            for start in range(bounds['low'], bounds['high'] + 1, size)]
+
+
+def index_range(bounds):
+    '''
+    Sends the indexed decks with primary keys in [start, end) on the search
+    connection `using` to the backend in one update. Takes a single
+    (using, start, end) tuple so it can be handed to a worker pool.
+    Returns the number of decks sent.
+    '''
+    using, start, end = bounds
+    index = _deck_index(using)
+    decks = list(index.index_queryset(using=using)
+                      .filter(pk__gte=start, pk__lt=end))
+    if decks:
+        haystack_connections[using].get_backend().update(index, decks)
+    return len(decks)
+
+
+def update_decks(using, pks, chunkSize=BATCH_SIZE):
+    '''
+    Brings the search index up to date for the decks with the given
+    primary keys. Decks that no longer belong in the index, because they
+    were deleted or unpublished, are removed from it.
+    Returns the number of decks (updated, removed).
+    '''
+    index = _deck_index(using)
+    backend = haystack_connections[using].get_backend()
+    updated = removed = 0
+    for chunk in _chunks(list(pks), chunkSize):
+        decks = list(index.index_queryset(using=using).filter(pk__in=chunk))
+        if decks:
+            backend.update(index, decks)
+        found = set(deck.pk for deck in decks)
+        for pk in chunk:
+            if pk not in found:
+                backend.remove('notecards.deck.{0}'.format(pk))
+        updated += len(decks)
+        removed += len(chunk) - len(decks)
+    return updated, removed
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    '''
+    Queues saved and deleted objects that have a search index and flushes
+    them to the backends every NOTECARDS_INDEX_INTERVAL seconds, or sooner
+    once NOTECARDS_INDEX_BATCH objects are waiting. With an interval of
+    None nothing is sent until flush() is called.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        # Maps (model, pk) to the last thing that happened to the object
+        self._queue = OrderedDict()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+        super(QueuedSignalProcessor, self).__init__(*args, **kwargs)
+
+    @property
+    def interval(self):
+        return getattr(settings, 'NOTECARDS_INDEX_INTERVAL', FLUSH_INTERVAL)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'NOTECARDS_INDEX_BATCH', BATCH_SIZE)
+
+    def setup(self):
+        models.signals.post_save.connect(self.handle_save)
+        models.signals.post_delete.connect(self.handle_delete)
+
+    def teardown(self):
+        models.signals.post_save.disconnect(self.handle_save)
+        models.signals.post_delete.disconnect(self.handle_delete)
+
+    def handle_save(self, sender, instance, **kwargs):
+        self._queue_tagged(sender, instance)
+        self._queue_carded(sender, instance)
+        self.enqueue(sender, instance.pk, UPDATE)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self._queue_tagged(sender, instance)
+        self._queue_carded(sender, instance)
+        self.enqueue(sender, instance.pk, DELETE)
+
+    def _queue_carded(self, sender, instance):
+        # Card text is indexed with the deck, which isn't saved when its
+        # cards change
+        meta = sender._meta
+        if (meta.app_label, meta.model_name) == ('notecards', 'card'):
+            self.enqueue_cards(instance.deck_id)
+
+    def _queue_tagged(self, sender, instance):
+        # Tags are indexed with the object they're on, which isn't saved
+        # when its tags change
+        meta = sender._meta
+        if (meta.app_label, meta.model_name) != ('taggit', 'taggeditem'):
+            return
+        from django.contrib.contenttypes.models import ContentType
+        contentType = ContentType.objects.get_for_id(instance.content_type_id)
+        self.enqueue(contentType.model_class(), instance.object_id, UPDATE)
+
+    def _indexed(self, model):
+        for using in self.connection_router.for_write():
+            try:
+                self.connections[using].get_unified_index().get_index(model)
+                return True
+            except NotHandled:
+                pass
+        return False
+
+    def enqueue(self, model, pk, action):
+        '''Queues an update or delete of one object.'''
+        if model is None or not self._indexed(model):
+            return
+        with self._lock:
+            queued = self._queue.pop((model, pk), None)
+            if action == UPDATE and queued == CARDS:
+                # Still has to bring the linked clones up to date
+                action = CARDS
+            self._queue[(model, pk)] = action
+            full = len(self._queue) >= self.batch_size
+        if self.interval is None:
+            return
+        self._start_worker()
+        if full:
+            self._wake.set()
+
+    def enqueue_cards(self, deckId):
+        '''Queues an update of the deck and of its linked clones.'''
+        self.enqueue(apps.get_model('notecards', 'Deck'), deckId, CARDS)
+
+    def pending(self):
+        '''Returns the queued (model, pk, action) triples.'''
+        with self._lock:
+            return [(model, pk, action)
+                    for (model, pk), action in self._queue.items()]
+
+    def flush(self):
+        '''
+        Sends everything queued to the search backends, along with the
+        linked clones of decks whose cards changed.
+        Returns the number of objects sent.
+        '''
+        with self._lock:
+            queue, self._queue = self._queue, OrderedDict()
+        byModel = defaultdict(OrderedDict)
+        for (model, pk), action in queue.items():
+            byModel[model][pk] = UPDATE if action == CARDS else action
+        try:
+            carded = [pk for (model, pk), action in queue.items()
+                      if action == CARDS]
+            if carded:
+                Deck = apps.get_model('notecards', 'Deck')
+                clones = Deck.objects.filter(source_id__in=carded) \
+                                     .values_list('id', flat=True)
+                for pk in clones:
+                    byModel[Deck].setdefault(pk, UPDATE)
+            for model, actions in byModel.items():
+                for using in self.connection_router.for_write():
+                    self._send(using, model, actions)
+        except Exception:
+            # Put the changes back unless the objects changed again since
+            with self._lock:
+                for key, action in queue.items():
+                    self._queue.setdefault(key, action)
+            raise
+        return sum(len(actions) for actions in byModel.values())
+
+    def _send(self, using, model, actions):
+        try:
+            index = self.connections[using].get_unified_index() \
+                                           .get_index(model)
+        except NotHandled:
+            return
+        backend = self.connections[using].get_backend()
+        removed = [pk for pk, action in actions.items() if action == DELETE]
+        updated = [pk for pk, action in actions.items() if action == UPDATE]
+        for chunk in _chunks(updated, self.batch_size):
+            objs = list(index.index_queryset(using=using)
+                             .filter(pk__in=chunk))
+            if objs:
+                backend.update(index, objs)
+            # Objects that are no longer indexed, like unpublished decks,
+            # have to come out of the index
+            found = set(obj.pk for obj in objs)
+            removed.extend(pk for pk in chunk if pk not in found)
+        meta = model._meta
+        for pk in removed:
+            backend.remove('{0}.{1}.{2}'.format(meta.app_label,
+                                                meta.model_name,
+                                                pk))
+
+    def _start_worker(self):
+        if self._worker is not None:
+            return
+        with self._lock:
+            if self._worker is not None:
+                return
+            self._worker = threading.Thread(target=self._run,
+                                            name='notecards-indexing')
+            self._worker.daemon = True
+            self._worker.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not update the search index')
+            finally:
+                connection.close()
@@ -0,0 +1,106 @@
+import json
+import random
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+
+from notecards import benchmarking
+
+
+class Command(BaseCommand):
+    help = ('Seeds a data set and reports the latency, queries and memory '
+            'use of the busiest views. Writes to the database, so only run '
+            'it against a database set aside for benchmarking.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--decks', type=int, default=10000)
+        parser.add_argument('--cards', type=int, default=100000)
+        parser.add_argument('--requests',
+                            type=int,
+                            default=200,
+                            help='Timed requests per view.')
+        parser.add_argument('--warmup',
+                            type=int,
+                            default=10,
+                            help='Untimed requests per view made first.')
+        parser.add_argument('--views',
+                            nargs='+',
+                            choices=benchmarking.Benchmark.views,
+                            default=benchmarking.Benchmark.views)
+        parser.add_argument('--seed',
+                            type=int,
+                            default=0,
+                            help='Seed for the random choices, so runs can '
+                                 'be repeated.')
+        parser.add_argument('--json',
+                            help='Write the results as JSON to this file.')
+        parser.add_argument('--compare',
+                            help='JSON results of an earlier run to show '
+                                 'the changes against.')
+
+    def handle(self, *args, **options):
+        rand = random.Random(options['seed'])
+        baseline = {}
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f)['views']
+        if benchmarking.unseeded():
+            raise CommandError('The database holds data that was not '
+                               'seeded, only benchmark against an empty '
+                               'database set aside for it')
+        # The test client's host has to be allowed
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            if benchmarking.seeded():
+                self.stdout.write('Using the data set already seeded')
+            else:
+                try:
+                    benchmarking.seed(options['users'],
+                                      options['decks'],
+                                      options['cards'],
+                                      rand,
+                                      log=self._log(options))
+                except ValueError as e:
+                    raise CommandError(str(e))
+            benchmark = benchmarking.Benchmark(rand)
+            if not benchmark.drillable:
+                raise CommandError('The data set has no cards to drill')
+            results = {}
+            for view in options['views']:
+                results[view] = benchmark.run(view,
+                                              options['requests'],
+                                              options['warmup'])
+                self._report(view, results[view], baseline.get(view))
+
+        if options['json']:
+            with open(options['json'], 'w') as f:
+                json.dump({'django': django.get_version(),
+                           'data': {'users': len(benchmark.usernames),
+                                    'decks': len(benchmark.decks),
+                                    'cards': benchmark.cards},
+                           'views': results},
+                          f,
+                          indent=2,
+                          sort_keys=True)
+
+    def _log(self, options):
+        def log(message):
+            if options['verbosity'] > 1:
+                self.stdout.write(message)
+        return log
+
+    def _report(self, view, result, baseline):
+        self.stdout.write(
+            '{0}: p50 {1:.1f}ms, p95 {2:.1f}ms, p99 {3:.1f}ms, '
+            '{4:.1f} queries, {5} KiB peak, {6} error(s)'.format(
+                view, result['p50'], result['p95'], result['p99'],
+                result['queries']['mean'], result['peak_memory'] // 1024,
+                result['errors']))
+        if baseline:
+            changes = ', '.join(
+                '{0} {1:+.0%}'.format(key,
+                                      (result[key] - baseline[key]) /
+                                      baseline[key])
+                for key in ('p50', 'p95', 'p99') if baseline[key])
+            self.stdout.write('    compared to baseline: {0}'.format(changes))
@@ -0,0 +1,45 @@
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from notecards import cloning
+from notecards.models import Deck
+
+
+class Command(BaseCommand):
+    help = 'Clones a deck for each of the given users.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('deckid', type=int)
+        parser.add_argument('usernames', nargs='+')
+        parser.add_argument('--copy',
+                            action='store_true',
+                            help='Give each clone its own copy of the cards '
+                                 'instead of linking it to the deck.')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=cloning.CHUNK_SIZE,
+                            help='Number of cards copied per INSERT.')
+
+    def handle(self, *args, **options):
+        try:
+            deck = Deck.objects.get(pk=options['deckid'])
+        except Deck.DoesNotExist:
+            raise CommandError('Deck {0} does not exist'
+                               .format(options['deckid']))
+        users = User.objects.filter(username__in=options['usernames'])
+        found = set(user.username for user in users)
+        for username in options['usernames']:
+            if username not in found:
+                self.stderr.write('{0}: no such user'.format(username))
+        for user in users:
+            try:
+                newDeck = cloning.clone_deck(deck, user)
+            except ValidationError as e:
+                self.stderr.write('{0}: {1}'.format(user.username,
+                                                    ' '.join(e.messages)))
+                continue
+            if options['copy']:
+                cloning.materialize(newDeck, options['chunk_size'])
+            self.stdout.write('{0}: cloned as deck {1}'.format(user.username,
+                                                               newDeck.id))
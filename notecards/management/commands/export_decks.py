@@ -0,0 +1,55 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from notecards import exporting
+from notecards.models import Deck
+
+
+class Command(BaseCommand):
+    help = ('Exports decks to a file. A path ending in .zip gets an archive '
+            'with one file per deck, anything else a single deck.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('deckids', nargs='*', type=int)
+        parser.add_argument('--user',
+                            help='Export all of this user\'s decks.')
+        parser.add_argument('--format',
+                            choices=sorted(exporting.FORMATS),
+                            default='csv',
+                            help='Format of the exported decks.')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=exporting.CHUNK_SIZE,
+                            help='Number of cards read per query.')
+
+    def handle(self, *args, **options):
+        decks = Deck.objects.none()
+        if options['deckids']:
+            decks = Deck.objects.filter(pk__in=options['deckids'])
+        if options['user']:
+            try:
+                user = User.objects.get(username=options['user'])
+            except User.DoesNotExist:
+                raise CommandError('{0}: no such user'
+                                   .format(options['user']))
+            decks = decks | Deck.objects.filter(author=user)
+        decks = list(decks.order_by('id'))
+        if not decks:
+            raise CommandError('No decks to export')
+        if options['path'].endswith('.zip'):
+            chunks = exporting.archive(decks,
+                                       options['format'],
+                                       options['chunk_size'])
+        elif len(decks) == 1:
+            write = exporting.FORMATS[options['format']][0]
+            chunks = (chunk.encode()
+                      for chunk in write(decks[0].cards(),
+                                         options['chunk_size']))
+        else:
+            raise CommandError('Several decks can only be exported to a '
+                               '.zip archive')
+        with open(options['path'], 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk)
+        self.stdout.write('Exported {0} deck(s)'.format(len(decks)))
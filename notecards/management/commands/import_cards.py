@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from notecards import importing
+from notecards.models import Deck
+
+
+class Command(BaseCommand):
+    help = ('Adds the cards in a CSV or tab separated file, one card per '
+            'row, to a deck.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('deckid', type=int)
+        parser.add_argument('path')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=importing.CHUNK_SIZE,
+                            help='Number of cards inserted per transaction.')
+        parser.add_argument('--encoding',
+                            default='utf-8-sig',
+                            help='Encoding of the file.')
+
+    def handle(self, *args, **options):
+        try:
+            deck = Deck.objects.get(pk=options['deckid'])
+        except Deck.DoesNotExist:
+            raise CommandError('Deck {0} does not exist'
+                               .format(options['deckid']))
+        verbosity = options['verbosity']
+
+        def progress(imported):
+            if verbosity > 1:
+                self.stdout.write('Imported {0} card(s)'.format(imported))
+
+        try:
+            # The csv module handles the line endings itself
+            with open(options['path'],
+                      encoding=options['encoding'],
+                      newline='') as lines:
+                result = importing.import_cards(deck,
+                                                lines,
+                                                options['chunk_size'],
+                                                progress)
+        except IOError as e:
+            raise CommandError(str(e))
+        for lineNumber, message in result['errors']:
+            self.stderr.write('Line {0}: {1}'.format(lineNumber, message))
+        self.stdout.write('Imported {0} card(s), {1} row(s) failed'
+                          .format(result['imported'], result['failed']))
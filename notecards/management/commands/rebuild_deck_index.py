@@ -0,0 +1,64 @@
+import multiprocessing
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from haystack import connections as haystack_connections
+
+from notecards import indexing
+from notecards.models import Deck, IndexWatermark
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the search index for decks, splitting them into '
+            'chunks of primary keys that are indexed in parallel.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers',
+                            type=int,
+                            default=1,
+                            help='Number of processes indexing chunks.')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=500,
+                            help='Number of primary keys per chunk.')
+        parser.add_argument('--using',
+                            default='default',
+                            help='Search connection to rebuild.')
+        parser.add_argument('--noclear',
+                            action='store_true',
+                            help="Don't clear the index before rebuilding.")
+
+    def handle(self, *args, **options):
+        using = options['using']
+        started = timezone.now()
+        index = haystack_connections[using].get_unified_index().get_index(Deck)
+        decks = index.index_queryset(using=using)
+        total = decks.count()
+        chunks = [(using, start, end)
+                  for start, end in indexing.pk_ranges(decks,
+                                                       options['chunk_size'])]
+        if not options['noclear']:
+            haystack_connections[using].get_backend().clear(models=[Deck])
+
+        if options['workers'] > 1:
+            # Each worker opens its own database connection
+            connections.close_all()
+            pool = multiprocessing.Pool(options['workers'])
+            results = pool.imap_unordered(indexing.index_range, chunks)
+        else:
+            pool = None
+            results = (indexing.index_range(chunk) for chunk in chunks)
+
+        done = 0
+        for count in results:
+            done += count
+            self.stdout.write('Indexed {0} of {1} decks'.format(done, total))
+        if pool is not None:
+            pool.close()
+            pool.join()
+        # Incremental updates can carry on from here
+        IndexWatermark.objects.update_or_create(
+            using=using, defaults={'dateModified': started})
+        self.stdout.write('Indexed {0} deck(s)'.format(done))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from notecards.models import Deck
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored number of cards in each deck.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('deckids', nargs='*', type=int,
+                            help='Only repair these decks.')
+
+    def handle(self, *args, **options):
+        decks = Deck.objects.all()
+        if options['deckids']:
+            decks = decks.filter(pk__in=options['deckids'])
+        counts = decks.annotate(actual=Count('card')) \
+                      .values_list('id', 'card_count', 'actual') \
+                      .iterator()
+        repaired = 0
+        for deckid, stored, actual in counts:
+            if stored != actual:
+                Deck.objects.filter(pk=deckid).update(card_count=actual)
+                repaired += 1
+        self.stdout.write('Repaired {0} deck(s)'.format(repaired))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from notecards import tagging
+from notecards.models import TagCount
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored number of published decks with each tag.'
+
+    def handle(self, *args, **options):
+        tagging.rebuild_counts()
+        self.stdout.write('Counted {0} tag(s)'
+                          .format(TagCount.objects.count()))
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from notecards import indexing
+from notecards.models import Deck, DeletedDeck, IndexWatermark
+
+
+class Command(BaseCommand):
+    help = ('Updates the search index with the decks changed, unpublished '
+            'or deleted since the last update.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--using',
+                            default='default',
+                            help='Search connection to update.')
+        parser.add_argument('--chunk-size',
+                            type=int,
+                            default=indexing.BATCH_SIZE,
+                            help='Decks sent to the backend at once.')
+
+    def handle(self, *args, **options):
+        using = options['using']
+        started = timezone.now()
+        try:
+            watermark = IndexWatermark.objects.get(using=using)
+        except IndexWatermark.DoesNotExist:
+            raise CommandError('The {0} search index has never been built, '
+                               'run rebuild_deck_index first'.format(using))
+        since = watermark.dateModified - indexing.WATERMARK_OVERLAP
+
+        changed = Deck.objects.filter(dateModified__gt=since) \
+                              .values_list('id', flat=True)
+        deleted = DeletedDeck.objects.filter(dateDeleted__gt=since) \
+                                     .values_list('deck_id', flat=True)
+        updated, removed = indexing.update_decks(
+            using,
+            sorted(set(changed) | set(deleted)),
+            options['chunk_size'])
+
+        watermark.dateModified = started
+        watermark.save()
+        # Deletions every connection has caught up with can be forgotten
+        oldest = IndexWatermark.objects.aggregate(oldest=Min('dateModified'))
+        DeletedDeck.objects.filter(
+            dateDeleted__lt=oldest['oldest'] - indexing.WATERMARK_OVERLAP) \
+            .delete()
+        self.stdout.write('Updated {0} deck(s), removed {1} deck(s)'
+                          .format(updated, removed))
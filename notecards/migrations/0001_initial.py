@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+import taggit.managers
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('taggit', '0002_auto_20150616_2121'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Card',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('front', models.CharField(max_length=512)),
+                ('back', models.CharField(max_length=512)),
+                ('score', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Deck',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('title', models.CharField(max_length=256)),
+                ('slug', models.SlugField(max_length=256)),
+                ('description', models.TextField(blank=True)),
+                ('dateCreated', models.DateField(auto_now_add=True)),
+                ('dateModified', models.DateTimeField(auto_now=True)),
+                ('published', models.BooleanField(default=True)),
+                ('author', models.ForeignKey(to=settings.AUTH_USER_MODEL)),
+                ('tags', taggit.managers.TaggableManager(verbose_name='Tags', blank=True, help_text='A comma-separated list of tags.', through='taggit.TaggedItem', to='taggit.Tag')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='card',
+            name='deck',
+            field=models.ForeignKey(to='notecards.Deck'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='deck',
+            unique_together=set([('author', 'title')]),
+        ),
+    ]
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.conf import settings
+import notecards.models
+
+
+def count_cards(apps, schema_editor):
+    # Decks created before card_count existed start at 0
+    Deck = apps.get_model('notecards', 'Deck')
+    counts = Deck.objects.annotate(actual=models.Count('card')) \
+                         .values_list('id', 'actual') \
+                         .iterator()
+    for deckid, actual in counts:
+        if actual:
+            Deck.objects.filter(pk=deckid).update(card_count=actual)
+
+
+def count_tags(apps, schema_editor):
+    # Tag listings read TagCount, see notecards.tagging.rebuild_counts
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Deck = apps.get_model('notecards', 'Deck')
+    TagCount = apps.get_model('notecards', 'TagCount')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    contentType = ContentType.objects.filter(app_label='notecards',
+                                             model='deck').first()
+    if contentType is None:
+        return
+    tagged = TaggedItem.objects.filter(
+        content_type=contentType,
+        object_id__in=Deck.objects.filter(published=True).values('id'))
+    counts = tagged.values('tag').annotate(decks=models.Count('id'))
+    TagCount.objects.bulk_create(
+        [TagCount(tag_id=row['tag'], count=row['decks']) for row in counts])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('taggit', '0002_auto_20150616_2121'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('notecards', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CardProgress',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('score', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeckCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('count', models.IntegerField(default=0)),
+                ('user', models.OneToOneField(to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='DeletedDeck',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('deck_id', models.IntegerField()),
+                ('dateDeleted', models.DateTimeField(db_index=True, auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IndexWatermark',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('using', models.CharField(max_length=64, unique=True)),
+                ('dateModified', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Review',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('correct', models.BooleanField()),
+                ('dateAnswered', models.DateTimeField()),
+                ('responseTime', models.IntegerField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ScoreBucket',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('score', models.IntegerField()),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TagCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('count', models.IntegerField(db_index=True, default=0)),
+                ('tag', models.OneToOneField(related_name='deck_count', to='taggit.Tag')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='card',
+            name='origin',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='deck',
+            name='card_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='deck',
+            name='dateScored',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='deck',
+            name='score_version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='deck',
+            name='source',
+            field=models.ForeignKey(blank=True, null=True, related_name='linked_clones', on_delete=notecards.models.release_clones, to='notecards.Deck'),
+        ),
+        migrations.AddField(
+            model_name='deck',
+            name='version',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='card',
+            name='deck',
+            field=models.ForeignKey(on_delete=notecards.models.hand_over_cards, to='notecards.Deck'),
+        ),
+        migrations.AlterIndexTogether(
+            name='card',
+            index_together=set([('deck', 'score')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='deck',
+            index_together=set([('published', 'dateCreated', 'id'), ('author', 'dateCreated', 'id')]),
+        ),
+        migrations.AddField(
+            model_name='scorebucket',
+            name='deck',
+            field=models.ForeignKey(to='notecards.Deck'),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='card',
+            field=models.ForeignKey(to='notecards.Card'),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='deck',
+            field=models.ForeignKey(to='notecards.Deck'),
+        ),
+        migrations.AddField(
+            model_name='review',
+            name='user',
+            field=models.ForeignKey(to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='cardprogress',
+            name='card',
+            field=models.ForeignKey(to='notecards.Card'),
+        ),
+        migrations.AddField(
+            model_name='cardprogress',
+            name='deck',
+            field=models.ForeignKey(to='notecards.Deck'),
+        ),
+        migrations.AddField(
+            model_name='cardprogress',
+            name='user',
+            field=models.ForeignKey(to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='scorebucket',
+            unique_together=set([('deck', 'score')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='review',
+            index_together=set([('user', 'dateAnswered'), ('card', 'dateAnswered')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='cardprogress',
+            unique_together=set([('user', 'card')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='cardprogress',
+            index_together=set([('deck', 'score')]),
+        ),
+        migrations.RunPython(count_cards, migrations.RunPython.noop),
+        migrations.RunPython(count_tags, migrations.RunPython.noop),
+    ]
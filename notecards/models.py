@@ -1,10 +1,74 @@
-from django.db import models
+import threading
+from contextlib import contextmanager
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from django.template.defaultfilters import slugify
+from django.utils import timezone
 from django.core import urlresolvers
 from django.core.exceptions import ValidationError
 
 from taggit.managers import TaggableManager
+from taggit.models import Tag
+
+
+# Most decks a single user can own
+MAX_DECKS = 100
+
+_local = threading.local()
+
+
+def _held():
+    # Ids of the decks whose touches the current thread is holding
+    if not hasattr(_local, 'decks'):
+        _local.decks = set()
+    return _local.decks
+
+
+def _hand_over_collected(collector):
+    # Hands the cards of every deck the collector is deleting over to a
+    # linked clone that isn't being deleted, once per deck. Returns the
+    # ids of the decks whose cards were handed over.
+    from notecards import cloning
+    deleting = dict((deck.pk, deck) for deck in collector.data.get(Deck, ()))
+    checked = collector.__dict__.setdefault('checkedClones', set())
+    handedOver = collector.__dict__.setdefault('handedOver', set())
+    unchecked = set(deleting) - checked
+    if unchecked:
+        checked.update(unchecked)
+        cloned = set(Deck.objects.filter(source__in=unchecked)
+                                 .values_list('source_id', flat=True))
+        for deckId in cloned:
+            if cloning.hand_over(deleting[deckId], exclude=deleting):
+                handedOver.add(deckId)
+    return handedOver
+
+
+def hand_over_cards(collector, field, sub_objs, using):
+    '''
+    Deletes the cards of deleted decks, except for decks with linked
+    clones, whose cards are handed over to one of the clones first (see
+    notecards.cloning). As the on_delete of Card.deck it runs however the
+    deck is deleted, while the objects to delete are still being
+    collected.
+    '''
+    handedOver = _hand_over_collected(collector)
+    # sub_objs was read before the cards were handed over
+    models.CASCADE(collector, field,
+                   [card for card in sub_objs
+                    if card.deck_id not in handedOver], using)
+
+
+def release_clones(collector, field, sub_objs, using):
+    '''
+    Unlinks the linked clones of deleted decks once the cards have been
+    handed over, which leaves only clones that are being deleted too.
+    '''
+    handedOver = _hand_over_collected(collector)
+    # Clones of decks whose cards were handed over now link to the heir
+    models.SET_NULL(collector, field,
+                    [clone for clone in sub_objs
+                     if clone.source_id not in handedOver], using)
 
 
 class Deck(models.Model):
@@ -16,33 +80,287 @@ class Deck(models.Model):
     dateCreated = models.DateField(auto_now_add=True)
     dateModified = models.DateTimeField(auto_now=True)
     published = models.BooleanField(default=True)
+    # Decks cloned from another deck share its cards until the new owner
+    # edits them, at which point the cards are copied, or the source deck
+    # is deleted and hands them over (see notecards.cloning). The owner's
+    # scores are kept in CardProgress.
+    source = models.ForeignKey('self',
+                               null=True,
+                               blank=True,
+                               related_name='linked_clones',
+                               on_delete=release_clones)
+    # Number of cards that belong to the deck, kept up to date as cards
+    # are added and removed (see notecards.signals) and by the code that
+    # creates cards in bulk. Use numCards to include a source deck's cards.
+    card_count = models.IntegerField(default=0)
+    # Bumped whenever the deck, its tags or any of its cards change. Cached
+    # pages showing the deck are keyed by it, see notecards.caching
+    version = models.IntegerField(default=0)
+    # Bumped whenever the owner's scores change. Scores aren't part of what
+    # the deck shows others, so they leave the version alone
+    score_version = models.IntegerField(default=0)
+    # When the owner's scores last changed
+    dateScored = models.DateTimeField(null=True, blank=True)
+
+    # Counters are only ever changed with UPDATE ... F(), and the time the
+    # scores changed along with them, so that saving a deck can't
+    # overwrite changes made since it was loaded
+    counters = ('card_count', 'version', 'score_version', 'dateScored')
 
     class Meta:
         unique_together = ('author', 'title')
+        # Deck listings are paged by (dateCreated, id), see
+        # notecards.pagination
+        index_together = [('published', 'dateCreated', 'id'),
+                          ('author', 'dateCreated', 'id')]
 
     def get_absolute_url(self):
         return "{0}?did={1}".format(urlresolvers.reverse('view_deck'),
                                     self.id)
 
+    @property
+    def content_id(self):
+        '''Id of the deck whose cards this deck shows.'''
+        return self.source_id or self.id
+
+    def cards(self):
+        '''Returns the cards shown in this deck.'''
+        return Card.objects.filter(deck_id=self.content_id)
+
     @property
     def numCards(self):
-        return self.card_set.count()
+        if self.source_id:
+            return self.source.card_count
+        return self.card_count
+
+    def touch(self, added=0):
+        '''
+        Records a change to the deck or its cards, with `added` cards added
+        to (or removed from) the deck.
+        '''
+        now = timezone.now()
+        Deck.objects.filter(pk=self.pk) \
+                    .update(card_count=models.F('card_count') + added,
+                            version=models.F('version') + 1,
+                            dateModified=now)
+        self.card_count += added
+        self.version += 1
+        self.dateModified = now
+
+    @staticmethod
+    @contextmanager
+    def held_touches(deckId):
+        '''
+        Stops changes to the deck's tags and cards from touching it until
+        the block exits, even if it raises.
+        '''
+        held = _held()
+        # Nested holds leave the deck held until the outermost one exits
+        outer = deckId not in held
+        held.add(deckId)
+        try:
+            yield
+        finally:
+            if outer:
+                held.discard(deckId)
+
+    @staticmethod
+    def touches_held(deckId):
+        '''Returns True if tag and card changes shouldn't touch the deck.'''
+        return deckId in _held()
+
+    def touch_scores(self):
+        '''Records a change to the owner's scores.'''
+        now = timezone.now()
+        Deck.objects.filter(pk=self.pk) \
+                    .update(score_version=models.F('score_version') + 1,
+                            dateScored=now)
+        self.score_version += 1
+        self.dateScored = now
 
     def __repr__(self):
         return self.title
 
+    def delete(self, *args, **kwargs):
+        # Handing the cards over to a linked clone (see hand_over_cards)
+        # happens together with the delete. Deleting the deck's tags and
+        # cards has no need to touch it.
+        with transaction.atomic(), Deck.held_touches(self.id):
+            super(Deck, self).delete(*args, **kwargs)
+
     def save(self, *args, **kwargs):
-        if Deck.objects.filter(author=self.author).count() >= 100:
-            raise ValidationError('User cannot have more than 100 decks')
         self.slug = slugify(self.title)
-        super(Deck, self).save(*args, **kwargs)
+        if self._state.adding:
+            # The deck limit only needs checking when a deck is created.
+            # Taking a slot and inserting the deck happen together so a
+            # failed insert gives the slot back.
+            with transaction.atomic():
+                DeckCounter.take_slot(self.author)
+                super(Deck, self).save(*args, **kwargs)
+            return
+        if 'update_fields' not in kwargs:
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.counters]
+        # The version is bumped in the same UPDATE
+        kwargs['update_fields'] = list(kwargs['update_fields']) + ['version']
+        version = self.version
+        self.version = models.F('version') + 1
+        try:
+            super(Deck, self).save(*args, **kwargs)
+        finally:
+            self.version = version
+        self.version += 1
 
 
 class Card(models.Model):
     front = models.CharField(max_length=512)
     back = models.CharField(max_length=512)
-    deck = models.ForeignKey(Deck)
+    deck = models.ForeignKey(Deck, on_delete=hand_over_cards)
     score = models.IntegerField(default=0)
+    # Id of the card this one was copied from when a linked clone got
+    # cards of its own, see notecards.cloning
+    origin = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        # Drawing cards looks them up by score within a deck
+        index_together = [('deck', 'score')]
 
     def __repr__(self):
         return self.front + ' - ' + self.back
+
+
+class ScoreBucket(models.Model):
+    '''
+    Histogram of card scores within a deck. Each row holds the number of
+    cards in the deck that currently have the given score, which lets a
+    card be drawn without loading the deck. For linked clones it counts
+    the owner's CardProgress rows instead.
+    '''
+    deck = models.ForeignKey(Deck)
+    score = models.IntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('deck', 'score')
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.score, self.count)
+
+
+class CardProgress(models.Model):
+    '''
+    A user's score for a card they drill through a linked clone. Rows are
+    only created once the user has answered the card, unanswered cards
+    count as having a score of 0.
+    '''
+    user = models.ForeignKey(User)
+    # The user's linked clone, the card belongs to its source deck
+    deck = models.ForeignKey(Deck)
+    card = models.ForeignKey(Card)
+    score = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user', 'card')
+        index_together = [('deck', 'score')]
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.card_id, self.score)
+
+
+class Review(models.Model):
+    '''
+    One answer a user gave while drilling. Rows are only ever added, in
+    batches, by grading (see notecards.reviewing), and make up the history
+    that a card's score summarizes.
+    '''
+    user = models.ForeignKey(User)
+    # The deck drilled, which for linked clones isn't the card's deck
+    deck = models.ForeignKey(Deck)
+    card = models.ForeignKey(Card)
+    correct = models.BooleanField()
+    dateAnswered = models.DateTimeField()
+    # Milliseconds from the card being shown to the answer, if known
+    responseTime = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('user', 'dateAnswered'),
+                          ('card', 'dateAnswered')]
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.card_id, self.correct)
+
+
+class DeckCounter(models.Model):
+    '''
+    Number of decks a user owns, used to enforce MAX_DECKS without
+    counting the user's decks every time one is created.
+    '''
+    user = models.OneToOneField(User)
+    count = models.IntegerField(default=0)
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.user_id, self.count)
+
+    @classmethod
+    def take_slot(cls, user):
+        '''
+        Counts a new deck for the user.
+        Raises ValidationError if the user already has MAX_DECKS decks.
+        '''
+        # A single conditional UPDATE both checks and takes the slot, so
+        # concurrent creates can't push a user over the limit
+        slots = cls.objects.filter(user=user, count__lt=MAX_DECKS)
+        if slots.update(count=models.F('count') + 1):
+            return
+        # Counters are created the first time a user makes a deck, starting
+        # from however many decks they already have
+        cls.objects.get_or_create(
+            user=user,
+            defaults={'count': Deck.objects.filter(author=user).count()})
+        if not slots.update(count=models.F('count') + 1):
+            raise ValidationError('User cannot have more than {0} decks'
+                                  .format(MAX_DECKS))
+
+    @classmethod
+    def free_slot(cls, user_id):
+        '''Stops counting one of the user's decks.'''
+        cls.objects.filter(user_id=user_id) \
+                   .update(count=models.F('count') - 1)
+
+
+class IndexWatermark(models.Model):
+    '''
+    Newest Deck.dateModified a search connection has been brought up to
+    date with, so update_deck_index only looks at decks changed since.
+    '''
+    using = models.CharField(max_length=64, unique=True)
+    dateModified = models.DateTimeField()
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.using, self.dateModified)
+
+
+class DeletedDeck(models.Model):
+    '''
+    A deleted deck, remembered until every search connection has caught up
+    with the deletion.
+    '''
+    deck_id = models.IntegerField()
+    dateDeleted = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.deck_id, self.dateDeleted)
+
+
+class TagCount(models.Model):
+    '''
+    Number of published decks with a tag, kept up to date as decks are
+    tagged, published and deleted (see notecards.tagging) so tags can be
+    browsed without counting them.
+    '''
+    tag = models.OneToOneField(Tag, related_name='deck_count')
+    count = models.IntegerField(default=0, db_index=True)
+
+    def __repr__(self):
+        return '{0}: {1}'.format(self.tag_id, self.count)
@@ -0,0 +1,77 @@
+'''
+Keyset pagination for deck listings.
+
+Decks are listed newest first, ordered by (dateCreated, id) so that decks
+created on the same day keep a stable order. Instead of page numbers the
+listings hand out opaque cursors naming the first or last deck shown, and
+the next page is fetched with a range query on the listing's index that
+costs the same however deep the user goes.
+'''
+import base64
+import datetime
+
+from django.db.models import Q
+
+
+PAGE_SIZE = 50
+# Largest id a deck can have, the most an AutoField holds on every
+# database
+MAX_ID = 2 ** 31 - 1
+
+
+def encode_cursor(deck):
+    '''Returns an opaque cursor pointing at the deck.'''
+    key = '{0}:{1}'.format(deck.dateCreated.isoformat(), deck.id)
+    return base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    '''
+    Returns the (dateCreated, id) pair a cursor points at.
+    Raises ValueError if the cursor is not valid.
+    '''
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        key = base64.urlsafe_b64decode((cursor + padding).encode()).decode()
+        date, deckid = key.split(':')
+        date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+        deckid = int(deckid)
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ValueError('Invalid cursor')
+    # Cursors come from the client, and ids the database can't hold make
+    # it raise rather than find nothing
+    if not 0 <= deckid <= MAX_ID:
+        raise ValueError('Invalid cursor')
+    return date, deckid
+
+
+def page_decks(decks, after=None, before=None, size=PAGE_SIZE):
+    '''
+    Returns one page of a deck queryset as a (decks, next, prev) tuple.
+    `after` and `before` are cursors from earlier pages; with neither the
+    first page is returned. `next` and `prev` are the cursors for the
+    neighbouring pages, or None where there are no more decks.
+    Raises ValueError if a cursor is not valid.
+    '''
+    if before:
+        date, deckid = decode_cursor(before)
+        # Walk backwards from the cursor and flip the page round after
+        page = list(decks.filter(Q(dateCreated__gt=date) |
+                                 Q(dateCreated=date, id__gt=deckid))
+                         .order_by('dateCreated', 'id')[:size + 1])
+        more = len(page) > size
+        page = page[:size][::-1]
+        prev = encode_cursor(page[0]) if more else None
+        nxt = encode_cursor(page[-1]) if page else None
+        return page, nxt, prev
+
+    if after:
+        date, deckid = decode_cursor(after)
+        decks = decks.filter(Q(dateCreated__lt=date) |
+                             Q(dateCreated=date, id__lt=deckid))
+    page = list(decks.order_by('-dateCreated', '-id')[:size + 1])
+    more = len(page) > size
+    page = page[:size]
+    nxt = encode_cursor(page[-1]) if more else None
+    prev = encode_cursor(page[0]) if after and page else None
+    return page, nxt, prev
@@ -0,0 +1,192 @@
+'''
+Logging drill answers with write-behind buffering.
+
+Every answer given on the drill page is logged as a Review, an append-only
+history of who answered which card, when, how quickly and whether they got
+it right. Rather than writing each answer as it's given, check_answer
+only reads whether the answer is right and queues it. The queue is graded
+every NOTECARDS_REVIEW_INTERVAL seconds, or sooner once
+NOTECARDS_REVIEW_BATCH answers are waiting, with one grading batch per
+deck: the scores and the reviews are written together, from the same
+answers, in a few statements (see notecards.grading).
+
+Scores lag behind the answers by up to the interval, which the drill page
+doesn't notice since it only uses them to choose cards. The queue lives in
+memory, so answers queued by a process that dies before flushing are lost.
+A deck's answers that can't be graded are retried a few times before
+they're logged and dropped, and the oldest answers are dropped if the
+queue grows past MAX_QUEUED, so a failing database can't exhaust memory.
+'''
+import atexit
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
+from notecards import grading
+from notecards.models import Deck
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between flushes of the queue
+FLUSH_INTERVAL = 5
+# Most answers waiting before the queue is flushed early
+BATCH_SIZE = 500
+# Most answers kept waiting, the oldest are dropped beyond it
+MAX_QUEUED = 50000
+# Flushes a deck's answers are tried in before they're dropped
+MAX_ATTEMPTS = 3
+
+
+class ReviewBuffer(object):
+    '''
+    Queues answers and grades them every NOTECARDS_REVIEW_INTERVAL
+    seconds, or sooner once NOTECARDS_REVIEW_BATCH answers are waiting.
+    With an interval of 0 answers are graded as they're queued, and with
+    None nothing is graded until flush() is called.
+    '''
+
+    def __init__(self):
+        # (deckid, cardid, answer, userid, dateAnswered, responseTime)
+        self._queue = []
+        # Maps deck ids to the number of flushes their answers failed in
+        self._failures = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+        # Process the worker was started in, forked processes start their
+        # own
+        self._pid = None
+
+    @property
+    def interval(self):
+        return getattr(settings, 'NOTECARDS_REVIEW_INTERVAL', FLUSH_INTERVAL)
+
+    @property
+    def batch_size(self):
+        return getattr(settings, 'NOTECARDS_REVIEW_BATCH', BATCH_SIZE)
+
+    def enqueue(self, deck, userid, cardid, answer, responseTime=None,
+                dateAnswered=None):
+        '''Queues a user's answer for a card in the deck.'''
+        dateAnswered = dateAnswered or timezone.now()
+        if self.interval == 0:
+            grading.sync_answers(deck, [(cardid, answer)],
+                                 [(userid, dateAnswered, responseTime)])
+            return
+        with self._lock:
+            self._queue.append((deck.id, cardid, answer, userid,
+                                dateAnswered, responseTime))
+            self._trim()
+            full = len(self._queue) >= self.batch_size
+        if self.interval is None:
+            return
+        self._start_worker()
+        if full:
+            self._wake.set()
+
+    def pending(self):
+        '''Returns the queued (deckid, cardid, answer) triples.'''
+        with self._lock:
+            return [entry[:3] for entry in self._queue]
+
+    def _trim(self):
+        # Called with the lock held
+        dropped = len(self._queue) - MAX_QUEUED
+        if dropped > 0:
+            del self._queue[:dropped]
+            logger.error('Dropped %d queued answer(s), the queue is full',
+                         dropped)
+
+    def flush(self):
+        '''
+        Grades and logs everything queued, in the order it was queued.
+        Answers for decks that have since been deleted are dropped, and a
+        deck's answers that fail MAX_ATTEMPTS flushes in a row are logged
+        and dropped. Answers that failed fewer times are queued again.
+        Returns the number of answers graded.
+        '''
+        with self._lock:
+            queue, self._queue = self._queue, []
+        byDeck = OrderedDict()
+        for entry in queue:
+            byDeck.setdefault(entry[0], []).append(entry)
+        flushed = 0
+        failed = []
+        try:
+            decks = Deck.objects.in_bulk(list(byDeck))
+        except Exception:
+            logger.exception('Could not load the decks of queued answers')
+            decks = None
+        for deckid, entries in byDeck.items():
+            if decks is None:
+                failed.append((deckid, entries))
+                continue
+            if deckid not in decks:
+                continue
+            try:
+                grading.sync_answers(decks[deckid],
+                                     [entry[1:3] for entry in entries],
+                                     [entry[3:] for entry in entries])
+            except Exception:
+                logger.exception('Could not grade %d answer(s) for deck %s',
+                                 len(entries), deckid)
+                failed.append((deckid, entries))
+                continue
+            flushed += len(entries)
+        with self._lock:
+            retried = []
+            failedIds = set(deckid for deckid, entries in failed)
+            for deckid in byDeck:
+                if deckid not in failedIds:
+                    self._failures.pop(deckid, None)
+            for deckid, entries in failed:
+                attempts = self._failures.get(deckid, 0) + 1
+                if attempts >= MAX_ATTEMPTS:
+                    logger.error('Dropped %d answer(s) for deck %s after %d '
+                                 'failed flushes', len(entries), deckid,
+                                 attempts)
+                    self._failures.pop(deckid, None)
+                else:
+                    self._failures[deckid] = attempts
+                    retried.extend(entries)
+            # Ahead of anything queued since
+            self._queue[:0] = retried
+            self._trim()
+        return flushed
+
+    def _start_worker(self):
+        pid = os.getpid()
+        if self._worker is not None and self._pid == pid:
+            return
+        with self._lock:
+            if self._worker is not None and self._pid == pid:
+                return
+            # A forked process inherits the parent's worker object but not
+            # its thread
+            self._pid = pid
+            self._wake = threading.Event()
+            self._worker = threading.Thread(target=self._run,
+                                            name='notecards-reviewing')
+            self._worker.daemon = True
+            self._worker.start()
+        atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not log drill answers')
+            finally:
+                connection.close()
+
+
+buffered = ReviewBuffer()
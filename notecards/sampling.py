@@ -0,0 +1,229 @@
+'''
+Weighted card selection for drill mode.
+
+Every deck keeps a small score histogram (ScoreBucket rows) alongside its
+cards. Drawing a card reads the histogram, picks a score the same way the
+drill has always done (a random score between the weakest and strongest
+card, then any card at or below it) and fetches exactly one card from the
+chosen bucket through the (deck, score) index on Card. Hard mode draws
+evenly from the buckets at or below the weakness threshold instead. The
+cost is a fixed number of small queries no matter how many cards the deck
+holds.
+
+Within a bucket the card is picked by its position in id order, so every
+card in the bucket is equally likely whatever its id. The database walks
+the (deck, score) index up to that position, which stays cheap since a
+bucket only holds the cards of one score.
+
+Linked clones draw from their source deck's cards, using the owner's
+CardProgress scores. Cards the owner has never answered have no progress
+row and sit at score 0.
+'''
+import random
+from collections import Counter
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from notecards.models import Card, CardProgress, Deck, ScoreBucket
+
+
+def update_buckets(deck, changes):
+    '''
+    Applies score changes to a deck's histogram. `changes` maps a score to
+    the number of cards gained (positive) or lost (negative) at that score.
+    Decks without a histogram are left alone, one is built from scratch
+    the first time a card is drawn.
+    '''
+    for score, delta in changes.items():
+        if delta == 0:
+            continue
+        updated = ScoreBucket.objects.filter(deck=deck, score=score) \
+                                     .update(count=F('count') + delta)
+        if not updated:
+            if not ScoreBucket.objects.filter(deck=deck).exists():
+                return
+            try:
+                with transaction.atomic():
+                    ScoreBucket.objects.create(deck=deck,
+                                               score=score,
+                                               count=delta)
+            except IntegrityError:
+                # Someone else created the bucket in the meantime
+                ScoreBucket.objects.filter(deck=deck, score=score) \
+                                   .update(count=F('count') + delta)
+
+
+def add_cards(deck, scores):
+    '''Records newly created cards with the given scores.'''
+    update_buckets(deck, Counter(scores))
+
+
+def remove_cards(deck, scores):
+    '''Records the removal of cards with the given scores.'''
+    changes = Counter()
+    for score in scores:
+        changes[score] -= 1
+    update_buckets(deck, changes)
+
+
+def rebuild_buckets(deck):
+    '''
+    Recomputes a deck's histogram from its cards, or from the owner's
+    progress for a linked clone. Used for decks that predate the histogram
+    and to repair one that has drifted.
+    '''
+    if deck.source_id:
+        scored = CardProgress.objects.filter(deck=deck)
+    else:
+        scored = Card.objects.filter(deck=deck)
+    counts = dict(scored.values_list('score')
+                        .annotate(num=Count('id'))
+                        .order_by())
+    # An empty bucket at 0 marks the histogram as present even when the
+    # deck has no cards yet
+    counts.setdefault(0, 0)
+    with transaction.atomic():
+        ScoreBucket.objects.filter(deck=deck).delete()
+        ScoreBucket.objects.bulk_create(
+            [ScoreBucket(deck=deck, score=score, count=num)
+             for score, num in counts.items()])
+
+
+def _histogram(deck, maxScore=None):
+    # Returns the (score, count) pairs for the non-empty buckets at or
+    # below maxScore, ordered by score, and the number of cards a linked
+    # clone's owner has never answered, which count towards score 0.
+    # Returns None for the histogram if the deck doesn't have one.
+    buckets = list(ScoreBucket.objects.filter(deck=deck)
+                                      .order_by('score')
+                                      .values_list('score', 'count'))
+    if not buckets:
+        return None, 0
+    unseen = 0
+    if deck.source_id:
+        total = Deck.objects.filter(pk=deck.source_id) \
+                            .values_list('card_count', flat=True)[0]
+        unseen = max(0, total - sum(count for score, count in buckets))
+        buckets = [(score, count + unseen if score == 0 else count)
+                   for score, count in buckets]
+    histogram = [(score, count) for score, count in buckets
+                 if count > 0 and (maxScore is None or score <= maxScore)]
+    return histogram, unseen
+
+
+def _card_at(deck, score, count, rindex, unseen):
+    # Fetches the card at position rindex among the deck's cards with the
+    # given score through the (deck, score) indexes
+    if not deck.source_id:
+        return Card.objects.filter(deck=deck, score=score) \
+                           .order_by('id')[rindex]
+    # A linked clone's answered cards come first, then for score 0 the
+    # cards its owner has never answered
+    answered = count - unseen if score == 0 else count
+    if rindex < answered:
+        progress = CardProgress.objects.filter(deck=deck, score=score) \
+                                       .select_related('card') \
+                                       .order_by('card')[rindex]
+        card = progress.card
+    else:
+        seen = CardProgress.objects.filter(deck=deck).values('card_id')
+        card = Card.objects.filter(deck_id=deck.source_id) \
+                           .exclude(id__in=seen) \
+                           .order_by('id')[rindex - answered]
+    # Show the owner's score rather than the source deck's
+    card.score = score
+    return card
+
+
+def _has_cards(deck, maxScore):
+    # Whether the deck really has cards at or below maxScore, for when
+    # its histogram says it doesn't. A linked clone's unanswered cards are
+    # counted from the source deck, so only its progress can be missing.
+    if deck.source_id:
+        scored = CardProgress.objects.filter(deck=deck)
+    else:
+        scored = Card.objects.filter(deck=deck)
+    if maxScore is not None:
+        scored = scored.filter(score__lte=maxScore)
+    return scored.exists()
+
+
+def _pick(deck, eligible, unseen):
+    # Every card in the eligible buckets is equally likely, so pick a
+    # position across them and find the bucket it lands in
+    rindex = random.randrange(sum(count for score, count in eligible))
+    for score, count in eligible:
+        if rindex < count:
+            break
+        rindex -= count
+    try:
+        return _card_at(deck, score, count, rindex, unseen)
+    except IndexError:
+        # The bucket holds fewer cards than the histogram says
+        return None
+
+
+def _draw(deck, histogram, unseen, weighted):
+    if weighted:
+        # Randomly select a score to draw from, biasing towards weaker
+        # cards
+        rscore = random.randint(histogram[0][0], histogram[-1][0])
+        histogram = [(score, count) for score, count in histogram
+                     if score <= rscore]
+    return _pick(deck, histogram, unseen)
+
+
+def draw_card(deck, maxScore=None):
+    '''
+    Returns a random card from the deck, or None if the deck has no
+    suitable cards.
+    With no maxScore the draw is biased towards weaker cards. With a
+    maxScore every card scoring at or below it is equally likely, which is
+    what hard mode uses.
+    '''
+    weighted = maxScore is None
+    histogram, unseen = _histogram(deck, maxScore)
+    if histogram:
+        card = _draw(deck, histogram, unseen, weighted)
+        if card is not None:
+            return card
+    elif histogram is not None and not _has_cards(deck, maxScore):
+        # The histogram is right, there just aren't any suitable cards
+        return None
+    # The histogram is missing or out of date, so rebuild it and try again
+    rebuild_buckets(deck)
+    histogram, unseen = _histogram(deck, maxScore)
+    if not histogram:
+        return None
+    return _draw(deck, histogram, unseen, weighted)
+
+
+def draw_cards(deck, num, maxScore=None):
+    '''
+    Returns a list of up to `num` cards drawn the same way as draw_card.
+    The histogram is read once for the whole batch, so this costs one
+    query per card plus a few more.
+    '''
+    weighted = maxScore is None
+    histogram, unseen = _histogram(deck, maxScore)
+    cards = []
+    while len(cards) < num:
+        card = None
+        if histogram:
+            card = _draw(deck, histogram, unseen, weighted)
+        if card is None:
+            # The histogram is missing or has drifted, so let draw_card
+            # repair it before carrying on
+            card = draw_card(deck, maxScore)
+            if card is None:
+                break
+            histogram, unseen = _histogram(deck, maxScore)
+        cards.append(card)
+    return cards
+
+
+def weak_score():
+    '''Highest score a card can have and still be drawn in hard mode.'''
+    return getattr(settings, 'NOTECARDS_WEAK_SCORE', 3)
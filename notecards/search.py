@@ -0,0 +1,60 @@
+'''
+Searching published decks.
+
+Decks are indexed along with the text of their cards (see CardIndex), so
+searching for a word on a card finds the deck. Each result shows the
+deck's cards that match the query, looking only through the cards that
+were indexed so huge decks aren't scanned for every result.
+'''
+import operator
+from functools import reduce
+
+from django.db.models import Q
+
+from haystack.views import SearchView, search_view_factory
+
+from notecards.search_indexes import indexed_cards
+
+
+# Most matching cards shown with each result
+MATCHING_CARDS = 3
+
+
+def matching_cards(deck, query, limit=MATCHING_CARDS):
+    '''
+    Returns up to `limit` of the deck's indexed cards containing any of
+    the words in the query. Excluded words (starting with '-') are
+    ignored.
+    '''
+    words = [word.strip('"') for word in query.split()
+             if not word.startswith('-')]
+    words = [word for word in words if word]
+    if not words:
+        return []
+    match = reduce(operator.or_, (Q(front__icontains=word) |
+                                  Q(back__icontains=word)
+                                  for word in words))
+    cards = deck.cards()
+    indexed = indexed_cards()
+    if deck.source_id or deck.card_count > indexed:
+        # Bound the scan by the id of the last card indexed
+        last = list(cards.order_by('id')
+                         .values_list('id', flat=True)[indexed - 1:indexed])
+        if last:
+            cards = cards.filter(id__lte=last[0])
+    return list(cards.filter(match).order_by('id')[:limit])
+
+
+class DeckSearchView(SearchView):
+    '''Haystack's search view, showing the cards that match in each deck.'''
+
+    def build_page(self):
+        paginator, page = super(DeckSearchView, self).build_page()
+        # One or two queries per result on the page
+        for result in page.object_list:
+            deck = result.object
+            result.cards = matching_cards(deck, self.query) if deck else []
+        return paginator, page
+
+
+deck_search = search_view_factory(view_class=DeckSearchView)
@@ -1,7 +1,19 @@
 import datetime
 
+from django.conf import settings
+from django.db.models import Prefetch
+
 from haystack import indexes
-from notecards.models import Deck
+from notecards.models import Card, Deck
+
+
+# Most cards whose text is indexed with each deck
+MAX_INDEXED_CARDS = 1000
+
+
+def indexed_cards():
+    '''Returns the most cards whose text is indexed with a deck.'''
+    return getattr(settings, 'NOTECARDS_INDEX_CARDS', MAX_INDEXED_CARDS)
 
 
 class CardIndex(indexes.SearchIndex, indexes.Indexable):
@@ -13,9 +25,34 @@ class CardIndex(indexes.SearchIndex, indexes.Indexable):
 
     def index_queryset(self, using=None):
         """Used when the entire index for model is updated."""
+        # The document shows each deck's author, tags and card text. Cards
+        # are only prefetched for decks small enough to index whole.
+        cards = Card.objects.filter(deck__card_count__lte=indexed_cards()) \
+                            .only('deck', 'front', 'back') \
+                            .order_by('id')
         return self.get_model().objects.filter(
             dateCreated__lte=datetime.datetime.now()).filter(
-            published=True)
+            published=True).select_related('author', 'source') \
+            .prefetch_related('tags',
+                              Prefetch('card_set', queryset=cards),
+                              Prefetch('source__card_set', queryset=cards))
 
     def prepare_tags(self, obj):
         return [tag.name for tag in obj.tags.all()]
+
+    def prepare_text(self, obj):
+        # Card text goes in the document so searching for a word on a card
+        # finds its deck
+        cards = '\n'.join('{0} {1}'.format(front, back)
+                          for front, back in self._card_text(obj))
+        return self.prepared_data['text'] + '\n' + cards
+
+    def _card_text(self, obj):
+        # Linked clones show their source deck's cards
+        deck = obj.source if obj.source_id else obj
+        limit = indexed_cards()
+        if deck.card_count > limit:
+            # Only the first cards of huge decks are indexed
+            return deck.card_set.order_by('id') \
+                                .values_list('front', 'back')[:limit]
+        return [(card.front, card.back) for card in deck.card_set.all()]
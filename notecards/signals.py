@@ -0,0 +1,76 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from taggit.models import Tag, TaggedItem
+
+from notecards import tagging, typeahead
+from notecards.models import Card, Deck, DeckCounter, DeletedDeck
+
+
+@receiver(pre_delete, sender=Deck)
+def uncount_tags(sender, instance, **kwargs):
+    '''
+    Takes the deck out of the per tag deck counts. Its tags are deleted
+    along with it, with touches held by Deck.delete.
+    '''
+    tagging.uncount(instance)
+
+
+@receiver(post_delete, sender=Deck)
+def free_deck_slot(sender, instance, **kwargs):
+    '''Gives the deck's slot back to its author.'''
+    DeckCounter.free_slot(instance.author_id)
+
+
+@receiver(post_save, sender=Card)
+def count_saved_card(sender, instance, created, **kwargs):
+    '''Counts a new card in its deck. Any change to a card touches it.'''
+    instance.deck.touch(1 if created else 0)
+
+
+@receiver(post_delete, sender=Card)
+def uncount_deleted_card(sender, instance, **kwargs):
+    '''
+    Stops counting a deleted card, however it was deleted. Cards deleted
+    along with their deck are left alone, see Deck.delete.
+    '''
+    if not Deck.touches_held(instance.deck_id):
+        instance.deck.touch(-1)
+
+
+@receiver(post_delete, sender=Deck)
+def remember_deleted_deck(sender, instance, **kwargs):
+    '''
+    Leaves a record of the deletion for incremental search index updates,
+    which only see decks that still exist.
+    '''
+    DeletedDeck.objects.create(deck_id=instance.id)
+
+
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def touch_tagged_deck(sender, instance, **kwargs):
+    '''
+    Deck pages and listings show the deck's tags, so tagging a deck counts
+    as a change to it.
+    '''
+    if instance.content_type_id != ContentType.objects.get_for_model(Deck).id:
+        return
+    if not Deck.touches_held(instance.object_id):
+        Deck.objects.filter(pk=instance.object_id) \
+                    .update(version=F('version') + 1,
+                            dateModified=timezone.now())
+
+
+@receiver(post_save, sender=Deck)
+@receiver(post_delete, sender=Deck)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=TaggedItem)
+def refresh_suggestions(sender, instance, **kwargs):
+    '''Search box suggestions are built from deck titles and tags.'''
+    typeahead.invalidate()
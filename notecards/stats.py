@@ -0,0 +1,248 @@
+'''
+Per-view request statistics.
+
+StatsMiddleware records the number of queries, time spent in SQL, time
+spent rendering templates, total time and response size of every request
+into a ring buffer that holds the last NOTECARDS_STATS_SIZE requests of
+each process. Summaries per view, with latency histograms over the
+requests in the buffer, are served as JSON to staff users by the stats
+view. Enable it by adding it to the project's middleware:
+
+    MIDDLEWARE_CLASSES += ['notecards.stats.StatsMiddleware']
+
+Queries are counted by turning on Django's query logging for each
+request, which is cheap next to the queries themselves. Requests slower
+than NOTECARDS_SLOW_REQUEST seconds are logged along with their slowest
+queries. Streaming responses make most of their queries while they're
+sent, so they're recorded once the stream is used up or closed.
+'''
+import logging
+import math
+import threading
+import time
+from collections import defaultdict, deque
+
+from django.conf import settings
+from django.db import connections
+from django.template import base as template_base
+
+
+logger = logging.getLogger(__name__)
+
+# Number of requests kept by each process
+BUFFER_SIZE = 1000
+# Upper bounds in milliseconds of the latency histogram's buckets, the
+# last bucket holds everything slower
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+# Most queries written to the log for a slow request
+SLOW_QUERIES = 10
+
+_local = threading.local()
+
+
+def percentile(values, percent):
+    '''Returns the nearest rank percentile of a list of numbers.'''
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(percent / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+class RingBuffer(object):
+    '''The most recent request records, oldest first.'''
+
+    def __init__(self, size=BUFFER_SIZE):
+        self._records = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return self._records.maxlen
+
+    def add(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+
+recorded = RingBuffer(getattr(settings, 'NOTECARDS_STATS_SIZE', BUFFER_SIZE))
+
+
+def _histogram(timings):
+    counts = [0] * (len(LATENCY_BUCKETS) + 1)
+    for timing in timings:
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if timing <= bound:
+                counts[position] += 1
+                break
+        else:
+            counts[-1] += 1
+    return [[bound, count]
+            for bound, count in zip(LATENCY_BUCKETS + (None,), counts)]
+
+
+def summary():
+    '''
+    Returns a dict with the number of buffered requests, the time the
+    oldest was made and a summary of each view's requests: the number of
+    requests and server errors, the mean and maximum queries, the mean SQL
+    and render time, latency percentiles and histogram in milliseconds,
+    and the mean response size in bytes.
+    '''
+    records = recorded.records()
+    byView = defaultdict(list)
+    for record in records:
+        byView[record['view']].append(record)
+    views = {}
+    for view, viewRecords in byView.items():
+        count = len(viewRecords)
+        timings = [record['total'] for record in viewRecords]
+        queries = [record['queries'] for record in viewRecords]
+        views[view] = {
+            'requests': count,
+            'errors': sum(1 for record in viewRecords
+                          if record['status'] >= 500),
+            'queries': {'mean': sum(queries) / count, 'max': max(queries)},
+            'sql': sum(record['sql'] for record in viewRecords) / count,
+            'render': sum(record['render'] for record in viewRecords) / count,
+            'p50': percentile(timings, 50),
+            'p95': percentile(timings, 95),
+            'p99': percentile(timings, 99),
+            'histogram': _histogram(timings),
+            'size': sum(record['size'] for record in viewRecords) / count}
+    return {'size': recorded.size,
+            'requests': len(records),
+            'since': records[0]['time'] if records else None,
+            'views': views}
+
+
+def _timed_render(render):
+    def timed(self, context):
+        # Only the outermost template is timed, since included templates
+        # are rendered within it
+        if getattr(_local, 'render', None) is None or _local.depth:
+            return render(self, context)
+        _local.depth = 1
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            _local.render += time.time() - start
+            _local.depth = 0
+    timed.timed = True
+    return timed
+
+
+class StreamedContent(object):
+    '''
+    Iterates over a streaming response's content, calling finish with the
+    number of bytes sent once it's used up or closed.
+    '''
+
+    def __init__(self, content, finish):
+        self._content = iter(content)
+        self._finish = finish
+        self.size = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            chunk = next(self._content)
+        except StopIteration:
+            self.close()
+            raise
+        self.size += len(chunk)
+        return chunk
+
+    next = __next__
+
+    def close(self):
+        # Called by the response when it's closed, which may be before the
+        # content is used up
+        finish, self._finish = self._finish, None
+        if finish is not None:
+            finish(self.size)
+
+
+class StatsMiddleware(object):
+    '''Records the statistics of each request a view handles.'''
+
+    def __init__(self):
+        if not getattr(template_base.Template.render, 'timed', False):
+            template_base.Template.render = _timed_render(
+                template_base.Template.render)
+
+    def process_request(self, request):
+        request._stats = {'start': time.time(), 'view': None, 'queries': {}}
+        for connection in connections.all():
+            request._stats['queries'][connection.alias] = (
+                connection.force_debug_cursor, len(connection.queries_log))
+            connection.force_debug_cursor = True
+        _local.render = 0.0
+        _local.depth = 0
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        stats = getattr(request, '_stats', None)
+        if stats is not None:
+            match = request.resolver_match
+            stats['view'] = (match and match.url_name) or '{0}.{1}'.format(
+                view_func.__module__, view_func.__name__)
+
+    def process_response(self, request, response):
+        stats = getattr(request, '_stats', None)
+        if stats is None:
+            return response
+        if response.streaming:
+            # Query logging stays on until the content has been sent
+            response.streaming_content = StreamedContent(
+                response.streaming_content,
+                lambda size: self._record(request, response, size))
+        else:
+            self._record(request, response, len(response.content))
+        return response
+
+    def _record(self, request, response, size):
+        stats = request._stats
+        total = time.time() - stats['start']
+        render = _local.render or 0.0
+        _local.render = None
+        queries = []
+        for connection in connections.all():
+            if connection.alias not in stats['queries']:
+                continue
+            forced, start = stats['queries'][connection.alias]
+            connection.force_debug_cursor = forced
+            # The log only holds the most recent queries, so a request
+            # making thousands is undercounted
+            queries.extend(list(connection.queries_log)[start:])
+        if stats['view'] is None:
+            # Nothing was resolved, like a 404 for an unknown URL
+            return
+        sql = sum(float(query['time']) for query in queries)
+        recorded.add({'view': stats['view'],
+                      'status': response.status_code,
+                      'time': stats['start'],
+                      'queries': len(queries),
+                      'sql': sql * 1000,
+                      'render': render * 1000,
+                      'total': total * 1000,
+                      'size': size})
+        slow = getattr(settings, 'NOTECARDS_SLOW_REQUEST', None)
+        if slow is not None and total >= slow:
+            slowest = sorted(queries,
+                             key=lambda query: float(query['time']),
+                             reverse=True)[:SLOW_QUERIES]
+            logger.warning(
+                'Slow request to %s took %.3fs with %d queries taking '
+                '%.3fs:\n%s',
+                request.path, total, len(queries), sql,
+                '\n'.join('{0}s {1}'.format(query['time'], query['sql'])
+                          for query in slowest))
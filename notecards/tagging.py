@@ -0,0 +1,145 @@
+'''
+Counting published decks per tag.
+
+TagCount rows hold the number of published decks with each tag, so tag
+listings don't have to join the whole taggit through table. The counts
+are changed incrementally: the views change a deck's tags with retag()
+and publish it with set_published(), and deleting a deck uncounts it
+(see notecards.signals). Decks that aren't published aren't counted, so
+cloning a deck, which makes an unpublished copy, changes no counts.
+
+Tagging a deck touches it once per tag added or removed (see
+notecards.signals). retag() and deck deletion hold those touches (see
+Deck.held_touches) while they change many tags at once, so the deck is
+touched at most once.
+'''
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_save
+
+from taggit.models import Tag, TaggedItem
+
+from notecards.models import Deck, TagCount
+
+
+def _count(tagIds, change):
+    # Adds `change` to the count of every tag, creating missing rows
+    tagIds = set(tagIds)
+    if not tagIds or not change:
+        return
+    counts = TagCount.objects.filter(tag_id__in=tagIds)
+    existing = set(counts.values_list('tag_id', flat=True))
+    counts.update(count=F('count') + change)
+    missing = tagIds - existing
+    if not missing:
+        return
+    try:
+        with transaction.atomic():
+            TagCount.objects.bulk_create(
+                [TagCount(tag_id=tagId, count=change) for tagId in missing])
+    except IntegrityError:
+        # Someone else created them first
+        TagCount.objects.filter(tag_id__in=missing) \
+                        .update(count=F('count') + change)
+
+
+def _tag_ids(deck):
+    return set(deck.tags.values_list('id', flat=True))
+
+
+def _named_tags(names):
+    # Returns the ids of the named tags, creating missing tags together
+    names = set(names)
+    tags = Tag.objects.filter(name__in=names)
+    found = dict(tags.values_list('name', 'id'))
+    missing = names - set(found)
+    if not missing:
+        return set(found.values())
+    try:
+        with transaction.atomic():
+            Tag.objects.bulk_create([Tag(name=name, slug=Tag().slugify(name))
+                                     for name in missing])
+    except IntegrityError:
+        # A slug is taken or someone else created a tag first. Saving them
+        # one at a time picks free slugs
+        for name in missing:
+            Tag.objects.get_or_create(name=name)
+    return set(tags.values_list('id', flat=True))
+
+
+def retag(deck, names):
+    '''Replaces the deck's tags with the named tags.'''
+    # Rather than deck.tags.set(), which looks up, creates and tags the
+    # deck with each tag one at a time, tags are added and removed in bulk
+    with transaction.atomic():
+        # Lock the deck so a concurrent publish can't count it with the
+        # wrong tags
+        published = Deck.objects.select_for_update() \
+                                .filter(pk=deck.pk) \
+                                .values_list('published', flat=True)[0]
+        old = _tag_ids(deck)
+        new = _named_tags(names)
+        if new == old:
+            return
+        tagged = TaggedItem.objects.filter(
+            content_type=ContentType.objects.get_for_model(Deck),
+            object_id=deck.id)
+        with Deck.held_touches(deck.id):
+            tagged.filter(tag_id__in=old - new).delete()
+            TaggedItem.objects.bulk_create(
+                [TaggedItem(content_object=deck, tag_id=tagId)
+                 for tagId in new - old])
+            # bulk_create sends no post_save, which the search index and
+            # the suggestions watch for
+            for item in tagged.filter(tag_id__in=new - old):
+                post_save.send(sender=TaggedItem, instance=item,
+                               created=True, update_fields=None, raw=False,
+                               using=item._state.db)
+        deck.touch()
+        if published:
+            _count(new - old, 1)
+            _count(old - new, -1)
+
+
+def set_published(deck, published):
+    '''Publishes or unpublishes the deck.'''
+    with transaction.atomic():
+        # Lock the deck so concurrent requests can't count it twice
+        wasPublished = Deck.objects.select_for_update() \
+                                   .filter(pk=deck.pk) \
+                                   .values_list('published', flat=True)[0]
+        deck.published = published
+        deck.save()
+        if published != wasPublished:
+            _count(_tag_ids(deck), 1 if published else -1)
+
+
+def uncount(deck):
+    '''Removes a deck that's about to be deleted from the counts.'''
+    if deck.published:
+        _count(_tag_ids(deck), -1)
+
+
+def rebuild_counts():
+    '''Recounts the published decks with each tag from scratch.'''
+    tagged = TaggedItem.objects.filter(
+        content_type=ContentType.objects.get_for_model(Deck),
+        object_id__in=Deck.objects.filter(published=True).values('id'))
+    counts = tagged.values('tag').annotate(decks=Count('id'))
+    with transaction.atomic():
+        TagCount.objects.all().delete()
+        TagCount.objects.bulk_create(
+            [TagCount(tag_id=row['tag'], count=row['decks'])
+             for row in counts])
+
+
+def top_tags(limit):
+    '''
+    Returns up to `limit` (name, slug, count) tuples for the tags with the
+    most published decks.
+    '''
+    return list(TagCount.objects.filter(count__gt=0)
+                                .order_by('-count', 'tag__name')
+                                .values_list('tag__name', 'tag__slug',
+                                             'count')[:limit])
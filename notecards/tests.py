@@ -1,16 +1,40 @@
+import base64
+import datetime
 import factory
+import gzip
+import json
 import random
+import tempfile
+import zipfile
 
+from collections import Counter
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.db.utils import IntegrityError
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
 from factory import fuzzy
+from haystack import connection_router, connections
+from haystack.query import SearchQuerySet
 
 from notecards.forms import deckForm
-from notecards.models import Card, Deck
+from notecards import (benchmarking, caching, cloning, exporting, grading,
+                       importing, indexing, reviewing, sampling, search,
+                       stats, tagging, typeahead, urls)
+from notecards.models import (Card, CardProgress, Deck, DeckCounter,
+                              DeletedDeck, IndexWatermark, Review,
+                              ScoreBucket, TagCount)
 
 
 class UserFactory(factory.DjangoModelFactory):
@@ -40,11 +64,15 @@ class CardFactory(factory.DjangoModelFactory):
     score = random.randint(-20, 10)
 
 
+# Answers are graded as they're given unless a test says otherwise
+@override_settings(NOTECARDS_REVIEW_INTERVAL=0)
 class TestNotecardViews(TestCase):
 
     def setUp(self):
         User.objects.create_user(username='auser', password='apass')
         User.objects.create_user(username='buser', password='bpass')
+        # Deck ids are reused between tests
+        caching.get_cache().clear()
 
     def test_add_score_to_card(self):
         # test adding a point to a card
@@ -114,6 +142,165 @@ class TestNotecardViews(TestCase):
         card3 = Card.objects.get(id=card3.id)
         self.assertEqual(card3.score, 0)
 
+    def test_check_answers(self):
+        a = self.client.login(username='auser', password='apass')
+        self.assertTrue(a)
+        user = User.objects.get(username='auser')
+        deck = DeckFactory.create(author=user)
+        card1 = CardFactory(deck=deck, front='one', back='eno', score=0)
+        card2 = CardFactory(deck=deck, front='two', back='owt', score=4)
+        card3 = CardFactory(deck=deck, front='two', back='wot', score=2)
+        card4 = CardFactory(deck=deck, front='four', back='ruof', score=7)
+        sampling.rebuild_buckets(deck)
+        url = reverse('check_answers', kwargs={'deckid': deck.id})
+        answers = [[card1.id, 'eno'],
+                   [card1.id, 'eno'],
+                   [card2.id, 'owt'],
+                   [card2.id, 'owt'],
+                   [card3.id, 'bad'],
+                   [card3.id, 'wot'],
+                   [card4.id, 'ruof'],
+                   [0, 'nothing']]
+        resp = self.client.post(url, json.dumps({'answers': answers}),
+                                content_type='application/json')
+        results = json.loads(resp.content.decode())['results']
+        self.assertEqual([r['result'] for r in results],
+                         ['correct', 'correct', 'correct', 'correct',
+                          'wrong', 'correct', 'correct', 'unknown'])
+        self.assertEqual(results[4]['answer'], 'wot')
+
+        # scores match grading the answers one by one, the wrong answer
+        # for 'two' resets card2 as well
+        scores = dict(Card.objects.filter(deck=deck)
+                                  .values_list('id', 'score'))
+        self.assertEqual(scores, {card1.id: 2, card2.id: 1,
+                                  card3.id: 2, card4.id: 7})
+        buckets = dict(ScoreBucket.objects.filter(deck=deck, count__gt=0)
+                                          .values_list('score', 'count'))
+        self.assertEqual(buckets, {1: 1, 2: 2, 7: 1})
+
+        # test bad input
+        resp = self.client.post(url, '{"answers": 5}',
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
+        # test that out of range times are logged as the nearest sane time
+        # rather than failing
+        Review.objects.all().delete()
+        body = '{{"answers": [[{0}, "eno", 100, -1e15], ' \
+               '[{0}, "eno", 1e400, 1e400]]}}'.format(card1.id)
+        resp = self.client.post(url, body, content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        old, new = Review.objects.order_by('id')
+        self.assertEqual(old.responseTime, 100)
+        self.assertLess(old.dateAnswered,
+                        timezone.now() - datetime.timedelta(days=364))
+        self.assertIsNone(new.responseTime)
+        resp = self.client.post(url, '{"answers": [[1e400, "eno"]]}',
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 400)
+
+        # test that buser can't grade auser's cards
+        self.client.logout()
+        self.client.login(username='buser', password='bpass')
+        resp = self.client.post(url, json.dumps({'answers': answers}),
+                                content_type='application/json')
+        self.assertEqual(resp.status_code, 404)
+
+    @override_settings(NOTECARDS_REVIEW_INTERVAL=None)
+    def test_review_log(self):
+        self.client.login(username='auser', password='apass')
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user)
+        card1 = CardFactory(deck=deck, front='one', back='eno', score=0)
+        card2 = CardFactory(deck=deck, front='two', back='owt', score=3)
+        sampling.rebuild_buckets(deck)
+        url = reverse('check_answer', kwargs={'deckid': deck.id})
+
+        # answers are checked straight away but only queued
+        resp = self.client.post(url, {'cardid': card1.id, 'ans': 'eno',
+                                      'time': 1200})
+        self.assertEqual(json.loads(resp.content.decode())['result'],
+                         'correct')
+        resp = self.client.post(url, {'cardid': card2.id, 'ans': 'bad',
+                                      'time': 'soon'})
+        self.assertEqual(json.loads(resp.content.decode()),
+                         {'result': 'wrong', 'answer': 'owt'})
+        self.client.post(url, {'cardid': card1.id, 'ans': 'eno'})
+        self.assertEqual(reviewing.buffered.pending(),
+                         [(deck.id, card1.id, 'eno'),
+                          (deck.id, card2.id, 'bad'),
+                          (deck.id, card1.id, 'eno')])
+        self.assertEqual(Card.objects.get(pk=card1.id).score, 0)
+        self.assertFalse(Review.objects.exists())
+
+        # flushing writes the reviews and scores from the same answers
+        self.assertEqual(reviewing.buffered.flush(), 3)
+        self.assertEqual(reviewing.buffered.pending(), [])
+        reviews = Review.objects.order_by('id')
+        self.assertEqual([(review.user_id, review.card_id, review.correct,
+                           review.responseTime) for review in reviews],
+                         [(user.id, card1.id, True, 1200),
+                          (user.id, card2.id, False, None),
+                          (user.id, card1.id, True, None)])
+        scores = dict(Card.objects.filter(deck=deck)
+                                  .values_list('id', 'score'))
+        self.assertEqual(scores, {card1.id: 2, card2.id: 1})
+        buckets = dict(ScoreBucket.objects.filter(deck=deck, count__gt=0)
+                                          .values_list('score', 'count'))
+        self.assertEqual(buckets, {1: 1, 2: 1})
+
+        # answers can only be given for the user's own decks
+        self.client.login(username='buser', password='bpass')
+        resp = self.client.post(url, {'cardid': card1.id, 'ans': 'eno'})
+        self.assertEqual(resp.status_code, 404)
+        self.assertEqual(reviewing.buffered.pending(), [])
+        self.client.login(username='auser', password='apass')
+
+        # answers that keep failing are retried, then dropped
+        self.client.post(url, {'cardid': card1.id, 'ans': 'eno'})
+        with mock.patch.object(grading, 'sync_answers',
+                               side_effect=IntegrityError), \
+                self.assertLogs('notecards.reviewing', 'ERROR'):
+            for i in range(reviewing.MAX_ATTEMPTS - 1):
+                self.assertEqual(reviewing.buffered.flush(), 0)
+                self.assertEqual(len(reviewing.buffered.pending()), 1)
+            self.assertEqual(reviewing.buffered.flush(), 0)
+        self.assertEqual(reviewing.buffered.pending(), [])
+
+        # the oldest answers are dropped once the queue is full
+        with mock.patch.object(reviewing, 'MAX_QUEUED', 2), \
+                self.assertLogs('notecards.reviewing', 'ERROR'):
+            for answer in ('a', 'b', 'c'):
+                self.client.post(url, {'cardid': card1.id, 'ans': answer})
+        self.assertEqual([answer for deckid, cardid, answer
+                          in reviewing.buffered.pending()], ['b', 'c'])
+
+        # answers for deleted decks are dropped
+        deck.delete()
+        self.assertEqual(reviewing.buffered.flush(), 0)
+        self.assertEqual(reviewing.buffered.pending(), [])
+        self.assertFalse(Review.objects.exists())
+
+        # synced answers are logged with when they were given
+        deck = DeckFactory(author=user)
+        card = CardFactory(deck=deck, front='one', back='eno', score=0)
+        answeredAt = timezone.now() - datetime.timedelta(hours=1)
+        resp = self.client.post(
+            reverse('check_answers', kwargs={'deckid': deck.id}),
+            json.dumps({'answers': [[card.id, 'eno', 800,
+                                     answeredAt.timestamp() * 1000],
+                                    [card.id, 'bad']]}),
+            content_type='application/json')
+        self.assertEqual(resp.status_code, 200)
+        reviews = list(Review.objects.order_by('id'))
+        self.assertEqual([(review.correct, review.responseTime)
+                          for review in reviews],
+                         [(True, 800), (False, None)])
+        self.assertLess(abs(reviews[0].dateAnswered - answeredAt),
+                        datetime.timedelta(seconds=1))
+        self.assertGreater(reviews[1].dateAnswered, answeredAt)
+
     def test_clone_deck(self):
         auser = User.objects.get(username='auser')
         buser = User.objects.get(username='buser')
@@ -137,7 +324,7 @@ class TestNotecardViews(TestCase):
                                {'did': decka.id})
         self.assertEqual(resp.status_code, 302)
         bdeck = Deck.objects.get(author=buser, title='test-deck')
-        self.assertEqual(10, len(bdeck.card_set.all()))
+        self.assertEqual(10, len(bdeck.cards()))
         self.assertCountEqual(bdeck.tags.names(), ['test', 'atag'])
 
         # test that clone fails with already owned deck
@@ -145,6 +332,145 @@ class TestNotecardViews(TestCase):
                                {'did': decka.id})
         self.assertContains(resp, 'with this title', 1)
 
+    def test_clone_deck_service(self):
+        auser = User.objects.get(username='auser')
+        buser = User.objects.get(username='buser')
+        deck = DeckFactory(author=auser, title='big deck')
+        CardFactory.create_batch(25, deck=deck)
+        deck.tags.add('big')
+
+        # a clone shares the cards of its source deck
+        newDeck = cloning.clone_deck(deck, buser)
+        self.assertEqual(newDeck.source, deck)
+        self.assertEqual(newDeck.card_set.count(), 0)
+        self.assertEqual(newDeck.numCards, 25)
+        self.assertFalse(newDeck.published)
+        self.assertCountEqual(newDeck.tags.names(), ['big'])
+
+        # nothing is left behind when cloning fails
+        with self.assertRaises(ValidationError):
+            cloning.clone_deck(deck, buser)
+        self.assertEqual(Deck.objects.filter(author=buser).count(), 1)
+
+        # the cards are copied in chunks along with the owner's progress
+        card = deck.card_set.order_by('id')[3]
+        grading.grade_answers(newDeck, [(card.id, card.back)])
+        self.assertEqual(CardProgress.objects.get(card=card).score, 1)
+        with CaptureQueriesContext(connection) as queries:
+            cardids = cloning.materialize(newDeck, chunkSize=10)
+        inserts = [q for q in queries.captured_queries
+                   if 'INSERT INTO "notecards_card"' in q['sql']]
+        self.assertEqual(len(inserts), 3)
+        self.assertIsNone(Deck.objects.get(pk=newDeck.id).source)
+        self.assertEqual(newDeck.card_set.count(), 25)
+        self.assertEqual(deck.card_set.count(), 25)
+        copy = Card.objects.get(pk=cardids[card.id])
+        self.assertEqual((copy.front, copy.back, copy.score),
+                         (card.front, card.back, 1))
+        self.assertEqual(newDeck.card_set.filter(score=0).count(), 24)
+        self.assertFalse(CardProgress.objects.exists())
+        self.assertEqual(cloning.materialize(newDeck), {})
+
+        # the management command clones for several users at once
+        out = StringIO()
+        User.objects.create_user(username='cuser', password='cpass')
+        call_command('clone_decks', str(deck.id), 'cuser', 'nobody',
+                     stdout=out, stderr=StringIO())
+        self.assertEqual(Deck.objects.filter(title='big deck').count(), 3)
+
+    def test_linked_clone(self):
+        auser = User.objects.get(username='auser')
+        buser = User.objects.get(username='buser')
+        deck = DeckFactory(author=auser, title='shared')
+        card1 = CardFactory(deck=deck, front='one', back='eno', score=3)
+        card2 = CardFactory(deck=deck, front='two', back='owt', score=3)
+
+        # drilling a linked clone uses the new owner's scores
+        b = self.client.login(username='buser', password='bpass')
+        self.assertTrue(b)
+        self.client.get(reverse('clone_deck'), {'did': deck.id})
+        bdeck = Deck.objects.get(author=buser, title='shared')
+        resp = self.client.get(reverse('get_card',
+                               kwargs={'deckid': bdeck.id}))
+        self.assertEqual(resp.context['card'].score, 0)
+        self.client.post(reverse('check_answer',
+                         kwargs={'deckid': bdeck.id}),
+                         {'cardid': card1.id, 'ans': 'eno'})
+        self.assertEqual(Card.objects.get(pk=card1.id).score, 3)
+        self.assertEqual(CardProgress.objects.get(card=card1).score, 1)
+        for i in range(0, 10):
+            card = sampling.draw_card(bdeck, maxScore=0)
+            self.assertEqual((card.id, card.score), (card2.id, 0))
+        resp = self.client.get(reverse('view_deck'), {'did': bdeck.id})
+        self.assertContains(resp, 'skill1', 1)
+
+        # editing a card copies the cards into the clone first
+        resp = self.client.post(reverse('edit_card',
+                                kwargs={'cardid': card2.id}),
+                                {'editfront': 'three',
+                                 'editback': 'eerht'})
+        self.assertEqual(resp.status_code, 200)
+        bdeck = Deck.objects.get(pk=bdeck.id)
+        self.assertIsNone(bdeck.source)
+        self.assertCountEqual(bdeck.card_set.values_list('front', 'score'),
+                              [('one', 1), ('three', 0)])
+        self.assertEqual(Card.objects.get(pk=card2.id).front, 'two')
+        # and moves the owner's reviews over to the copies
+        review = Review.objects.get(deck=bdeck)
+        self.assertEqual((review.card.deck_id, review.card.front),
+                         (bdeck.id, 'one'))
+
+        # deleting the source deck hands its cards to the oldest clone,
+        # which the other clones then link to
+        User.objects.create_user(username='cuser', password='cpass')
+        User.objects.create_user(username='duser', password='dpass')
+        cuser = User.objects.get(username='cuser')
+        cdeck = cloning.clone_deck(deck, cuser)
+        ddeck = cloning.clone_deck(deck, User.objects.get(username='duser'))
+        grading.grade_answers(cdeck, [(card1.id, 'eno')])
+        grading.grade_answers(ddeck, [(card2.id, 'owt'), (card2.id, 'owt')])
+        deck.delete()
+        cdeck = Deck.objects.get(pk=cdeck.id)
+        self.assertIsNone(cdeck.source)
+        self.assertEqual(cdeck.card_count, 2)
+        self.assertCountEqual(cdeck.card_set.values_list('id', 'score'),
+                              [(card1.id, 1), (card2.id, 0)])
+        self.assertFalse(CardProgress.objects.filter(deck=cdeck).exists())
+        ddeck = Deck.objects.get(pk=ddeck.id)
+        self.assertEqual(ddeck.source_id, cdeck.id)
+        self.assertEqual(CardProgress.objects.get(deck=ddeck).score, 2)
+        self.assertEqual(sampling.draw_card(ddeck, maxScore=0).id, card1.id)
+
+        # the cards are handed over when the author's account is deleted
+        # too, while decks without clones lose their cards
+        lonely = CardFactory(deck=DeckFactory(author=cuser))
+        cuser.delete()
+        ddeck = Deck.objects.get(pk=ddeck.id)
+        self.assertIsNone(ddeck.source)
+        self.assertEqual(ddeck.numCards, 2)
+        self.assertCountEqual(ddeck.cards().values_list('id', 'score'),
+                              [(card1.id, 0), (card2.id, 2)])
+        self.assertFalse(Card.objects.filter(pk=lonely.id).exists())
+
+        # and when decks are deleted through a queryset
+        edeck = cloning.clone_deck(ddeck, auser)
+        Deck.objects.filter(pk=ddeck.id).delete()
+        edeck = Deck.objects.get(pk=edeck.id)
+        self.assertIsNone(edeck.source)
+        self.assertEqual(edeck.numCards, 2)
+
+        # without copying cards once per clone
+        def deleteQueries(size):
+            source = DeckFactory(author=auser)
+            CardFactory.create_batch(size, deck=source)
+            for i in range(size):
+                cloning.clone_deck(source, User.objects.create_user(
+                    username='clone{0}-{1}'.format(size, i)))
+            with CaptureQueriesContext(connection) as queries:
+                source.delete()
+            return len(queries)
+        self.assertEqual(deleteQueries(2), deleteQueries(6))
+
     def test_create_card(self):
         # Test that user can create a card using the create_card view
 
@@ -165,6 +491,58 @@ class TestNotecardViews(TestCase):
         expected = '<option>question -- answer</option>'
         self.assertContains(resp, expected, 1, status_code=201)
 
+    def test_import_cards(self):
+        a = self.client.login(username='auser', password='apass')
+        self.assertTrue(a)
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user)
+        sampling.rebuild_buckets(deck)
+
+        # CSV with a header row, a quoted field and two bad rows
+        upload = SimpleUploadedFile(
+            'cards.csv',
+            '\ufeffFront,Back\r\none,1\r\n"two, too",2\r\n'
+            'three\r\n,4\r\n\r\nfive,5\r\n'.encode())
+        resp = self.client.post(reverse('import_cards',
+                                        kwargs={'deckid': deck.id}),
+                                {'file': upload})
+        result = json.loads(resp.content.decode())
+        self.assertEqual(result['imported'], 3)
+        self.assertEqual(result['failed'], 2)
+        self.assertEqual(result['errors'],
+                         [[4, 'Expected a front and a back'],
+                          [5, 'front: This field is required.']])
+        self.assertCountEqual(deck.card_set.values_list('front', 'back'),
+                              [('one', '1'), ('two, too', '2'),
+                               ('five', '5')])
+        deck = Deck.objects.get(pk=deck.id)
+        self.assertEqual(deck.card_count, 3)
+        self.assertEqual(ScoreBucket.objects.get(deck=deck, score=0).count,
+                         3)
+
+        # other users can't import into the deck
+        self.client.login(username='buser', password='bpass')
+        resp = self.client.post(reverse('import_cards',
+                                        kwargs={'deckid': deck.id}),
+                                {'file': SimpleUploadedFile('a.csv', b'a,b')})
+        self.assertEqual(resp.status_code, 404)
+
+        # Anki exports are tab separated, in chunks from the command
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as export:
+            export.write('#separator:tab\n#html:true\n')
+            for i in range(5):
+                export.write('front {0}\tback {0}\ttag\n'.format(i))
+            export.flush()
+            out = StringIO()
+            call_command('import_cards', str(deck.id), export.name,
+                         chunk_size=2, verbosity=2, stdout=out)
+        self.assertIn('Imported 4 card(s)\n', out.getvalue())
+        self.assertIn('Imported 5 card(s), 0 row(s) failed',
+                      out.getvalue())
+        self.assertEqual(Deck.objects.get(pk=deck.id).card_count, 8)
+        self.assertTrue(deck.card_set.filter(front='front 4',
+                                             back='back 4').exists())
+
     def test_create_deck(self):
         a = self.client.login(username='auser', password='apass')
         self.assertTrue(a)
@@ -206,6 +584,50 @@ class TestNotecardViews(TestCase):
             CardFactory(deck=deck)
         self.assertEqual(10, deck.numCards)
 
+    def test_deck_card_count(self):
+        # test that the stored card count follows cards being added and
+        # removed
+        a = self.client.login(username='auser', password='apass')
+        self.assertTrue(a)
+        auser = User.objects.get(username='auser')
+        deck = DeckFactory(author=auser)
+        for front in ['one', 'two', 'three']:
+            self.client.post(reverse('create_card',
+                             kwargs={'deckid': deck.id}),
+                             {'front': front, 'back': front})
+        card = Card.objects.get(front='two')
+        self.client.delete(reverse('edit_card', kwargs={'cardid': card.id}))
+        self.assertEqual(Deck.objects.get(pk=deck.id).card_count, 2)
+
+        # and cards deleted in bulk
+        CardFactory(deck=deck)
+        Card.objects.filter(front='one').delete()
+        self.assertEqual(Deck.objects.get(pk=deck.id).card_count, 2)
+
+        # saving a stale deck doesn't overwrite the count
+        deck.title = 'new title'
+        deck.save()
+        self.assertEqual(Deck.objects.get(pk=deck.id).card_count, 2)
+
+        # linked clones count the cards of their source deck
+        buser = User.objects.get(username='buser')
+        clone = cloning.clone_deck(deck, buser)
+        self.assertEqual(Deck.objects.get(pk=clone.id).numCards, 2)
+        cloning.materialize(clone)
+        self.assertEqual(Deck.objects.get(pk=clone.id).card_count, 2)
+
+        # listing decks doesn't count cards
+        with CaptureQueriesContext(connection) as queries:
+            resp = self.client.get(reverse('decks'))
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'COUNT' in q['sql']])
+        self.assertContains(resp, '<td>2</td>', 1)
+
+        # the management command repairs counts that have drifted
+        Deck.objects.filter(pk=deck.id).update(card_count=7)
+        call_command('repair_card_counts', stdout=StringIO())
+        self.assertEqual(Deck.objects.get(pk=deck.id).card_count, 2)
+
     def test_deck_validation(self):
         # tests that no user can create more than 100 decks
         auser = User.objects.get(username='auser')
@@ -226,6 +648,23 @@ class TestNotecardViews(TestCase):
         with self.assertRaises(IntegrityError):
             DeckFactory(author=buser, title='title')
 
+        # tests that a user at the limit can still edit their decks
+        # without counting them
+        deck = Deck.objects.filter(author=auser)[0]
+        deck.published = False
+        with self.assertNumQueries(1):
+            deck.save()
+
+        # tests that deleting a deck makes room for a new one
+        deck.delete()
+        DeckFactory(author=auser)
+        self.assertEqual(100, Deck.objects.filter(author=auser).count())
+        with self.assertRaises(ValidationError):
+            DeckFactory(author=auser)
+        counter = DeckCounter.objects.get(user=buser)
+        self.assertEqual(counter.count,
+                         Deck.objects.filter(author=buser).count())
+
     def test_delete_deck(self):
         a = self.client.login(username='auser', password='apass')
         self.assertTrue(a)
@@ -324,6 +763,112 @@ class TestNotecardViews(TestCase):
 
         self.assertEquals(resp.status_code, 404)
 
+    def test_score_buckets(self):
+        # test that drilling keeps the deck's score histogram in sync
+        a = self.client.login(username='auser', password='apass')
+        self.assertTrue(a)
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user)
+        for front in ['one', 'two', 'three']:
+            self.client.post(reverse('create_card',
+                             kwargs={'deckid': deck.id}),
+                             {'front': front, 'back': front[::-1]})
+        # the histogram is built on the first draw
+        self.assertFalse(ScoreBucket.objects.filter(deck=deck).exists())
+        self.client.get(reverse('get_card', kwargs={'deckid': deck.id}))
+        card = Card.objects.get(front='one')
+        self.client.post(reverse('check_answer',
+                         kwargs={'deckid': deck.id}),
+                         {'cardid': card.id, 'ans': 'eno'})
+        buckets = dict(ScoreBucket.objects.filter(deck=deck)
+                                          .values_list('score', 'count'))
+        self.assertEqual(buckets, {0: 2, 1: 1})
+
+        self.client.delete(reverse('edit_card',
+                           kwargs={'cardid': card.id}))
+        buckets = dict(ScoreBucket.objects.filter(deck=deck)
+                                          .values_list('score', 'count'))
+        self.assertEqual(buckets, {0: 2, 1: 0})
+
+    def test_draw_card(self):
+        # test that drawing a card doesn't depend on the size of the deck
+        deck = DeckFactory()
+        self.assertIsNone(sampling.draw_card(deck))
+        CardFactory.create_batch(5, deck=deck, score=2)
+        sampling.rebuild_buckets(deck)
+        with self.assertNumQueries(2):
+            card = sampling.draw_card(deck)
+        self.assertEqual(card.deck, deck)
+        CardFactory.create_batch(50, deck=deck, score=2)
+        sampling.rebuild_buckets(deck)
+        with self.assertNumQueries(2):
+            sampling.draw_card(deck)
+
+        # a stale histogram is rebuilt rather than drawing nothing
+        Card.objects.filter(deck=deck).update(score=4)
+        card = sampling.draw_card(deck)
+        self.assertEqual(card.score, 4)
+
+        # so is one whose counts have drifted to nothing
+        ScoreBucket.objects.filter(deck=deck).update(count=0)
+        self.assertEqual(sampling.draw_card(deck).deck, deck)
+        self.assertEqual(ScoreBucket.objects.get(deck=deck, score=4).count,
+                         55)
+        # while a deck with no suitable cards stays as it is
+        with self.assertNumQueries(2):
+            self.assertIsNone(sampling.draw_card(deck, maxScore=3))
+
+    def test_draw_card_distribution(self):
+        # test that hard mode draws every card equally often when the
+        # deck's card ids are interleaved with another deck's, with a
+        # growing gap before each card
+        deck = DeckFactory()
+        other = DeckFactory()
+        cards = []
+        for gap in range(10):
+            CardFactory.create_batch(gap * 5, deck=other)
+            cards.append(CardFactory(deck=deck, score=0).id)
+        sampling.rebuild_buckets(deck)
+        random.seed(0)
+        drawn = Counter(sampling.draw_card(deck, maxScore=3).id
+                        for i in range(1000))
+        self.assertEqual(sorted(drawn), sorted(cards))
+        for card in cards:
+            self.assertTrue(60 <= drawn[card] <= 140, drawn)
+
+    def test_get_cards(self):
+        # test that a batch of cards can be fetched for the drill queue
+        a = self.client.login(username='auser', password='apass')
+        self.assertTrue(a)
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user)
+        CardFactory.create_batch(5, deck=deck, score=1)
+        CardFactory.create_batch(5, deck=deck, score=5)
+        resp = self.client.get(reverse('get_cards',
+                               kwargs={'deckid': deck.id}),
+                               {'n': 15})
+        cards = json.loads(resp.content.decode())['cards']
+        self.assertEqual(len(cards), 15)
+        ids = set(deck.card_set.values_list('id', flat=True))
+        for cardid, front in cards:
+            self.assertIn(cardid, ids)
+
+        # test hard mode only returns weak cards
+        resp = self.client.get(reverse('get_cards',
+                               kwargs={'deckid': deck.id}),
+                               {'n': 10, 'hard': 1})
+        cards = json.loads(resp.content.decode())['cards']
+        weak = Card.objects.filter(deck=deck, score=1)
+        self.assertTrue(all(c[0] in weak.values_list('id', flat=True)
+                            for c in cards))
+
+        # test that buser can't drill auser's deck
+        self.client.logout()
+        self.client.login(username='buser', password='bpass')
+        resp = self.client.get(reverse('get_cards',
+                               kwargs={'deckid': deck.id}))
+        self.assertEqual(resp.status_code, 404)
+
     def test_get_deck(self):
         # get test that the get_deck view correctly returns the details
         # of a deck
@@ -334,20 +879,591 @@ class TestNotecardViews(TestCase):
         resp = self.client.get(reverse('get_deck',
                                kwargs={'deckid': deck.id}))
 
-        self.assertContains(resp, 'score', 10)
+        content = b''.join(resp.streaming_content).decode()
+        self.assertEquals(content.count('score'), 10)
+        cards = json.loads(content)
+        self.assertEquals(sorted(card['pk'] for card in cards),
+                          sorted(deck.cards().values_list('id', flat=True)))
+
+        # test that an unchanged deck isn't sent again
+        resp = self.client.get(reverse('get_deck',
+                               kwargs={'deckid': deck.id}),
+                               HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEquals(resp.status_code, 304)
+
+        # test that editing a card changes the ETag
+        etag = resp['ETag']
+        card = deck.cards()[0]
+        card.back = 'changed'
+        card.save()
+        resp = self.client.get(reverse('get_deck',
+                               kwargs={'deckid': deck.id}),
+                               HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotEquals(resp['ETag'], etag)
+
+        # and so does grading a card, since the cards carry their scores
+        etag = resp['ETag']
+        grading.grade_answers(deck, [(card.id, card.back)])
+        resp = self.client.get(reverse('get_deck',
+                               kwargs={'deckid': deck.id}),
+                               HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(resp.status_code, 200)
+        self.assertNotEquals(resp['ETag'], etag)
+        self.assertIsNotNone(Deck.objects.get(pk=deck.id).dateScored)
+
+        # test getting a deck that doesn't exist
+        resp = self.client.get(reverse('get_deck',
+                               kwargs={'deckid': deck.id + 1}))
+        self.assertEquals(resp.status_code, 404)
+
+    def test_deck_pack(self):
+        self.client.login(username='auser', password='apass')
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user)
+        card1 = CardFactory(deck=deck, front='one', back='eno', score=0)
+        card2 = CardFactory(deck=deck, front='two', back='owt', score=4)
+        sampling.rebuild_buckets(deck)
+        url = reverse('deck_pack', kwargs={'deckid': deck.id})
+
+        resp = self.client.get(url)
+        pack = json.loads(b''.join(resp.streaming_content).decode())
+        self.assertEqual(sorted(pack['cards']),
+                         [[card1.id, 'one', 'eno', 0],
+                          [card2.id, 'two', 'owt', 4]])
+        self.assertEqual(pack['weak'], sampling.weak_score())
+        self.assertEqual(resp['ETag'], '"{0}"'.format(pack['version']))
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(resp.status_code, 304)
+
+        # answers synced against the current version keep the copy
+        # current, and come back with the new scores
+        syncUrl = reverse('check_answers', kwargs={'deckid': deck.id})
+        body = json.dumps({'answers': [[card1.id, 'eno']],
+                           'version': pack['version']})
+        resp = self.client.post(syncUrl, body,
+                                content_type='application/json')
+        data = json.loads(resp.content.decode())
+        self.assertEqual(data['scores'], {str(card1.id): 1})
+        self.assertNotEqual(data['version'], pack['version'])
+        # scores aren't part of the deck's content
+        graded = Deck.objects.get(pk=deck.id)
+        self.assertEqual((graded.version, graded.dateModified),
+                         (deck.version, deck.dateModified))
+        resp = self.client.get(url,
+                               HTTP_IF_NONE_MATCH='"{0}"'.format(
+                                   data['version']))
+        self.assertEqual(resp.status_code, 304)
+
+        # a stale version gets null back, the body may be gzipped
+        buffer = BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb') as gzipFile:
+            gzipFile.write(json.dumps({'answers': [[card2.id, 'bad']],
+                                       'version': pack['version']})
+                           .encode())
+        resp = self.client.post(syncUrl, buffer.getvalue(),
+                                content_type='application/json',
+                                HTTP_CONTENT_ENCODING='gzip')
+        data = json.loads(resp.content.decode())
+        self.assertEqual(data['results'][0]['result'], 'wrong')
+        self.assertEqual(data['scores'], {str(card2.id): 1})
+        self.assertIsNone(data['version'])
+
+        # linked clones are packed with their owner's own scores
+        self.client.login(username='buser', password='bpass')
+        clone = cloning.clone_deck(deck, User.objects.get(username='buser'))
+        resp = self.client.get(reverse('deck_pack',
+                                       kwargs={'deckid': clone.id}))
+        pack = json.loads(b''.join(resp.streaming_content).decode())
+        self.assertEqual(sorted(card[3] for card in pack['cards']), [0, 0])
+
+        # only the owner can download the deck
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 404)
+
+    def test_export_deck(self):
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user, title='Export Me', published=False)
+        for front in ('one', 'two, too', 'three'):
+            CardFactory(deck=deck, front=front, back='back\t' + front)
+
+        # unpublished decks can only be exported by their author
+        url = reverse('export_deck', kwargs={'deckid': deck.id})
+        resp = self.client.get(url)
+        self.assertEqual(resp.status_code, 404)
+        self.client.login(username='auser', password='apass')
+        resp = self.client.get(url, {'format': 'csv'})
+        self.assertEqual(resp['Content-Disposition'],
+                         'attachment; filename="export-me.csv"')
+        content = b''.join(resp.streaming_content).decode()
+        self.assertEqual(content.splitlines()[:3],
+                         ['front,back', 'one,back\tone',
+                          '"two, too","back\ttwo, too"'])
+
+        resp = self.client.get(url, {'format': 'jsonl'})
+        lines = b''.join(resp.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['front'] for line in lines],
+                         ['one', 'two, too', 'three'])
+
+        # exports can be imported again, whatever the chunk size
+        copy = DeckFactory(author=user)
+        for format in exporting.FORMATS:
+            write = exporting.FORMATS[format][0]
+            if format != 'jsonl':
+                exported = ''.join(write(deck.cards(), 2))
+                importing.import_cards(copy, StringIO(exported))
+        self.assertEqual(
+            sorted(copy.card_set.values_list('front', 'back')),
+            sorted(list(deck.card_set.values_list('front', 'back')) * 2))
+
+        # archive of all of the user's decks
+        resp = self.client.get(reverse('export_decks'), {'format': 'anki'})
+        archive = zipfile.ZipFile(
+            BytesIO(b''.join(resp.streaming_content)))
+        names = ['{0}-export-me.txt'.format(deck.id),
+                 '{0}-{1}.txt'.format(copy.id, copy.slug)]
+        self.assertEqual(archive.namelist(), names)
+        self.assertEqual(archive.read(names[0]).decode().splitlines()[2],
+                         'one\t"back\tone"')
+
+        with tempfile.NamedTemporaryFile(suffix='.zip') as output:
+            call_command('export_decks', output.name, user='auser',
+                         stdout=StringIO())
+            self.assertEqual(len(zipfile.ZipFile(output.name).namelist()),
+                             2)
+
+    def test_benchmark(self):
+        # only an empty database is seeded
+        with self.assertRaises(CommandError):
+            call_command('benchmark', users=3, decks=6, cards=63,
+                         requests=4, warmup=1, stdout=StringIO())
+        self.assertFalse(benchmarking.seeded())
+        User.objects.all().delete()
+
+        with tempfile.NamedTemporaryFile('r', suffix='.json') as output:
+            call_command('benchmark', users=3, decks=6, cards=63,
+                         requests=4, warmup=1, json=output.name,
+                         stdout=StringIO())
+            results = json.load(output)
+        self.assertEqual(results['data'],
+                         {'users': 3, 'decks': 6, 'cards': 63})
+        self.assertEqual(set(results['views']),
+                         set(benchmarking.Benchmark.views))
+        for view, result in results['views'].items():
+            self.assertEqual(result['errors'], 0, view)
+            self.assertLessEqual(result['p50'], result['p99'])
+            self.assertGreater(result['queries']['max'], 0)
+
+        # the seeded data looks like it was built through the site
+        deck = Deck.objects.get(title='Bench deck 0')
+        self.assertFalse(deck.published)
+        self.assertEqual(deck.card_count, Card.objects.filter(deck=deck)
+                                                      .count())
+        self.assertEqual(sum(ScoreBucket.objects.filter(deck=deck)
+                                        .values_list('count', flat=True)),
+                         deck.card_count)
+        self.assertEqual(DeckCounter.objects.get(user=deck.author).count, 2)
+        self.assertFalse(deck.author.has_usable_password())
+        # cloning was rolled back
+        self.assertEqual(Deck.objects.count(), 6)
 
     def test_get_decks(self):
         DeckFactory.create_batch(125)
 
-        # test getting first page without specifying page number
+        # test getting first page without specifying a cursor
         resp = self.client.get(reverse('decks'))
-        self.assertEquals(resp.context['decks'].count(), 50)
+        self.assertEquals(len(resp.context['decks']), 50)
+        self.assertIsNone(resp.context['prev'])
+        seen = [deck.id for deck in resp.context['decks']]
 
         # test getting subsequent pages
-        resp = self.client.get(reverse('decks'), {'page': 2})
-        self.assertEquals(resp.context['decks'].count(), 50)
-        resp = self.client.get(reverse('decks'), {'page': 3})
-        self.assertEquals(resp.context['decks'].count(), 25)
+        resp = self.client.get(reverse('decks'),
+                               {'after': resp.context['next']})
+        self.assertEquals(len(resp.context['decks']), 50)
+        seen += [deck.id for deck in resp.context['decks']]
+        resp = self.client.get(reverse('decks'),
+                               {'after': resp.context['next']})
+        self.assertEquals(len(resp.context['decks']), 25)
+        self.assertIsNone(resp.context['next'])
+        seen += [deck.id for deck in resp.context['decks']]
+        # decks created on the same day are ordered by id
+        self.assertEqual(seen, sorted(seen, reverse=True))
+
+        # test going back a page
+        resp = self.client.get(reverse('decks'),
+                               {'before': resp.context['prev']})
+        self.assertEqual([deck.id for deck in resp.context['decks']],
+                         seen[50:100])
+        resp = self.client.get(reverse('decks'),
+                               {'before': resp.context['prev']})
+        self.assertEqual([deck.id for deck in resp.context['decks']],
+                         seen[:50])
+        self.assertIsNone(resp.context['prev'])
+
+        # test that a bad cursor is rejected
+        resp = self.client.get(reverse('decks'), {'after': 'nonsense'})
+        self.assertContains(resp, 'Invalid page')
+        huge = base64.urlsafe_b64encode(
+            '2015-01-01:{0}'.format(2 ** 70).encode()).decode()
+        resp = self.client.get(reverse('decks'), {'after': huge})
+        self.assertContains(resp, 'Invalid page')
+
+    def test_get_decks_queries(self):
+        # test that the number of queries doesn't depend on the number of
+        # decks shown
+        DeckFactory.create_batch(5)
+        for deck in Deck.objects.all():
+            deck.tags.add('a', 'b')
+        with self.assertNumQueries(3):
+            resp = self.client.get(reverse('decks'))
+        self.assertEquals(len(resp.context['decks']), 5)
+        DeckFactory.create_batch(45)
+        with self.assertNumQueries(3):
+            self.client.get(reverse('decks'))
+        # unchanged rows come from the cache
+        with self.assertNumQueries(1):
+            self.client.get(reverse('decks'))
+
+    def test_deck_cache(self):
+        user = User.objects.get(username='auser')
+        deck = DeckFactory(author=user, title='cached')
+        card = CardFactory(deck=deck, front='one', back='eno', score=2)
+
+        # test that anonymous visitors share a cached page
+        resp = self.client.get(reverse('view_deck'), {'did': deck.id})
+        self.assertContains(resp, 'eno')
+        with self.assertNumQueries(1):
+            resp = self.client.get(reverse('view_deck'), {'did': deck.id})
+        self.assertContains(resp, 'eno')
+
+        # test that changing a card, the deck or its tags changes the page
+        card.back = 'changed'
+        card.save()
+        resp = self.client.get(reverse('view_deck'), {'did': deck.id})
+        self.assertContains(resp, 'changed')
+        deck = Deck.objects.get(pk=deck.id)
+        deck.description = 'new description'
+        deck.save()
+        resp = self.client.get(reverse('view_deck'), {'did': deck.id})
+        self.assertContains(resp, 'new description')
+        deck.tags.add('spanish')
+        resp = self.client.get(reverse('decks'))
+        self.assertContains(resp, 'spanish')
+
+        # test that the owner doesn't get the anonymous page
+        self.client.login(username='auser', password='apass')
+        resp = self.client.get(reverse('view_deck'), {'did': deck.id})
+        self.assertContains(resp, 'skill2')
+
+        # test that the local cache evicts the least recently used entry
+        lru = caching.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual((lru.get('a'), lru.get('b'), lru.get('c')),
+                         (1, None, 3))
+
+    @override_settings(NOTECARDS_INDEX_INTERVAL=None)
+    def test_queued_signal_processor(self):
+        processor = indexing.QueuedSignalProcessor(connections,
+                                                   connection_router)
+        try:
+            user = User.objects.get(username='auser')
+            deck = DeckFactory(author=user)
+            other = DeckFactory(author=user)
+            otherid = other.id
+            # test that only indexed models are queued, once per object
+            CardFactory(deck=deck)
+            deck.tags.add('spanish')
+            deck.published = False
+            deck.save()
+            other.delete()
+            self.assertEqual(processor.pending(),
+                             [(Deck, deck.id, indexing.CARDS),
+                              (Deck, otherid, indexing.DELETE)])
+
+            self.assertEqual(processor.flush(), 2)
+            self.assertEqual(processor.pending(), [])
+
+            # test that changing a deck's cards, one at a time or in bulk,
+            # also updates its linked clones, whose documents hold them
+            clone = cloning.clone_deck(deck,
+                                       User.objects.get(username='buser'))
+            processor.flush()
+            card = CardFactory(deck=deck)
+            self.assertEqual(processor.pending(),
+                             [(Deck, deck.id, indexing.CARDS)])
+            with mock.patch('haystack.signal_processor', processor):
+                processor.flush()
+                card.delete()
+                self.assertEqual(processor.flush(), 2)
+                importing.import_cards(deck, ['new,card'])
+                self.assertEqual(processor.pending(),
+                                 [(Deck, deck.id, indexing.CARDS)])
+                processor.flush()
+                cloning.materialize(clone)
+                self.assertEqual(processor.pending(),
+                                 [(Deck, clone.id, indexing.CARDS)])
+        finally:
+            processor.teardown()
+
+    def test_rebuild_deck_index(self):
+        DeckFactory.create_batch(7)
+        DeckFactory(published=False)
+        for deck in Deck.objects.all():
+            deck.tags.add('a', 'b')
+
+        # test that preparing the index documents doesn't query per deck
+        index = connections['default'].get_unified_index().get_index(Deck)
+        decks = list(index.index_queryset())
+        with self.assertNumQueries(0):
+            for deck in decks:
+                index.full_prepare(deck)
+        self.assertCountEqual(index.prepared_data['tags'], ['a', 'b'])
+
+        out = StringIO()
+        call_command('rebuild_deck_index', chunk_size=3, stdout=out)
+        self.assertIn('Indexed 7 deck(s)', out.getvalue())
+
+    def test_update_deck_index(self):
+        out = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('update_deck_index', stdout=out)
+        decks = DeckFactory.create_batch(5)
+        call_command('rebuild_deck_index', stdout=out)
+
+        # test that only decks changed since the last update are looked at
+        hourAgo = timezone.now() - datetime.timedelta(hours=1)
+        Deck.objects.update(dateModified=hourAgo - datetime.timedelta(hours=1))
+        IndexWatermark.objects.update(dateModified=hourAgo)
+        decks[0].description = 'changed'
+        decks[0].save()
+        decks[1].published = False
+        decks[1].save()
+        deletedId = decks[2].id
+        decks[2].delete()
+        self.assertTrue(DeletedDeck.objects.filter(deck_id=deletedId)
+                                           .exists())
+        call_command('update_deck_index', stdout=out)
+        self.assertIn('Updated 1 deck(s), removed 2 deck(s)', out.getvalue())
+        self.assertGreater(IndexWatermark.objects.get().dateModified,
+                           hourAgo)
+
+    def test_fts5_search_backend(self):
+        connections.connections_info['fts'] = {
+            'ENGINE': 'notecards.fts_backend.FTS5Engine'}
+        try:
+            backend = connections['fts'].get_backend()
+            backend.clear()
+            index = connections['fts'].get_unified_index().get_index(Deck)
+            spanish = DeckFactory(title='Spanish verbs',
+                                  description='conjugation practice')
+            spanish.tags.add('spanish')
+            french = DeckFactory(title='French verbs',
+                                 description='more verbs')
+            french.tags.add('french')
+            backend.update(index, [spanish, french])
+            sqs = SearchQuerySet(using='fts')
+
+            # test that results are ranked and can be filtered by tag
+            results = sqs.auto_query('verbs')
+            self.assertEqual([int(r.pk) for r in results],
+                             [french.id, spanish.id])
+            results = sqs.auto_query('verbs').filter(tags='spanish')
+            self.assertEqual([int(r.pk) for r in results], [spanish.id])
+            results = sqs.auto_query('verbs -french')
+            self.assertEqual([int(r.pk) for r in results], [spanish.id])
+            results = sqs.auto_query('"french verbs"').highlight()
+            self.assertIn('<em>French verbs</em>',
+                          results[0].highlighted['text'][0])
+
+            # test that removed decks can't be found
+            backend.remove(french)
+            results = sqs.auto_query('verbs')
+            self.assertEqual([int(r.pk) for r in results], [spanish.id])
+            backend.clear(models=[Deck])
+            self.assertEqual(sqs.all().count(), 0)
+        finally:
+            del connections.connections_info['fts']
+
+    def test_card_search(self):
+        deck = DeckFactory(title='Spanish verbs')
+        CardFactory(deck=deck, front='verbs: hablar', back='to speak')
+        CardFactory(deck=deck, front='comer', back='to eat')
+
+        # test that card text is indexed with the deck, up to a limit
+        index = connections['default'].get_unified_index().get_index(Deck)
+        text = index.full_prepare(index.index_queryset().get())['text']
+        self.assertIn('hablar', text)
+        self.assertIn('comer', text)
+        with self.settings(NOTECARDS_INDEX_CARDS=1):
+            text = index.full_prepare(index.index_queryset().get())['text']
+        self.assertIn('hablar', text)
+        self.assertNotIn('comer', text)
+
+        # test that results show the matching cards
+        resp = self.client.get(reverse('search'), {'q': 'verbs'})
+        self.assertContains(resp,
+                            '<strong class="highlighted">verbs</strong>')
+        self.assertNotContains(resp, 'comer')
+
+        # test that only the indexed cards are looked through
+        self.assertEqual([card.front for card in
+                          search.matching_cards(deck, 'eat')], ['comer'])
+        with self.settings(NOTECARDS_INDEX_CARDS=1):
+            self.assertEqual(search.matching_cards(deck, 'eat'), [])
+
+    def test_suggest(self):
+        spanish = DeckFactory(title='Spanish verbs')
+        spanish.tags.add('spanish', 'language')
+        DeckFactory(title='Spelling')
+        private = DeckFactory(title='Spanish secrets', published=False)
+        private.tags.add('spy')
+
+        # test that titles match from the start of any word
+        suggestions = typeahead.Suggestions()
+        self.assertEqual(suggestions.suggest('VER')['decks'],
+                         [(spanish.id, 'Spanish verbs')])
+        found = suggestions.suggest('sp')
+        self.assertEqual([title for deckid, title in found['decks']],
+                         ['Spanish verbs', 'Spelling'])
+        self.assertEqual(found['tags'], ['spanish'])
+
+        # test that changes are rebuilt in the background, with the old
+        # index answering until then
+        spanish.title = 'Mexican verbs'
+        spanish.save()
+        suggestions.built = 0
+        with mock.patch.object(suggestions, '_start_rebuild') as rebuild:
+            self.assertEqual(suggestions.suggest('mex')['decks'], [])
+            self.assertEqual(suggestions.suggest('mex')['decks'], [])
+        self.assertEqual(rebuild.call_count, 1)
+        suggestions.rebuild(*rebuild.call_args[0])
+        self.assertEqual(suggestions.suggest('mex')['decks'],
+                         [(spanish.id, 'Mexican verbs')])
+
+        # test that without a shared cache, which would show changes made
+        # by other processes, the index is rebuilt once it's old enough
+        suggestions._rebuilding = False
+        suggestions.built = 0
+        with mock.patch.object(suggestions, '_start_rebuild') as rebuild:
+            suggestions.suggest('mex')
+            with override_settings(NOTECARDS_CACHE='default'):
+                suggestions.rebuild()
+                suggestions.built = 0
+                suggestions.suggest('mex')
+        self.assertEqual(rebuild.call_count, 1)
+
+        typeahead.suggestions = suggestions
+        resp = self.client.get(reverse('suggest'), {'q': 'lang'})
+        self.assertEqual(json.loads(resp.content.decode()),
+                         {'decks': [], 'tags': ['language']})
+
+    def test_request_stats(self):
+        stats.recorded.clear()
+        deck = DeckFactory(title='stats deck')
+        CardFactory(deck=deck)
+        middleware = settings.MIDDLEWARE_CLASSES + \
+            ['notecards.stats.StatsMiddleware']
+        with override_settings(MIDDLEWARE_CLASSES=middleware):
+            with override_settings(NOTECARDS_SLOW_REQUEST=0), \
+                    self.assertLogs('notecards.stats', 'WARNING') as logs:
+                self.client.get(reverse('view_deck'), {'did': deck.id})
+                self.client.get(reverse('decks'))
+                self.client.get(reverse('decks'))
+            # the deck's cards are among the queries logged
+            self.assertIn('notecards_card', logs.output[0])
+
+            # only staff can see the stats
+            self.client.login(username='auser', password='apass')
+            resp = self.client.get(reverse('stats'))
+            self.assertEqual(resp.status_code, 302)
+            User.objects.filter(username='auser').update(is_staff=True)
+            resp = self.client.get(reverse('stats'))
+        summary = json.loads(resp.content.decode())
+        self.assertEqual(summary['requests'], 4)
+        decks = summary['views']['decks']
+        self.assertEqual(decks['requests'], 2)
+        self.assertEqual(sum(count for bound, count in decks['histogram']),
+                         2)
+        self.assertGreater(decks['size'], 0)
+        self.assertGreater(decks['queries']['max'], 0)
+        self.assertEqual(summary['views']['view_deck']['requests'], 1)
+        self.assertGreater(summary['views']['view_deck']['render'], 0)
+
+        # streaming responses are recorded once their content is sent,
+        # along with the queries made sending it, here the deck's cards
+        stats.recorded.clear()
+        with override_settings(MIDDLEWARE_CLASSES=middleware):
+            resp = self.client.get(reverse('export_deck',
+                                           kwargs={'deckid': deck.id}))
+            self.assertEqual(stats.recorded.records(), [])
+            self.assertTrue(connection.force_debug_cursor)
+            content = b''.join(resp.streaming_content)
+        self.assertFalse(connection.force_debug_cursor)
+        record, = stats.recorded.records()
+        self.assertEqual(record['view'], 'export_deck')
+        self.assertEqual(record['size'], len(content))
+        self.assertGreater(record['queries'], 1)
+
+    def test_tag_counts(self):
+        def counts():
+            return dict((name, count) for name, slug, count
+                        in tagging.top_tags(10))
+
+        self.client.login(username='auser', password='apass')
+        self.client.post(reverse('create_deck'),
+                         {'title': 'one', 'tags': 'spanish, verbs'})
+        self.client.post(reverse('create_deck'),
+                         {'title': 'two', 'tags': 'spanish'})
+        self.assertEqual(counts(), {'spanish': 2, 'verbs': 1})
+
+        # test retagging, unpublishing and deleting decks
+        one = Deck.objects.get(title='one')
+        two = Deck.objects.get(title='two')
+        self.client.post(reverse('edit_deck', kwargs={'deckid': one.id}),
+                         {'title': 'one', 'tags': 'verbs, french'})
+        self.assertEqual(counts(), {'spanish': 1, 'verbs': 1, 'french': 1})
+        self.client.post(reverse('publish'), {'did': two.id})
+        self.assertEqual(counts(), {'verbs': 1, 'french': 1})
+        self.client.post(reverse('publish'), {'did': two.id})
+        self.assertEqual(counts(), {'spanish': 1, 'verbs': 1, 'french': 1})
+        self.client.post(reverse('delete_deck'), {'did': two.id})
+        self.assertEqual(counts(), {'verbs': 1, 'french': 1})
+
+        # test that a failed delete doesn't leave tag touches held
+        with mock.patch('notecards.tagging.uncount',
+                        side_effect=RuntimeError):
+            self.assertRaises(RuntimeError, one.delete)
+        self.assertFalse(Deck.touches_held(one.id))
+
+        # test that new tags whose slugs are taken still get free slugs
+        tagging.retag(one, ['verbs', 'french', 'Verbs', 'French'])
+        self.assertEqual(sorted(one.tags.values_list('slug', flat=True)),
+                         ['french', 'french_1', 'verbs', 'verbs_1'])
+        tagging.retag(one, ['verbs', 'french'])
+
+        # test that cloning doesn't count the unpublished clone
+        self.client.login(username='buser', password='bpass')
+        self.client.get(reverse('clone_deck'), {'did': one.id})
+        self.assertEqual(counts(), {'verbs': 1, 'french': 1})
+
+        # test the browse page, the api and the repair command
+        resp = self.client.get(reverse('tags'))
+        self.assertContains(resp, 'french')
+        resp = self.client.get(reverse('get_tag_decks',
+                               kwargs={'slug': 'french'}))
+        self.assertEqual([deck.id for deck in resp.context['decks']],
+                         [one.id])
+        resp = self.client.get(reverse('get_tags'), {'n': 1})
+        self.assertEqual(json.loads(resp.content.decode()),
+                         {'tags': [['french', 'french', 1]]})
+        resp = self.client.get(reverse('get_tags'), {'n': -1})
+        self.assertEqual(json.loads(resp.content.decode()), {'tags': []})
+        TagCount.objects.update(count=5)
+        call_command('repair_tag_counts', stdout=StringIO())
+        self.assertEqual(counts(), {'verbs': 1, 'french': 1})
 
     def test_get_user_deck(self):
         user = User.objects.get(username='auser')
@@ -363,18 +1479,18 @@ class TestNotecardViews(TestCase):
         self.assertTrue(a)
         resp = self.client.get(reverse('get_user_decks',
                                kwargs={'user': 'auser'}))
-        self.assertEquals(resp.context['decks'].count(), 10)
+        self.assertEquals(len(resp.context['decks']), 10)
 
         # Test from different user than deck belongs to
         resp = self.client.get(reverse('get_user_decks',
                                kwargs={'user': 'buser'}))
-        self.assertEquals(resp.context['decks'].count(), 50)
+        self.assertEquals(len(resp.context['decks']), 50)
 
         # Test different user requesting second page
         resp = self.client.get(reverse('get_user_decks',
                                kwargs={'user': 'buser'}),
-                               {'page': 2})
-        self.assertEquals(resp.context['decks'].count(), 25)
+                               {'after': resp.context['next']})
+        self.assertEquals(len(resp.context['decks']), 25)
 
     def test_get_weak_card(self):
         # test user can draw a weak card from get_weak_card view
@@ -399,6 +1515,20 @@ class TestNotecardViews(TestCase):
         resp = self.client.get(reverse('get_weak_card',
                                kwargs={'deckid': deck.id}))
 
+    def test_get_weak_card_threshold(self):
+        # test that the hard mode threshold is configurable
+        deck = DeckFactory()
+        CardFactory.create_batch(5, deck=deck, score=2)
+        CardFactory.create_batch(5, deck=deck, score=5)
+        sampling.rebuild_buckets(deck)
+        for i in range(0, 10):
+            self.assertEqual(sampling.draw_card(deck, maxScore=2).score, 2)
+        self.assertIsNone(sampling.draw_card(deck, maxScore=1))
+
+        with self.settings(NOTECARDS_WEAK_SCORE=5):
+            self.assertEqual(sampling.weak_score(), 5)
+        self.assertEqual(sampling.weak_score(), 3)
+
     def test_publish_deck(self):
         a = self.client.login(username='auser', password='apass')
         self.assertTrue(a)
@@ -427,3 +1557,205 @@ class TestNotecardViews(TestCase):
         resp = self.client.post(reverse('publish'),
                                 {'did': deck.id})
         self.assertEquals(404, resp.status_code)
+
+
+# Answers are queued, so check_answer's budget leaves out grading them
+@override_settings(NOTECARDS_REVIEW_INTERVAL=None)
+class TestQueryBudgets(TestCase):
+    '''
+    Runs every view against small and large decks and listings. A view
+    fails if it makes more queries than its budget or a different number
+    of queries for the large fixture than the small one, whose decks,
+    cards, tags, clones and posted tags all grow with its size, which
+    catches queries made per card, per tag or per deck.
+    '''
+
+    # Most queries each view may make, counting the session and user
+    # lookups of logged in requests
+    budgets = {'index': 0,
+               'get_card': 6,
+               # One query per card drawn, 10 here
+               'get_cards': 15,
+               'get_weak_card': 6,
+               'get_deck': 2,
+               'deck_pack': 5,
+               'export_deck': 2,
+               'export_decks': 4,
+               'check_answer': 5,
+               'check_answers': 17,
+               'create_deck': 25,
+               'create_card': 10,
+               'import_cards': 11,
+               'edit_card': 8,
+               'edit_deck': 27,
+               'view_deck': 4,
+               'decks': 3,
+               'get_user_decks': 4,
+               'clone_deck': 16,
+               'delete_deck': 37,
+               'publish': 12,
+               'search': 5,
+               'suggest': 2,
+               'tags': 1,
+               'get_tag_decks': 4,
+               'get_tags': 1,
+               'stats': 2}
+    # Most queries preparing every deck for the search index may make
+    index_budget = 4
+
+    # Number of cards, tags and decks in each fixture
+    SMALL = 2
+    LARGE = 20
+
+    def setUp(self):
+        auser = User.objects.create_user(username='auser', password='apass')
+        # Only staff can see the stats
+        auser.is_staff = True
+        auser.save()
+        User.objects.create_user(username='buser', password='bpass')
+        User.objects.create_user(username='cuser', password='cpass')
+
+    def _fixture(self, size):
+        # A deck of `size` cards and tags owned by auser with `size` linked
+        # clones, and `size` published decks by buser each with a
+        # published linked clone owned by cuser
+        auser, buser, cuser = User.objects.order_by('id')[:3]
+        deck = DeckFactory(author=auser, title='budget deck')
+        Card.objects.bulk_create(
+            [Card(deck=deck, front='front {0}'.format(i),
+                  back='back {0}'.format(i)) for i in range(size)])
+        deck.touch(size)
+        sampling.rebuild_buckets(deck)
+        tagging.retag(deck, ['tag{0}'.format(i) for i in range(size)])
+        for i in range(size):
+            cloning.clone_deck(deck, User.objects.create_user(
+                username='clone{0}'.format(i)))
+        for i in range(size):
+            other = DeckFactory(author=buser, title='other {0}'.format(i))
+            tagging.retag(other, ['shared'])
+            clone = cloning.clone_deck(other, cuser)
+            tagging.set_published(clone, True)
+        # Nothing is cached from building the fixture
+        caching.get_cache().clear()
+        typeahead.suggestions = typeahead.Suggestions()
+        return deck
+
+    def _request(self, name, deck):
+        # Returns the (username, method, path, data) of a request to the
+        # view with the given URL name
+        cards = list(deck.card_set.values_list('id', flat=True))
+        deckArgs = {'deckid': deck.id}
+        # As many tags as the fixture size, none of which exist yet
+        tags = ', '.join('new{0}'.format(i) for i in range(len(cards)))
+        requests = {
+            'index': (None, 'get', reverse('index'), {}),
+            'get_card': ('auser', 'get', reverse('get_card',
+                                                 kwargs=deckArgs), {}),
+            'get_cards': ('auser', 'get', reverse('get_cards',
+                                                  kwargs=deckArgs),
+                          {'n': 10}),
+            'get_weak_card': ('auser', 'get',
+                              reverse('get_weak_card', kwargs=deckArgs), {}),
+            'get_deck': (None, 'get', reverse('get_deck', kwargs=deckArgs),
+                         {}),
+            'deck_pack': ('auser', 'get', reverse('deck_pack',
+                                                  kwargs=deckArgs), {}),
+            'export_deck': (None, 'get', reverse('export_deck',
+                                                 kwargs=deckArgs), {}),
+            'export_decks': ('auser', 'get', reverse('export_decks'), {}),
+            'check_answer': ('auser', 'post',
+                             reverse('check_answer', kwargs=deckArgs),
+                             {'cardid': cards[0], 'ans': 'wrong'}),
+            'check_answers': ('auser', 'post',
+                              reverse('check_answers', kwargs=deckArgs),
+                              json.dumps({'answers': [[card, 'wrong']
+                                                      for card in cards]})),
+            'create_deck': ('auser', 'post', reverse('create_deck'),
+                            {'title': 'new deck', 'tags': tags}),
+            'create_card': ('auser', 'post',
+                            reverse('create_card', kwargs=deckArgs),
+                            {'front': 'new', 'back': 'card'}),
+            'import_cards': ('auser', 'post',
+                             reverse('import_cards', kwargs=deckArgs),
+                             {'file': SimpleUploadedFile(
+                                 'cards.csv',
+                                 ''.join('{0},{0}\n'.format(card)
+                                         for card in cards).encode())}),
+            'edit_card': ('auser', 'post',
+                          reverse('edit_card', kwargs={'cardid': cards[0]}),
+                          {'editfront': 'edited', 'editback': 'card'}),
+            'edit_deck': ('auser', 'post', reverse('edit_deck',
+                                                   kwargs=deckArgs),
+                          {'title': 'edited deck', 'tags': tags}),
+            'view_deck': (None, 'get', reverse('view_deck'),
+                          {'did': deck.id}),
+            'decks': (None, 'get', reverse('decks'), {}),
+            'get_user_decks': (None, 'get',
+                               reverse('get_user_decks',
+                                       kwargs={'user': 'cuser'}), {}),
+            'clone_deck': ('buser', 'get', reverse('clone_deck'),
+                           {'did': deck.id}),
+            'delete_deck': ('auser', 'post', reverse('delete_deck'),
+                            {'did': deck.id}),
+            'publish': ('auser', 'post', reverse('publish'),
+                        {'did': deck.id}),
+            'search': (None, 'get', reverse('search'), {'q': 'deck'}),
+            'suggest': (None, 'get', reverse('suggest'), {'q': 'o'}),
+            'tags': (None, 'get', reverse('tags'), {}),
+            'get_tag_decks': (None, 'get',
+                              reverse('get_tag_decks',
+                                      kwargs={'slug': 'shared'}), {}),
+            'get_tags': (None, 'get', reverse('get_tags'), {}),
+            'stats': ('auser', 'get', reverse('stats'), {})}
+        return requests[name]
+
+    def _queries(self, name, size):
+        # Counts the queries the view makes against a fixture of the given
+        # size, which is rolled back afterwards
+        with transaction.atomic():
+            deck = self._fixture(size)
+            username, method, path, data = self._request(name, deck)
+            if username is not None:
+                self.client.login(username=username,
+                                  password=username[0] + 'pass')
+            kwargs = {}
+            if isinstance(data, str):
+                kwargs['content_type'] = 'application/json'
+            with CaptureQueriesContext(connection) as queries:
+                resp = getattr(self.client, method)(path, data, **kwargs)
+                if resp.streaming:
+                    b''.join(resp.streaming_content)
+            self.assertLess(resp.status_code, 400, name)
+            self.client.logout()
+            reviewing.buffered.flush()
+            transaction.set_rollback(True)
+        return len(queries)
+
+    def test_every_view_has_a_budget(self):
+        names = [pattern.name for pattern in urls.urlpatterns]
+        self.assertEqual(sorted(names), sorted(self.budgets))
+
+    def test_query_budgets(self):
+        for name, budget in sorted(self.budgets.items()):
+            with self.subTest(view=name):
+                small = self._queries(name, self.SMALL)
+                large = self._queries(name, self.LARGE)
+                self.assertEqual(large, small,
+                                 'Queries change with the fixture size')
+                self.assertLessEqual(large, budget,
+                                     'Over the query budget')
+
+    def test_index_query_budget(self):
+        index = connections['default'].get_unified_index().get_index(Deck)
+        counts = []
+        for size in (self.SMALL, self.LARGE):
+            with transaction.atomic():
+                self._fixture(size)
+                with CaptureQueriesContext(connection) as queries:
+                    for deck in index.index_queryset():
+                        index.full_prepare(deck)
+                counts.append(len(queries))
+                transaction.set_rollback(True)
+        small, large = counts
+        self.assertEqual(large, small)
+        self.assertLessEqual(large, self.index_budget)
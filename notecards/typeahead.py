@@ -0,0 +1,175 @@
+'''
+Suggestions for the search box.
+
+Published deck titles and tag names are kept in memory as sorted lists of
+lower cased keys, so the suggestions for what the user has typed so far
+are found with a binary search instead of a search query. Titles are
+indexed from the start of each word, so typing 'verbs' suggests 'Spanish
+verbs'.
+
+The lists are rebuilt when decks or tags change. Changes bump a
+generation number in the cache (see notecards.caching) that every process
+checks before answering, and a process rebuilds at most once every
+REFRESH_INTERVAL seconds however often decks change. Without a shared
+cache a process only sees its own changes, so it rebuilds every
+REFRESH_INTERVAL seconds whether or not the generation changed.
+
+Rebuilds after the first run in a background thread, and the old lists
+keep answering until the new ones are swapped in, so no request waits on
+reading every deck.
+'''
+import bisect
+import logging
+import threading
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from taggit.models import TaggedItem
+
+from notecards import caching
+from notecards.models import Deck
+
+
+logger = logging.getLogger(__name__)
+
+# Most suggestions of each kind returned
+MAX_SUGGESTIONS = 8
+# Fewest seconds between rebuilds of a process's index
+REFRESH_INTERVAL = 5
+
+GENERATION_KEY = 'notecards:typeahead:generation'
+
+
+def _key(text):
+    return text.casefold()
+
+
+class PrefixIndex(object):
+    '''
+    Sorted (key, value) pairs that can be searched by the start of the key.
+    '''
+
+    def __init__(self, pairs):
+        pairs = sorted(pairs)
+        self.keys = [key for key, value in pairs]
+        self.values = [value for key, value in pairs]
+
+    def search(self, prefix, limit=MAX_SUGGESTIONS):
+        '''
+        Returns up to `limit` distinct values whose key starts with the
+        prefix, in key order.
+        '''
+        prefix = _key(prefix)
+        found = []
+        start = bisect.bisect_left(self.keys, prefix)
+        for position in range(start, len(self.keys)):
+            if not self.keys[position].startswith(prefix):
+                break
+            value = self.values[position]
+            if value not in found:
+                found.append(value)
+                if len(found) == limit:
+                    break
+        return found
+
+
+class Suggestions(object):
+    '''Prefix indexes of published deck titles and tag names.'''
+
+    def __init__(self):
+        self.generation = None
+        self.built = 0
+        # The deck and tag indexes, swapped together
+        self.indexes = (PrefixIndex([]), PrefixIndex([]))
+        self._lock = threading.Lock()
+        self._rebuilding = False
+
+    def _build(self):
+        pairs = []
+        titles = Deck.objects.filter(published=True) \
+                             .values_list('id', 'title') \
+                             .iterator()
+        for deckid, title in titles:
+            words = title.split()
+            for start in range(len(words)):
+                pairs.append((_key(' '.join(words[start:])), (deckid, title)))
+        decks = PrefixIndex(pairs)
+        # Only tags on published decks are suggested
+        tagged = TaggedItem.objects.filter(
+            content_type=ContentType.objects.get_for_model(Deck),
+            object_id__in=Deck.objects.filter(published=True).values('id'))
+        names = tagged.values_list('tag__name', flat=True).distinct()
+        return decks, PrefixIndex((_key(name), name) for name in names)
+
+    def rebuild(self, generation=None):
+        '''Builds the indexes and swaps them in for the old ones.'''
+        if generation is None:
+            generation = caching.get_cache().get(GENERATION_KEY, 0)
+        self.indexes = self._build()
+        self.generation = generation
+        self.built = time.time()
+
+    def refresh(self):
+        '''
+        Rebuilds the indexes if decks or tags have changed, or might have
+        in another process, in the background unless there's nothing
+        built yet.
+        '''
+        generation = caching.get_cache().get(GENERATION_KEY, 0)
+        if generation == self.generation and caching.is_shared():
+            return
+        if self.generation is None:
+            with self._lock:
+                if self.generation is None:
+                    self.rebuild(generation)
+            return
+        if time.time() - self.built < REFRESH_INTERVAL:
+            return
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        self._start_rebuild(generation)
+
+    def _start_rebuild(self, generation):
+        thread = threading.Thread(target=self._rebuild_in_background,
+                                  args=(generation,),
+                                  name='notecards-typeahead')
+        thread.daemon = True
+        thread.start()
+
+    def _rebuild_in_background(self, generation):
+        try:
+            self.rebuild(generation)
+        except Exception:
+            logger.exception('Could not rebuild the search suggestions')
+            # Wait out the interval before trying again
+            self.built = time.time()
+        finally:
+            self._rebuilding = False
+            connection.close()
+
+    def suggest(self, prefix, limit=MAX_SUGGESTIONS):
+        '''
+        Returns a dict with up to `limit` published 'decks', as (id, title)
+        pairs, and 'tags' whose text starts with the prefix.
+        '''
+        self.refresh()
+        decks, tags = self.indexes
+        return {'decks': decks.search(prefix, limit),
+                'tags': tags.search(prefix, limit)}
+
+
+suggestions = Suggestions()
+
+
+def invalidate():
+    '''Marks every process's suggestions as out of date.'''
+    cache = caching.get_cache()
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        # incr fails when the key has been evicted or was never set
+        cache.set(GENERATION_KEY, int(time.time() * 1000), None)
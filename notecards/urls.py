@@ -1,6 +1,6 @@
 from django.conf.urls import url, include
 from django.contrib.auth import views as auth_views
-from notecards import views
+from notecards import search, views
 
 urlpatterns = [
                  url(r'^$',
@@ -9,21 +9,39 @@ urlpatterns = [
                  url(r'^get_card/(?P<deckid>[0-9]+)/$',
                      views.get_card,
                      name='get_card'),
+                 url(r'^get_cards/(?P<deckid>[0-9]+)/$',
+                     views.get_cards,
+                     name='get_cards'),
                  url(r'^gwc/(?P<deckid>[0-9]+)/$',
                      views.get_weak_card,
                      name='get_weak_card'),
                  url(r'^get_deck/(?P<deckid>[0-9]+)/$',
                      views.get_deck,
                      name='get_deck'),
+                 url(r'^export_deck/(?P<deckid>[0-9]+)/$',
+                     views.export_deck,
+                     name='export_deck'),
+                 url(r'^export_decks/$',
+                     views.export_decks,
+                     name='export_decks'),
+                 url(r'^deck_pack/(?P<deckid>[0-9]+)/$',
+                     views.get_deck_pack,
+                     name='deck_pack'),
                  url(r'^check_answer/(?P<deckid>[0-9]+)/$',
                      views.check_answer,
                      name='check_answer'),
+                 url(r'^check_answers/(?P<deckid>[0-9]+)/$',
+                     views.check_answers,
+                     name='check_answers'),
                  url(r'^create_deck/$',
                      views.create_deck,
                      name='create_deck'),
                  url(r'^create_card/(?P<deckid>[0-9]+)/$',
                      views.create_card,
                      name='create_card'),
+                 url(r'^import_cards/(?P<deckid>[0-9]+)/$',
+                     views.import_cards,
+                     name='import_cards'),
                  url(r'^edit_card/(?P<cardid>[0-9]+)/$',
                      views.edit_card,
                      name='edit_card'),
@@ -48,4 +66,22 @@ urlpatterns = [
                  url(r'^publish/$',
                      views.publish_deck,
                      name='publish'),
+                 url(r'^search/$',
+                     search.deck_search,
+                     name='search'),
+                 url(r'^suggest/$',
+                     views.suggest,
+                     name='suggest'),
+                 url(r'^tags/$',
+                     views.view_tags,
+                     name='tags'),
+                 url(r'^tags/(?P<slug>[\w\-]+)/$',
+                     views.get_tag_decks,
+                     name='get_tag_decks'),
+                 url(r'^get_tags/$',
+                     views.get_tags,
+                     name='get_tags'),
+                 url(r'^stats/$',
+                     views.get_stats,
+                     name='stats'),
                  ]
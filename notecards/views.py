@@ -1,91 +1,178 @@
+import datetime
+import itertools
 import json
-import random
+import math
+import time
+import zlib
 
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth.models import User
-from django.core import serializers
+from django.core.exceptions import ValidationError
 from django.core.urlresolvers import reverse
-from django.db.models import Max, Min
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import (Http404, HttpResponse, HttpResponseRedirect,
+                         StreamingHttpResponse)
 from django.shortcuts import render, get_object_or_404
-
-from notecards.forms import deckForm, cardForm
-from notecards.models import Deck, Card
+from django.template.loader import render_to_string
+from django.utils import timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from taggit.models import Tag
+
+from notecards import (caching, cloning, exporting, grading, importing,
+                       pagination, reviewing, sampling, stats, tagging,
+                       typeahead)
+from notecards.forms import deckForm, cardForm, importForm
+from notecards.models import Deck, Card, CardProgress
+
+
+# Most cards the drill page can request at once
+CARD_BATCH_LIMIT = 50
+# Most answers that can be graded in one request
+ANSWER_BATCH_LIMIT = 1000
+# Most bytes a gzipped batch of answers can unpack to
+MAX_ANSWERS_SIZE = 1024 * 1024
+# Most tags listed on the tag page
+TAG_LIMIT = 200
+# Longest response time in milliseconds logged for an answer, anything
+# longer says more about the user leaving the page than the card
+MAX_RESPONSE_TIME = 60 * 60 * 1000
+# Oldest in milliseconds an offline answer can say it is, older answers
+# are logged as this old
+MAX_ANSWER_AGE = 365 * 24 * 60 * 60 * 1000
+
+
+def _gunzip(data, limit):
+    # Stops unpacking at the limit rather than trusting the sender
+    unpacker = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    unpacked = unpacker.decompress(data, limit)
+    if unpacker.unconsumed_tail:
+        raise ValueError('Body too large')
+    return unpacked
+
+
+def _response_time(value):
+    try:
+        value = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return value if 0 <= value <= MAX_RESPONSE_TIME else None
+
+
+def _answered_at(value, now):
+    # Offline answers say when they were given in milliseconds since the
+    # epoch, which is turned into a time relative to now so that a wrong
+    # clock can't put them in the future
+    try:
+        age = time.time() * 1000 - float(value)
+    except (TypeError, ValueError):
+        return now
+    if math.isnan(age):
+        return now
+    age = min(max(0, age), MAX_ANSWER_AGE)
+    return now - datetime.timedelta(milliseconds=age)
 
 
 @login_required
 def check_answer(request, deckid):
     '''
     Checks whether the user's answer for a flashcard is correct or not.
-    If not, the card's score is set to 0. If it is, a point is added up
-    to a maximum of 5 points.
+    If not, the card's score is set to 1. If it is, a point is added up
+    to a maximum of 5 points. The answer is logged, along with the
+    milliseconds the user took to answer if sent as 'time', and the score
+    changed a few seconds later (see notecards.reviewing).
     Returns JSON data indicating whether the answer was wrong or correct.
     '''
-    # Get information about the card presented to the user
-    deck = get_object_or_404(Deck, pk=deckid)
+    # Get information about the card presented to the user. Only the
+    # deck's owner can change its scores
+    deck = get_object_or_404(Deck, pk=deckid, author_id=request.user.id)
     cardid = request.POST.get('cardid')
-    card = Card.objects.get(pk=cardid)
-    front = card.front
-    retResp = {'answer': card.back, 'result': 'wrong'}
-    # Get user's answer as well as all cards they might have possibly
-    # thought they were being presented with. We give the user the
-    # benefit of a doubt.
+    card = get_object_or_404(Card, pk=cardid, deck_id=deck.content_id)
+    # Get user's answer. Any card in the deck with the same front counts,
+    # we give the user the benefit of a doubt.
     userAnswer = request.POST.get('ans')
-    answerCards = Card.objects.filter(deck=deck, front=front)
-    for ans in answerCards:
-        # For any card that matches the answer given, add 1 point
-        if ans.back == userAnswer:
-            if ans.score < 5:
-                ans.score += 1
-                ans.save()
-            retResp['result'] = 'correct'
-    if retResp['result'] == 'wrong':
-        # If user's answer didn't match anything, then reset the
-        # presented card's points
-        answerCards.update(score=1)
+    result = grading.check_answer(deck, card, userAnswer)
+    reviewing.buffered.enqueue(deck, request.user.id, card.id, userAnswer,
+                               _response_time(request.POST.get('time')))
+    retResp = {'answer': card.back, 'result': result}
     jsonResp = json.dumps(retResp)
 
     return HttpResponse(jsonResp, content_type='application/json')
 
 
+@login_required
+def check_answers(request, deckid):
+    '''
+    Accepts a POST request whose body is JSON of the form
+    {"answers": [[cardid, answer], ...]} and grades all of the answers,
+    in order, the same way check_answer does but straight away. Answers
+    can also give the milliseconds the user took to answer and when they
+    answered, in milliseconds since the epoch, as
+    [cardid, answer, time, answeredAt].
+    Returns JSON of the form
+    {"results": [{"cardid": ..., "result": ..., "answer": ...}, ...],
+     "scores": {cardid: score, ...}, "version": ...}
+    with the new score of every card graded, which is how the offline
+    drill syncs. Clients holding a copy of the deck send its "version"
+    with the answers, and get back the deck's new version if their copy
+    was up to date or null if it wasn't. The body may be gzipped, with a
+    Content-Encoding header saying so.
+    '''
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    userid = request.user.id
+    user = User.objects.get(pk=userid)
+    deck = get_object_or_404(Deck, pk=deckid, author=user)
+    try:
+        body = request.body
+        if request.META.get('HTTP_CONTENT_ENCODING') == 'gzip':
+            body = _gunzip(body, MAX_ANSWERS_SIZE)
+        batch = json.loads(body.decode('utf-8'))
+        answers = []
+        reviews = []
+        now = timezone.now()
+        for entry in batch['answers']:
+            cardid, ans = entry[:2]
+            responseTime, answeredAt = (list(entry[2:4]) + [None, None])[:2]
+            answers.append((int(cardid), str(ans)))
+            reviews.append((userid,
+                            _answered_at(answeredAt, now),
+                            _response_time(responseTime)))
+    except (ValueError, KeyError, TypeError, OverflowError, zlib.error):
+        return HttpResponse('Invalid answers', status=400)
+    if len(answers) > ANSWER_BATCH_LIMIT:
+        return HttpResponse('Too many answers', status=400)
+    current = batch.get('version') == _pack_etag(request, deckid)
+    results, scores = grading.sync_answers(deck, answers, reviews)
+    version = None
+    if current:
+        # The client's copy of the deck is only up to date if nothing
+        # else changed it before these answers
+        del request.deckVersion
+        version = _pack_etag(request, deckid)
+    jsonResp = json.dumps({'results': results,
+                           'scores': scores,
+                           'version': version})
+
+    return HttpResponse(jsonResp, content_type='application/json')
+
+
 @login_required
 def clone_deck(request):
     '''Creates a copy of a user's deck for another user to own.'''
     deckid = request.GET.get('did')
     userID = request.user.id
     user = User.objects.get(pk=userID)
-    deck = Deck.objects.get(pk=deckid)
-    # Make sure user isn't trying to clone their own deck
-    if deck.author != user:
-        newDeck, created = Deck.objects.get_or_create(author=user,
-                                                      title=deck.title)
-        # Check to make sure that user doesn't already have a deck the
-        # same title
-        if not created:
-            return HttpResponse('Error: You already own a deck with '
-                                'this title')
-        # Copy the deck
-        newDeck.slug = deck.slug
-        newDeck.description = deck.description
-        newDeck.published = False
-        newDeck.save()
-        # Copy the tags
-        tags = deck.tags.names()
-        for tag in tags:
-            newDeck.tags.add(tag)
-        newDeck.save()
-        # Copy the cards
-        for card in deck.card_set.all():
-            newCard = Card(front=card.front,
-                           back=card.back,
-                           deck=newDeck,
-                           score=0)
-            newCard.save()
-        # Redirect user to their newly cloned deck
-        url = reverse('view_deck') + '?did=' + str(newDeck.id)
-        return HttpResponseRedirect(url)
-    else:
-        return HttpResponse('Error: You already own this deck')
+    deck = get_object_or_404(Deck, pk=deckid)
+    try:
+        newDeck = cloning.clone_deck(deck, user)
+    except ValidationError as e:
+        # The user already owns this deck, a deck with the same title or
+        # too many decks
+        return HttpResponse('Error: ' + ' '.join(e.messages))
+    # Redirect user to their newly cloned deck
+    url = reverse('view_deck') + '?did=' + str(newDeck.id)
+    return HttpResponseRedirect(url)
 
 
 @login_required
@@ -103,8 +190,12 @@ def create_card(request, deckid):
         if form.is_valid():
             front = form.cleaned_data['front']
             back = form.cleaned_data['back']
+            # Linked clones get their own copy of the cards before they
+            # can be changed
+            cloning.materialize(deck)
             card = Card(front=front, back=back, deck=deck)
             card.save()
+            sampling.add_cards(deck, [card.score])
             # Card goes into a select box so we use the <option> tag
             content = '<option>{0} -- {1}</option>'.format(front, back)
             return HttpResponse(status=201,
@@ -129,8 +220,7 @@ def create_deck(request):
             desc = form.cleaned_data['description']
             deck = Deck(author=user, title=title, description=desc)
             deck.save()
-            for tag in form.cleaned_data['tags']:
-                deck.tags.add(tag)
+            tagging.retag(deck, form.cleaned_data['tags'])
             deck.save()
             return HttpResponseRedirect(reverse('decks'))
         else:
@@ -182,6 +272,14 @@ def edit_card(request, cardid):
     card = Card.objects.get(pk=cardid)
     userID = request.user.id
     user = User.objects.get(pk=userID)
+    if card.deck.author != user:
+        # The card may belong to the source of one of the user's linked
+        # clones, in which case the clone gets its own copy of the cards
+        # and the copy of this card is changed instead
+        clone = Deck.objects.filter(author=user, source=card.deck).first()
+        if clone is not None:
+            cardids = cloning.materialize(clone)
+            card = Card.objects.get(pk=cardids[card.id])
     if card.deck.author == user:
         if request.method == 'POST':
             # Replace the old card info with new info
@@ -203,6 +301,7 @@ def edit_card(request, cardid):
                                     content_type='text/html')
         elif request.method == 'DELETE':
             card.delete()
+            sampling.remove_cards(card.deck, [card.score])
             return HttpResponse(status=200)
 
 
@@ -220,14 +319,48 @@ def edit_deck(request, deckid):
         if form.is_valid():
             deck.title = form.cleaned_data['title']
             deck.description = form.cleaned_data['description']
-            deck.tags.clear()
-            for tag in form.cleaned_data['tags']:
-                deck.tags.add(tag)
+            tagging.retag(deck, form.cleaned_data['tags'])
             deck.save()
             queryParam = '?did={0}'.format(deckid)
             return HttpResponseRedirect(reverse('view_deck') + queryParam)
 
 
+def export_deck(request, deckid):
+    '''
+    Streams a deck's cards as a file to download, in the format given by
+    the 'format' parameter: 'csv' (the default), 'jsonl' or 'anki'.
+    Only the deck's author can export an unpublished deck.
+    '''
+    format = request.GET.get('format', 'csv')
+    if format not in exporting.FORMATS:
+        return HttpResponse(status=400)
+    deck = get_object_or_404(Deck, pk=deckid)
+    if not deck.published and deck.author_id != request.user.id:
+        raise Http404('No such deck')
+    write, extension, contentType = exporting.FORMATS[format]
+    response = StreamingHttpResponse(write(deck.cards()),
+                                     content_type=contentType)
+    response['Content-Disposition'] = 'attachment; filename="{0}"'.format(
+        exporting.filename(deck, format))
+    return response
+
+
+@login_required
+def export_decks(request):
+    '''
+    Streams a zip archive of all the user's decks, with one file per deck
+    in the format given by the 'format' parameter (see export_deck).
+    '''
+    format = request.GET.get('format', 'csv')
+    if format not in exporting.FORMATS:
+        return HttpResponse(status=400)
+    decks = Deck.objects.filter(author_id=request.user.id).order_by('id')
+    response = StreamingHttpResponse(exporting.archive(decks, format),
+                                     content_type='application/zip')
+    response['Content-Disposition'] = 'attachment; filename="decks.zip"'
+    return response
+
+
 @login_required
 def get_card(request, deckid):
     '''
@@ -236,20 +369,12 @@ def get_card(request, deckid):
     # Get information necessary to determine which deck to pull from
     userid = request.user.id
     user = User.objects.get(pk=userid)
-    deck = Deck.objects.filter(pk=deckid, author=user)
+    deck = get_object_or_404(Deck, pk=deckid, author=user)
+    # Randomly select a card to draw, biasing towards weaker cards. The
+    # deck's score histogram keeps this from having to load the deck.
+    card = sampling.draw_card(deck)
     # Make sure deck actually has cards in it
-    if deck.count() > 0 and deck[0].card_set.count() > 0:
-        # Randomly select a card to draw, biasing towards weaker cards
-        minScore = deck.aggregate(Min('card__score'))
-        minScore = minScore['card__score__min']
-        maxScore = deck.aggregate(Max('card__score'))
-        maxScore = maxScore['card__score__max']
-        rscore = random.randint(minScore, maxScore)
-        deck = deck[0]
-        cards = deck.card_set.filter(score__lte=rscore)
-        rindex = random.randint(0, len(cards) - 1)
-        card = cards[rindex]
-
+    if card is not None:
         # 'mode' is used in the template to build the URL for fetching
         # the next card.
         context_dict = {'card': card, 'deck': deck, 'mode': 'get_card/'}
@@ -259,46 +384,142 @@ def get_card(request, deckid):
         return HttpResponse(status=404)
 
 
+@login_required
+def get_cards(request, deckid):
+    '''
+    Fetches a batch of cards for the drill page to queue up.
+    GET parameters: 'n' is the number of cards wanted (at most
+    CARD_BATCH_LIMIT) and 'hard' selects hard mode when present.
+    Returns JSON of the form {"cards": [[id, front], ...]}.
+    '''
+    userid = request.user.id
+    user = User.objects.get(pk=userid)
+    deck = get_object_or_404(Deck, pk=deckid, author=user)
+    try:
+        num = int(request.GET.get('n', CARD_BATCH_LIMIT))
+    except ValueError:
+        return HttpResponse(status=400)
+    num = max(0, min(num, CARD_BATCH_LIMIT))
+    if request.GET.get('hard'):
+        cards = sampling.draw_cards(deck, num,
+                                    maxScore=sampling.weak_score())
+    else:
+        cards = sampling.draw_cards(deck, num)
+    jsonResp = json.dumps({'cards': [[card.id, card.front]
+                                     for card in cards]})
+
+    return HttpResponse(jsonResp, content_type='application/json')
+
+
+def _deck_version(request, deckid):
+    # The parts of a deck that say whether its cards have changed. Kept on
+    # the request so the conditional GET checks and the view share a query.
+    if not hasattr(request, 'deckVersion'):
+        request.deckVersion = Deck.objects.filter(pk=deckid) \
+            .values('id', 'source_id', 'version', 'dateModified',
+                    'score_version', 'dateScored', 'source__version',
+                    'source__dateModified', 'source__score_version',
+                    'source__dateScored') \
+            .first()
+    return request.deckVersion
+
+
+def _deck_etag(request, deckid):
+    deck = _deck_version(request, deckid)
+    if deck is None:
+        return None
+    # Linked clones show their source deck's cards, so its version counts
+    return '{0}-{1}-{2}'.format(deck['id'],
+                                deck['version'],
+                                deck['source__version'] or 0)
+
+
+def _pack_etag(request, deckid):
+    # Offline drills also hold the owner's scores
+    etag = _deck_etag(request, deckid)
+    if etag is None:
+        return None
+    return '{0}-{1}'.format(etag, request.deckVersion['score_version'])
+
+
+def _scored(deck):
+    # Prefix of the fields saying when the scores stored on the deck's
+    # cards changed, which are the source deck's for a linked clone
+    return 'source__' if deck['source_id'] else ''
+
+
+def _cards_etag(request, deckid):
+    # The cards hold their scores
+    etag = _deck_etag(request, deckid)
+    if etag is None:
+        return None
+    deck = request.deckVersion
+    return '{0}-{1}'.format(etag, deck[_scored(deck) + 'score_version'])
+
+
+def _deck_last_modified(request, deckid):
+    deck = _deck_version(request, deckid)
+    if deck is None:
+        return None
+    return max(filter(None, [deck['dateModified'],
+                             deck['source__dateModified'],
+                             deck[_scored(deck) + 'dateScored']]))
+
+
+@condition(etag_func=_cards_etag, last_modified_func=_deck_last_modified)
 def get_deck(request, deckid):
     '''
-    Returns all cards in a deck in JSON format
+    Returns all cards in a deck in JSON format. The cards are streamed
+    rather than built up in memory, and clients that send back the ETag
+    or Last-Modified date get a 304 if the cards and their scores haven't
+    changed.
     '''
-    deck = get_object_or_404(Deck, pk=deckid)
-    cards = deck.card_set.all()
-    cardsJSON = serializers.serialize('json', cards)
+    deck = _deck_version(request, deckid)
+    if deck is None:
+        raise Http404('No such deck')
+    cards = Card.objects.filter(deck_id=deck['source_id'] or deck['id'])
+    cardsJSON = exporting.json_cards(cards)
 
-    return HttpResponse(cardsJSON, content_type='application/json')
+    return StreamingHttpResponse(cardsJSON, content_type='application/json')
+
+
+@login_required
+@condition(etag_func=_pack_etag)
+def get_deck_pack(request, deckid):
+    '''
+    Returns everything the offline drill needs to drill a deck: JSON of
+    the form {"version": ..., "weak": ..., "cards": [[id, front, back,
+    score], ...]} with the owner's scores and the weakness threshold for
+    hard mode. Clients that send back the version as an ETag get a 304 if
+    nothing has changed since.
+    '''
+    deck = get_object_or_404(Deck, pk=deckid, author_id=request.user.id)
+    scores = None
+    if deck.source_id:
+        progress = CardProgress.objects.filter(deck=deck)
+        scores = dict(progress.values_list('card_id', 'score'))
+    header = '{{"version": {0}, "weak": {1}, "cards": '.format(
+        json.dumps(_pack_etag(request, deckid)), sampling.weak_score())
+    content = itertools.chain([header],
+                              exporting.pack_cards(deck.cards(), scores),
+                              ['}'])
+    response = StreamingHttpResponse(content,
+                                     content_type='application/json')
+    # Always check with the server, the version says whether to download
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 def get_decks(request):
     '''
     Fetches a maximum of 50 decks to display to the user in order of
-    creation date.
+    creation date. Pages after the first are selected with the 'after'
+    and 'before' cursors handed out in the page's links.
     Returns a page populated with rows of said decks.
     '''
-    page = request.GET.get('page')
-    if page:
-        page = int(page)
-    else:
-        # Default to 1st page if no page number present in GET request
-        page = 1
-    if page > 0:
-        start = (page - 1) * 50
-        end = start + 50
-        # Only fetch published decks
-        decks = Deck.objects.filter(published=True) \
-                            .order_by('-dateCreated')[start:end]
-        # last is a boolean that tells the template not to render the
-        # 'next' button if we're already on the last page as indicated
-        # by getting fewer than 50 decks in the query
-        last = len(decks) < 50
-
-        return render(request, 'notecards/decks.html', {'decks': decks,
-                                                        'next': page + 1,
-                                                        'prev': page - 1,
-                                                        'lastpg': last})
-    else:
-        return HttpResponse('Invalid page number')
+    # Only fetch published decks
+    decks = Deck.objects.filter(published=True)
+    return _render_decks(request, decks)
 
 
 def get_user_decks(request, user):
@@ -308,41 +529,97 @@ def get_user_decks(request, user):
     Returns a page populated with rows of said decks.
     '''
     if request.method == 'GET':
-        user = User.objects.get(username=user)
-        page = request.GET.get('page')
-        if page:
-            page = int(page)
-        else:
-            page = 1
-        if page > 0:
-            start = (page - 1) * 50
-            end = start + 50
-            decks = Deck.objects.filter(author=user) \
-                                .order_by('-dateCreated')[start:end]
-            last = len(decks) < 50
-
-            return render(request, 'notecards/decks.html', {'decks': decks,
-                                                            'next': page + 1,
-                                                            'prev': page - 1,
-                                                            'lastpg': last})
-        else:
-            return HttpResponse('Invalid page number')
+        user = get_object_or_404(User, username=user)
+        decks = Deck.objects.filter(author=user)
+        return _render_decks(request, decks)
+
+
+def _render_decks(request, decks):
+    # Pages the listing with only the columns that say whether a deck has
+    # changed, then takes the rendered rows from the cache if none have.
+    # Rows are rendered along with everything they show, so rendering
+    # doesn't go back to the database per deck.
+    versions = decks.select_related('source') \
+                    .only('id', 'dateCreated', 'dateModified', 'version',
+                          'source', 'source__version',
+                          'source__dateModified')
+    try:
+        decks, nextCursor, prevCursor = pagination.page_decks(
+            versions,
+            after=request.GET.get('after'),
+            before=request.GET.get('before'))
+    except ValueError:
+        return HttpResponse('Invalid page')
+
+    def render_rows():
+        rows = Deck.objects.filter(pk__in=[deck.id for deck in decks]) \
+                           .select_related('author', 'source') \
+                           .prefetch_related('tags')
+        byId = dict((deck.id, deck) for deck in rows)
+        return render_to_string('notecards/deck_template.html',
+                                {'decks': [byId[deck.id] for deck in decks
+                                           if deck.id in byId]})
+    rows = caching.cached('deck-rows',
+                          [caching.deck_version(deck) for deck in decks],
+                          render_rows)
+
+    # 'next' and 'prev' are the cursors for the neighbouring pages, the
+    # template doesn't render a button for pages that don't exist
+    return render(request, 'notecards/decks.html', {'decks': decks,
+                                                    'rows': rows,
+                                                    'next': nextCursor,
+                                                    'prev': prevCursor})
+
+
+@user_passes_test(lambda user: user.is_staff)
+def get_stats(request):
+    '''
+    Returns JSON statistics of the requests recently handled by this
+    process, per view (see notecards.stats). Staff only.
+    '''
+    response = HttpResponse(json.dumps(stats.summary()),
+                            content_type='application/json')
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+def get_tags(request):
+    '''
+    Returns the tags with the most published decks in JSON format, as
+    [name, slug, number of decks] lists. At most 'n' tags are returned.
+    '''
+    try:
+        num = max(0, min(int(request.GET.get('n', TAG_LIMIT)), TAG_LIMIT))
+    except ValueError:
+        return HttpResponse(status=400)
+    jsonResp = json.dumps({'tags': [list(tag)
+                                    for tag in tagging.top_tags(num)]})
+    return HttpResponse(jsonResp, content_type='application/json')
+
+
+def get_tag_decks(request, slug):
+    '''
+    Fetches a maximum of 50 published decks with the tag, in order of
+    creation date.
+    Returns a page populated with rows of said decks.
+    '''
+    tag = get_object_or_404(Tag, slug=slug)
+    decks = Deck.objects.filter(published=True, tags=tag)
+    return _render_decks(request, decks)
 
 
 @login_required
 def get_weak_card(request, deckid):
     '''
-    Fetches a card with a score of 3 or less to be presented to the user.
+    Fetches a card with a score at or below the weakness threshold
+    (NOTECARDS_WEAK_SCORE, 3 by default) to be presented to the user.
     '''
     userid = request.user.id
     user = User.objects.get(pk=userid)
     deck = get_object_or_404(Deck, pk=deckid, author=user)
-    cards = deck.card_set.filter(score__lte=3)
-    if cards.count() > 0:
-        # If we have any weak cards then draw a random one
-        rindex = random.randint(0, len(cards) - 1)
-        card = cards[rindex]
-
+    # If we have any weak cards then draw a random one
+    card = sampling.draw_card(deck, maxScore=sampling.weak_score())
+    if card is not None:
         # 'mode' is used in the template to build the URL for fetching
         # the next card
         context_dict = {'card': card, 'deck': deck, 'mode': 'gwc/'}
@@ -352,6 +629,27 @@ def get_weak_card(request, deckid):
         return HttpResponse(status=404)
 
 
+@login_required
+def import_cards(request, deckid):
+    '''
+    Accepts a POST request with a CSV or tab separated file of cards, one
+    card per row, and adds them to the deck.
+    Returns JSON of the form
+    {"imported": ..., "failed": ..., "errors": [[line, message], ...]}.
+    '''
+    if request.method != 'POST':
+        return HttpResponse(status=405)
+    deck = get_object_or_404(Deck, pk=deckid, author_id=request.user.id)
+    form = importForm(request.POST, request.FILES)
+    if not form.is_valid():
+        return HttpResponse(json.dumps({'errors': form.errors}),
+                            status=400,
+                            content_type='application/json')
+    lines = importing.decode(form.cleaned_data['file'])
+    result = importing.import_cards(deck, lines)
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
 def index(request):
     '''
     Simply returns the home page
@@ -370,27 +668,82 @@ def publish_deck(request):
         deckID = request.POST.get('did')
         deck = get_object_or_404(Deck, pk=deckID)
         if deck.author == user:
-            deck.published = not deck.published
-            deck.save()
+            tagging.set_published(deck, not deck.published)
             return HttpResponse(status=200)
     return HttpResponse(status=404)
 
 
+def suggest(request):
+    '''
+    Returns JSON suggestions for the search box: the published 'decks', as
+    [id, title] pairs, and 'tags' starting with the text typed so far.
+    '''
+    prefix = request.GET.get('q', '').strip()
+    found = {'decks': [], 'tags': []}
+    if prefix:
+        found = typeahead.suggestions.suggest(prefix)
+    jsonResp = json.dumps({'decks': [[deckid, title]
+                                     for deckid, title in found['decks']],
+                           'tags': found['tags']})
+    response = HttpResponse(jsonResp, content_type='application/json')
+    # Suggestions can be a few seconds out of date anyway
+    patch_cache_control(response, public=True,
+                        max_age=typeahead.REFRESH_INTERVAL)
+    return response
+
+
+def view_tags(request):
+    '''
+    Returns a page listing the tags with the most published decks.
+    '''
+    return render(request, 'notecards/tags.html',
+                  {'tags': tagging.top_tags(TAG_LIMIT)})
+
+
 def view_deck(request):
     '''
     Returns a page with all the information about a deck
     '''
     deckid = request.GET.get('did')
-    deck = Deck.objects.get(pk=deckid)
+    deck = Deck.objects.select_related('source').get(pk=deckid)
+    version = caching.deck_version(deck)
+    owner = deck.author_id == request.user.id
+    if owner and deck.source_id:
+        # The owner of a linked clone sees their own scores, which aren't
+        # part of the deck's version
+        progress = CardProgress.objects.filter(deck=deck)
+        scores = dict(progress.values_list('card_id', 'score'))
+        cards = list(deck.cards())
+        for card in cards:
+            card.score = scores.get(card.id, 0)
+        cardlist = render_to_string('notecards/card_options.html',
+                                    {'cards': cards, 'scored': True})
+    else:
+        # Only the owner sees the scores
+        cardlist = caching.cached(
+            'deck-cards-owner' if owner else 'deck-cards',
+            version + [deck.score_version] if owner else version,
+            lambda: render_to_string('notecards/card_options.html',
+                                     {'cards': deck.cards(),
+                                      'scored': owner}))
+
     # deck form is pre-filled with deck info
     deckform = deckForm(instance=deck)
     # card form is empty since it's used to add new cards
     cardform = cardForm()
-    cards = deck.card_set.all()
-
     context_dict = {'deckform': deckform,
                     'cardform': cardform,
-                    'cards': cards,
+                    'importform': importForm(),
+                    'cardlist': cardlist,
                     'deck': deck}
 
+    if not request.user.is_authenticated():
+        # Every anonymous visitor is shown the same page
+        content = caching.cached(
+            'deck-page',
+            version,
+            lambda: render(request,
+                           'notecards/view_deck.html',
+                           context_dict).content)
+        return HttpResponse(content)
     return render(request, 'notecards/view_deck.html', context_dict)
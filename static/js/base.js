@@ -30,4 +30,324 @@ $.ajaxSetup({
 
 $('#lolink').click(function() {
     $('#loform').submit();
-});
\ No newline at end of file
+});
+
+// Suggest deck titles and tags as the user types into the search box.
+// Requests wait for a short pause in typing and replies to anything but
+// the latest request are dropped.
+var suggestTimer = null;
+var suggestRequest = 0;
+$('#searchbox').on('input', function() {
+    var box = $(this);
+    clearTimeout(suggestTimer);
+    suggestTimer = setTimeout(function() {
+        var request = ++suggestRequest;
+        var prefix = $.trim(box.val());
+        if (prefix === '') {
+            $('#suggestions').empty();
+            return;
+        }
+        $.getJSON(box.data('url'), {q: prefix}, function(data) {
+            if (request !== suggestRequest) {
+                return;
+            }
+            var list = $('#suggestions').empty();
+            $.each(data['decks'], function(i, deck) {
+                list.append($('<option>').attr('value', deck[1]));
+            });
+            $.each(data['tags'], function(i, tag) {
+                list.append($('<option>').attr('value', tag));
+            });
+        });
+    }, 100);
+});
+
+// Queue of cards for the drill page. Cards are fetched from the server in
+// batches and the queue refills itself in the background once it runs
+// low, so moving on to the next card normally doesn't wait on a request.
+function CardQueue(url, size) {
+    this.url = url;
+    this.size = size || 20;
+    this.cards = [];
+    this.waiting = [];
+    this.loading = false;
+}
+
+CardQueue.prototype.refill = function() {
+    if (this.loading) {
+        return;
+    }
+    var queue = this;
+    queue.loading = true;
+    $.ajax({
+        method: 'GET',
+        url: queue.url,
+        data: {n: queue.size},
+        dataType: 'json',
+        success: function(data) {
+            $.each(data['cards'], function(i, card) {
+                queue.cards.push({id: card[0], front: card[1]});
+            });
+        },
+        complete: function() {
+            queue.loading = false;
+            // Hand out cards to anyone who asked while the queue was
+            // empty. If the server had nothing left to give them, they
+            // get null.
+            while (queue.waiting.length > 0) {
+                queue.waiting.shift()(queue.cards.shift() || null);
+            }
+        }
+    });
+};
+
+CardQueue.prototype.next = function(callback) {
+    if (this.cards.length > 0) {
+        callback(this.cards.shift());
+    } else {
+        this.waiting.push(callback);
+        this.refill();
+    }
+    if (this.cards.length < this.size / 2) {
+        this.refill();
+    }
+};
+
+// Drilling without the server. The deck is downloaded once and kept in
+// localStorage by version, cards are drawn and answers graded in the
+// browser the same way the server does it, and the answers are sent back
+// in batches. The server replays them against the scores it holds and
+// replies with the resulting scores, which replace the local ones, so
+// answers given elsewhere in the meantime aren't lost.
+function OfflineDeck(deckId, packUrl, syncUrl) {
+    this.key = 'notecards:deck:' + deckId;
+    this.pendingKey = 'notecards:answers:' + deckId;
+    this.packUrl = packUrl;
+    this.syncUrl = syncUrl;
+    this.cards = [];
+    this.byId = {};
+    this.version = null;
+    this.weak = 3;
+    this.pending = this.loadItem(this.pendingKey) || [];
+    this.syncing = 0;
+}
+
+OfflineDeck.MAX_SCORE = 5;
+OfflineDeck.RESET_SCORE = 1;
+// Answers sent to the server at once
+OfflineDeck.BATCH_SIZE = 50;
+// Milliseconds between syncs while answers are waiting
+OfflineDeck.SYNC_INTERVAL = 60000;
+
+OfflineDeck.prototype.loadItem = function(key) {
+    try {
+        return JSON.parse(window.localStorage.getItem(key));
+    } catch (e) {
+        return null;
+    }
+};
+
+OfflineDeck.prototype.saveItem = function(key, value) {
+    try {
+        window.localStorage.setItem(key, JSON.stringify(value));
+    } catch (e) {
+        // Storage is full or turned off, the deck just won't be kept
+        // between visits
+    }
+};
+
+OfflineDeck.prototype.use = function(pack) {
+    var deck = this;
+    deck.version = pack['version'];
+    deck.weak = pack['weak'];
+    deck.cards = [];
+    deck.byId = {};
+    $.each(pack['cards'], function(i, row) {
+        var card = {id: row[0], front: row[1], back: row[2], score: row[3]};
+        deck.cards.push(card);
+        deck.byId[card.id] = card;
+    });
+};
+
+OfflineDeck.prototype.store = function() {
+    this.saveItem(this.key, {
+        version: this.version,
+        weak: this.weak,
+        cards: $.map(this.cards, function(card) {
+            return [[card.id, card.front, card.back, card.score]];
+        })
+    });
+};
+
+// Calls back with true once the deck is ready, or false if it couldn't
+// be loaded. Answers left over from an earlier visit are synced first,
+// and the deck is only downloaded if the copy kept from then is out of
+// date.
+OfflineDeck.prototype.load = function(callback) {
+    var deck = this;
+    var cached = deck.loadItem(deck.key);
+    if (cached) {
+        deck.use(cached);
+    }
+    deck.sync(function() {
+        var headers = {};
+        if (deck.version) {
+            headers['If-None-Match'] = '"' + deck.version + '"';
+        }
+        $.ajax({
+            method: 'GET',
+            url: deck.packUrl,
+            headers: headers,
+            dataType: 'json',
+            success: function(pack, status, xhr) {
+                if (xhr.status !== 304) {
+                    deck.use(pack);
+                    deck.store();
+                }
+                callback(true);
+            },
+            error: function() {
+                // Offline, so drill whatever was kept
+                callback(deck.cards.length > 0);
+            }
+        });
+    });
+    setInterval(function() {
+        deck.sync();
+    }, OfflineDeck.SYNC_INTERVAL);
+};
+
+function randomInt(low, high) {
+    return low + Math.floor(Math.random() * (high - low + 1));
+}
+
+// Draws a card like the server: a random score between the weakest and
+// strongest card, then any card at or below it. Hard mode draws evenly
+// from the cards at or below the weakness threshold.
+OfflineDeck.prototype.draw = function(hard) {
+    var eligible = this.cards;
+    if (hard) {
+        var weak = this.weak;
+        eligible = $.grep(eligible, function(card) {
+            return card.score <= weak;
+        });
+    } else if (eligible.length > 0) {
+        var scores = $.map(eligible, function(card) {
+            return card.score;
+        });
+        var rscore = randomInt(Math.min.apply(null, scores),
+                               Math.max.apply(null, scores));
+        eligible = $.grep(eligible, function(card) {
+            return card.score <= rscore;
+        });
+    }
+    if (eligible.length === 0) {
+        return null;
+    }
+    return eligible[randomInt(0, eligible.length - 1)];
+};
+
+// Grades an answer like the server: every card with the same front whose
+// back matches gains a point, otherwise all of them are reset. Returns
+// the same result check_answer would. The answer is kept with the time
+// the user took and when they gave it, for the server's review log.
+OfflineDeck.prototype.check = function(cardId, answer, time) {
+    var card = this.byId[cardId];
+    var same = $.grep(this.cards, function(other) {
+        return other.front === card.front;
+    });
+    var matching = $.grep(same, function(other) {
+        return other.back === answer;
+    });
+    if (matching.length > 0) {
+        $.each(matching, function(i, other) {
+            other.score = Math.min(other.score + 1, OfflineDeck.MAX_SCORE);
+        });
+    } else {
+        $.each(same, function(i, other) {
+            other.score = OfflineDeck.RESET_SCORE;
+        });
+    }
+    this.pending.push([cardId, answer, time, Date.now()]);
+    this.saveItem(this.pendingKey, this.pending);
+    this.store();
+    if (this.pending.length >= OfflineDeck.BATCH_SIZE) {
+        this.sync();
+    }
+    return {result: matching.length > 0 ? 'correct' : 'wrong',
+            answer: card.back};
+};
+
+// Gzips the body when the browser can, which shrinks a batch of answers
+// to a fraction of its size
+function compressBody(body, callback) {
+    if (!window.CompressionStream) {
+        callback(body, {});
+        return;
+    }
+    var stream = new Blob([body]).stream()
+        .pipeThrough(new CompressionStream('gzip'));
+    new Response(stream).arrayBuffer().then(function(buffer) {
+        callback(buffer, {'Content-Encoding': 'gzip'});
+    }, function() {
+        callback(body, {});
+    });
+}
+
+// Sends the waiting answers to the server, then calls back whether or not
+// that worked. Answers stay queued until the server has them.
+OfflineDeck.prototype.sync = function(callback) {
+    var deck = this;
+    callback = callback || $.noop;
+    if (deck.pending.length === 0 || deck.syncing) {
+        callback();
+        return;
+    }
+    var batch = deck.pending.slice(0, OfflineDeck.BATCH_SIZE);
+    deck.syncing = batch.length;
+    var body = JSON.stringify({answers: batch, version: deck.version});
+    compressBody(body, function(body, headers) {
+        $.ajax({
+            method: 'POST',
+            url: deck.syncUrl,
+            data: body,
+            headers: headers,
+            processData: false,
+            contentType: 'application/json',
+            dataType: 'json',
+            success: function(data) {
+                // The server's scores win
+                $.each(data['scores'], function(cardId, score) {
+                    if (deck.byId[cardId]) {
+                        deck.byId[cardId].score = score;
+                    }
+                });
+                // Cards deleted on the server go here too
+                $.each(data['results'], function(i, result) {
+                    if (result['result'] === 'unknown') {
+                        deck.remove(result['cardid']);
+                    }
+                });
+                deck.pending = deck.pending.slice(batch.length);
+                deck.saveItem(deck.pendingKey, deck.pending);
+                if (deck.cards.length > 0) {
+                    // A null version means the deck changed on the
+                    // server, so it's downloaded again next time
+                    deck.version = data['version'];
+                    deck.store();
+                }
+            },
+            complete: function() {
+                deck.syncing = 0;
+                callback();
+            }
+        });
+    });
+};
+
+OfflineDeck.prototype.remove = function(cardId) {
+    delete this.byId[cardId];
+    this.cards = $.grep(this.cards, function(card) {
+        return card.id !== cardId;
+    });
+};